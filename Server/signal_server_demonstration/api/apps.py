@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        # Connect the signal handlers that keep the recipient and token caches fresh
+        from api import recipients
+        from api import authentication
+        # Configure each new database connection
+        from api import database
+        # Register the checks for caches the worker processes cannot share
+        from api import caches
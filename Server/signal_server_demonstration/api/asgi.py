@@ -0,0 +1,223 @@
+import asyncio
+import contextvars
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+from corsheaders.middleware import CorsMiddleware
+from django.conf import settings
+from django.core import signals
+from django.core.handlers import base
+from django.core.handlers.exception import response_for_exception
+from django.core.handlers.wsgi import WSGIRequest, get_script_name
+from django.db import close_old_connections
+from django.urls import Resolver404, get_resolver, set_script_prefix
+
+# Serves the project over ASGI. Django 2.2 has no ASGI support, async views
+# or async ORM, so this handler provides the parts the API needs: requests
+# are read and written on the event loop, and everything that may touch the
+# database runs on a pool of ASGI_THREADS worker threads.
+#
+# Views run as they do under WSGI, through the middleware chain on a worker
+# thread, unless their class has an async handler for the method, named
+# asyncGet, asyncPost and so on, and its servesAsync(environ) accepts the
+# request. Those run on the event loop, with the view's checks before them
+# and its response after them on a worker thread, and await runInThread for
+# any query. While an async handler waits, such as a long poll waiting for
+# a message, it holds no thread.
+#
+# Async handlers skip the middleware chain, apart from the CORS headers, so
+# views only hand them requests that would otherwise hold a thread idle.
+# Request metrics are only collected for views run on a worker thread.
+
+
+@lru_cache(maxsize=None)
+def getExecutor():
+    return ThreadPoolExecutor(settings.ASGI_THREADS, thread_name_prefix='asgi')
+
+
+# Calls fn on a worker thread, in a copy of the caller's context so context
+# variables such as the database reads are routed to carry over. Each thread
+# keeps its own database connection, closed before and after the call if it
+# has failed or outlived CONN_MAX_AGE, as a request would close it.
+def runInThread(fn, *args, **kwargs):
+    def call():
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+    context = contextvars.copy_context()
+    return asyncio.get_event_loop().run_in_executor(getExecutor(), context.run, call)
+
+
+# Returns the request body, or None if the client disconnected first
+async def readBody(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+def buildEnviron(scope, body):
+    scriptName = scope.get('root_path', '')
+    pathInfo = scope['path']
+    if scriptName and pathInfo.startswith(scriptName):
+        pathInfo = pathInfo[len(scriptName):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI carries paths as latin-1 decoded bytes
+        'SCRIPT_NAME': scriptName.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': pathInfo.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    # The body has been read in full, whatever the client sent as its length
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+# Reads out a finished response as (status, headers, body), then closes it,
+# which ends the request
+def readResponse(response):
+    try:
+        body = b''.join(response)
+    finally:
+        response.close()
+    if not response.has_header('Content-Length'):
+        response['Content-Length'] = str(len(body))
+    headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in response.items()]
+    for cookie in response.cookies.values():
+        headers.append((b'Set-Cookie', cookie.output(header='').strip().encode('latin-1')))
+    return response.status_code, headers, body
+
+
+class ASGIHandler(base.BaseHandler):
+
+    def __init__(self):
+        super().__init__()
+        self.load_middleware()
+        self.cors = CorsMiddleware()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type %s' % scope['type'])
+
+        body = await readBody(receive)
+        if body is None:
+            return
+        environ = buildEnviron(scope, body)
+        match, handlerName = self.findAsyncHandler(environ)
+        if handlerName is None:
+            statusCode, headers, body = await runInThread(self.respond, environ)
+        else:
+            statusCode, headers, body = await self.respondAsync(environ, match, handlerName)
+
+        await send({'type': 'http.response.start', 'status': statusCode, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Returns the URL match and the name of the view's async handler for the
+    # request, or None for requests served by the view as usual
+    def findAsyncHandler(self, environ):
+        try:
+            match = get_resolver().resolve(environ['PATH_INFO'].encode('latin-1').decode('utf-8'))
+        except (Resolver404, UnicodeDecodeError):
+            return None, None
+        viewClass = getattr(match.func, 'cls', None)
+        handlerName = 'async' + environ['REQUEST_METHOD'].capitalize()
+        if viewClass is None or not hasattr(viewClass, handlerName) or not viewClass.servesAsync(environ):
+            return None, None
+        return match, handlerName
+
+    # Serves a request as WSGIHandler does, on a worker thread
+    def respond(self, environ):
+        set_script_prefix(get_script_name(environ))
+        signals.request_started.send(sender=self.__class__, environ=environ)
+        request = WSGIRequest(environ)
+        return readResponse(self.get_response(request))
+
+    # Serves a request with a view's async handler, following APIView.dispatch.
+    # The request is started and checked in one call on a worker thread, and
+    # finished in another.
+    async def respondAsync(self, environ, match, handlerName):
+        args, kwargs = match.args, match.kwargs
+        view = match.func.cls(**match.func.initkwargs)
+
+        def start():
+            set_script_prefix(get_script_name(environ))
+            signals.request_started.send(sender=self.__class__, environ=environ)
+            request = WSGIRequest(environ)
+            request.resolver_match = match
+            view.setup(request, *args, **kwargs)
+            view.args, view.kwargs = args, kwargs
+            view.request = view.initialize_request(request, *args, **kwargs)
+            view.headers = view.default_response_headers
+            try:
+                # Checks the Host header against ALLOWED_HOSTS, as CommonMiddleware would
+                request.get_host()
+                view.initial(view.request, *args, **kwargs)
+            except Exception as exc:
+                return request, exc
+            return request, None
+
+        request, failure = await runInThread(start)
+        response = None
+        if failure is None:
+            try:
+                response = await getattr(view, handlerName)(view.request, *args, **kwargs)
+            except Exception as exc:
+                failure = exc
+
+        def finish():
+            try:
+                result = response
+                if failure is not None:
+                    # handle_exception passes on what it cannot handle with a
+                    # bare raise, so it must run while the exception is handled
+                    try:
+                        raise failure
+                    except Exception as exc:
+                        result = view.handle_exception(exc)
+                result = view.finalize_response(view.request, result, *args, **kwargs)
+                result.render()
+                result = self.cors.process_response(request, result)
+            except Exception as exc:
+                result = response_for_exception(request, exc)
+            return readResponse(result)
+
+        return await runInThread(finish)
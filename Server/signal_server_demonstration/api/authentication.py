@@ -0,0 +1,120 @@
+import hashlib
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import ugettext as _
+from rest_framework import exceptions
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication, jwt_get_username_from_payload
+
+from api.models import Device
+
+# Clients send the same token on many requests in a row. Once a token has
+# been verified, the user and device it resolved to are cached until the
+# token expires, so later requests skip both the signature check and the
+# user query.
+#
+# Each entry records the user's current token generation, a random value
+# that is removed whenever the user or their device changes, including its
+# preKeyCount, which the entry holds for the prekey hint. An entry is
+# only used while its generation is still the current one, so deleting or
+# re-registering a device, or disabling the user, takes effect at once.
+
+
+# Tokens arrive as bytes from the Authorization header
+def tokenKey(token):
+    return 'token:%s' % hashlib.sha256(token).hexdigest()
+
+
+def generationKey(username):
+    return 'token-generation:%s' % username
+
+
+# Returns the user's token generation, starting a new one if there is none
+def currentGeneration(username):
+    cache.add(generationKey(username), uuid.uuid4().hex, None)
+    return cache.get(generationKey(username))
+
+
+# Stops every cached token of the user from being used, now and again once
+# the change is committed, in case a concurrent request cached the old rows
+def invalidateTokens(username):
+    cache.delete(generationKey(username))
+    transaction.on_commit(lambda: cache.delete(generationKey(username)))
+
+
+# Builds the user and device from a cache entry. The other fields are
+# deferred, and loaded from the database only if something reads them.
+def fromTokenEntry(entry):
+    generation, username, userId, deviceId, registrationId, address, preKeyCount = entry
+    user = User.from_db(None, ['id', 'username'], (userId, username))
+    user.device = Device.from_db(None, ['id', 'user_id', 'registrationId', 'address', 'preKeyCount'],
+                                 (deviceId, userId, registrationId, address, preKeyCount))
+    return user
+
+
+# JWT authentication that loads the user's device in the same query as the
+# user, so views can use request.user.device without another lookup. Tokens
+# seen before are answered from the cache without either.
+class DeviceJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+
+    def authenticate(self, request):
+        token = self.get_jwt_value(request)
+        if token is None:
+            return None
+
+        entry = cache.get(tokenKey(token))
+        if entry is not None and cache.get(generationKey(entry[1])) == entry[0]:
+            return fromTokenEntry(entry), token
+
+        result = super().authenticate(request)
+        user = result[0]
+        expiresIn = int(self.payload.get('exp', 0) - time.time())
+        # Only users with a device are cached, as they make nearly all requests
+        if expiresIn > 0 and hasattr(user, 'device'):
+            device = user.device
+            entry = (self.generation, user.username, user.id, device.id, device.registrationId, device.address,
+                     device.preKeyCount)
+            cache.set(tokenKey(token), entry, expiresIn)
+        return result
+
+    def authenticate_credentials(self, payload):
+        User = get_user_model()
+        username = jwt_get_username_from_payload(payload)
+
+        if not username:
+            raise exceptions.AuthenticationFailed(_('Invalid payload.'))
+
+        # Read before the user, so a change made while the user is loading
+        # leaves the entry cached below already out of date
+        self.payload = payload
+        self.generation = currentGeneration(username)
+
+        try:
+            user = User.objects.select_related('device').get(**{User.USERNAME_FIELD: username})
+        except User.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid signature.'))
+
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User account is disabled.'))
+
+        return user
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidateUserTokens(sender, instance, **kwargs):
+    invalidateTokens(instance.username)
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def invalidateDeviceTokens(sender, instance, **kwargs):
+    # Deleted devices were detached from their user, and invalidated, already
+    if instance.user_id is not None:
+        invalidateTokens(instance.user.username)
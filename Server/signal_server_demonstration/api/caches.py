@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS
+from django.core.checks import Tags, Warning, register
+
+# Cache backends whose entries live in the memory of one process
+PROCESS_LOCAL_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+def isProcessLocal(alias=DEFAULT_CACHE_ALIAS):
+    return settings.CACHES[alias]['BACKEND'] in PROCESS_LOCAL_BACKENDS
+
+
+# Recipient devices and verified tokens are cached in the default cache,
+# and removed from it whenever the device or user changes. A removal made by
+# one worker process must reach every other one, or they keep serving the
+# old device and accepting its tokens, so the default cache has to be shared
+# once there is more than one worker. With a read replica it also records
+# which devices must read from the primary, and a device's next request may
+# reach any worker, so the cache has to be shared whatever the worker count.
+#
+# These are warnings so that migrate and the other commands still run, and
+# check and runserver report them.
+@register(Tags.caches)
+def checkSharedCache(app_configs, **kwargs):
+    if not isProcessLocal():
+        return []
+    warnings = []
+    if settings.WORKER_PROCESSES > 1:
+        warnings.append(Warning(
+            'WORKER_PROCESSES is %d but the default cache is local to each process.' % settings.WORKER_PROCESSES,
+            hint='Set MEMCACHED_LOCATION so the workers share one.', id='api.W001'))
+    if settings.REPLICA_DATABASE:
+        warnings.append(Warning(
+            'REPLICA_DATABASE is set but the default cache is local to each process, so a device could read '
+            'from the replica before its own writes reach it.',
+            hint='Set MEMCACHED_LOCATION.', id='api.W002'))
+    return warnings
+
+
+# The worker count is only known from WEB_CONCURRENCY, and gunicorn -w does
+# not set it, so check --deploy warns about a process-local cache regardless
+@register(Tags.caches, deploy=True)
+def checkDeployedCache(app_configs, **kwargs):
+    if not isProcessLocal() or settings.WORKER_PROCESSES > 1:
+        return []
+    return [Warning(
+        'The default cache is local to each process, which is only correct with a single worker process.',
+        hint='Set MEMCACHED_LOCATION if more than one worker serves the API.', id='api.W003')]
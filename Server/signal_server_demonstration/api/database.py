@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+# Applies settings.SQLITE_PRAGMAS to every new SQLite connection. Most
+# pragmas only last as long as the connection, so they are set each time
+# one is opened rather than once on the database file.
+@receiver(connection_created)
+def configureSqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
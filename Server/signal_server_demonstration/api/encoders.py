@@ -0,0 +1,73 @@
+import base64
+import zlib
+
+from api.renderers import dumpJSON
+
+# Read-only encoders for the responses that list many messages and for
+# prekey bundles. They produce the same data as MessageSerializer and
+# PreKeyBundleSerializer but read each value once, with no fields, no
+# OrderedDicts and no validation machinery in between.
+
+# The fields to select with Message.objects.values() for rows that
+# encodeMessages can encode without building model instances. created is
+# only read by encodeCursor.
+MESSAGE_VALUES = (
+    'id', 'created', 'sender__address', 'sender__registrationId', 'recipient__address',
+    'recipientRegistrationId', 'messageType', 'body', 'compressed',
+)
+
+
+def encodeKey(value):
+    return base64.b64encode(value).decode('ascii')
+
+
+# Rebuilds the JSON content a client sent from the stored message columns
+def encodeContent(messageType, body, compressed, registrationId):
+    body = zlib.decompress(body) if compressed else bytes(body)
+    return dumpJSON({
+        'type': messageType,
+        'body': body.decode('latin-1'),
+        'registrationId': registrationId,
+    })
+
+
+def encodeMessage(message):
+    sender = message.sender
+    return {
+        'id': message.id,
+        'senderAddress': sender.address,
+        'senderRegistrationID': sender.registrationId,
+        'content': encodeContent(message.messageType, message.body, message.compressed, message.recipientRegistrationId),
+        'recipientAddress': message.recipient.address,
+    }
+
+
+def encodeMessageValues(row):
+    return {
+        'id': row['id'],
+        'senderAddress': row['sender__address'],
+        'senderRegistrationID': row['sender__registrationId'],
+        'content': encodeContent(row['messageType'], row['body'], row['compressed'], row['recipientRegistrationId']),
+        'recipientAddress': row['recipient__address'],
+    }
+
+
+# Encodes Message instances, or dicts from values(*MESSAGE_VALUES)
+def encodeMessages(messages):
+    return [encodeMessageValues(x) if isinstance(x, dict) else encodeMessage(x) for x in messages]
+
+
+# The device's bundle with this one-time prekey
+def encodeBundle(device, preKey):
+    signedPreKey = device.signedprekey
+    return {
+        'address': device.address,
+        'identityKey': encodeKey(device.identityKey),
+        'registrationId': device.registrationId,
+        'preKey': {'keyId': preKey.keyId, 'publicKey': encodeKey(preKey.publicKey)},
+        'signedPreKey': {
+            'keyId': signedPreKey.keyId,
+            'publicKey': encodeKey(signedPreKey.publicKey),
+            'signature': encodeKey(signedPreKey.signature),
+        },
+    }
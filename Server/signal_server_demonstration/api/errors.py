@@ -56,6 +56,16 @@ recipient_identity_changed = Response({
     "message": "Recipients device has changed"
 }, status=status.HTTP_403_FORBIDDEN)
 
+reached_max_prekeys = Response({
+    "code": "reached_max_prekeys",
+    "message": "Storing these prekeys would exceed the maximum allowed for a device"
+}, status=status.HTTP_403_FORBIDDEN)
+
+duplicate_prekey = Response({
+    "code": "duplicate_prekey",
+    "message": "A prekey with this keyId is already stored for the device"
+}, status=status.HTTP_400_BAD_REQUEST)
+
 def invalidData(errors):
     return Response({
         "code": "invalid_data",
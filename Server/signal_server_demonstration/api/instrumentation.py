@@ -0,0 +1,177 @@
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import ExitStack
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+# Per-view request metrics. When settings.REQUEST_METRICS is on, every
+# response carries a Server-Timing header with its query count, time spent
+# in the database, time spent rendering the response and total time. Each
+# worker process also aggregates the metrics per view and writes them to
+# its own file under REQUEST_METRICS_DIR, which the request_metrics command
+# merges. When the setting is off the middleware removes itself from the
+# chain, so requests pay nothing for it.
+
+# Upper bounds, in milliseconds, of the latency histogram buckets. A last
+# bucket holds anything slower.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def emptyStats():
+    return {
+        'count': 0,
+        'queries': 0,
+        'maxQueries': 0,
+        'dbMs': 0.0,
+        'renderMs': 0.0,
+        'totalMs': 0.0,
+        'latency': [0] * (len(LATENCY_BUCKETS) + 1),
+    }
+
+
+def mergeStats(into, stats):
+    into['count'] += stats['count']
+    into['queries'] += stats['queries']
+    into['maxQueries'] = max(into['maxQueries'], stats['maxQueries'])
+    into['dbMs'] += stats['dbMs']
+    into['renderMs'] += stats['renderMs']
+    into['totalMs'] += stats['totalMs']
+    into['latency'] = [x + y for x, y in zip(into['latency'], stats['latency'])]
+
+
+# Estimates a latency percentile as the upper bound of the histogram bucket
+# it falls in. Returns None for the overflow bucket.
+def latencyPercentile(stats, fraction):
+    target = fraction * stats['count']
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS + (None,), stats['latency']):
+        seen += count
+        if seen >= target:
+            return bound
+    return None
+
+
+# Aggregates this process's metrics, writing them out at most every
+# REQUEST_METRICS_FLUSH_INTERVAL seconds
+class RequestMetrics:
+
+    def __init__(self, directory, flushInterval):
+        self.path = os.path.join(directory, '%d.json' % os.getpid())
+        self.flushInterval = flushInterval
+        self.views = {}
+        self.lastFlush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, view, queries, dbMs, renderMs, totalMs):
+        bucket = sum(1 for bound in LATENCY_BUCKETS if totalMs > bound)
+        with self._lock:
+            stats = self.views.setdefault(view, emptyStats())
+            stats['count'] += 1
+            stats['queries'] += queries
+            stats['maxQueries'] = max(stats['maxQueries'], queries)
+            stats['dbMs'] += dbMs
+            stats['renderMs'] += renderMs
+            stats['totalMs'] += totalMs
+            stats['latency'][bucket] += 1
+            due = time.monotonic() - self.lastFlush >= self.flushInterval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self.lastFlush = time.monotonic()
+            data = json.dumps({'buckets': LATENCY_BUCKETS, 'views': self.views})
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as metricsFile:
+            metricsFile.write(data)
+        os.replace(temporary, self.path)
+
+
+@lru_cache(maxsize=None)
+def getRequestMetrics():
+    return RequestMetrics(settings.REQUEST_METRICS_DIR, settings.REQUEST_METRICS_FLUSH_INTERVAL)
+
+
+# Writes out whatever was recorded since the last flush
+@atexit.register
+def flushOnExit():
+    if getRequestMetrics.cache_info().currsize:
+        getRequestMetrics().flush()
+
+
+# Merges every process's metrics from the directory into {view: stats}
+def loadMetrics(directory):
+    views = {}
+    if not os.path.isdir(directory):
+        return views
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, name)) as metricsFile:
+            data = json.load(metricsFile)
+        # Files written with other buckets cannot be merged
+        if tuple(data['buckets']) != LATENCY_BUCKETS:
+            continue
+        for view, stats in data['views'].items():
+            mergeStats(views.setdefault(view, emptyStats()), stats)
+    return views
+
+
+# Times every query on a connection for the request being measured
+class QueryTimer:
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.queries += 1
+
+
+class InstrumentationMiddleware:
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_METRICS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        timer = QueryTimer()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timer))
+            response = self.get_response(request)
+        totalMs = (time.perf_counter() - started) * 1000
+        dbMs = timer.seconds * 1000
+        renderMs = getattr(request, 'renderSeconds', 0.0) * 1000
+
+        response['Server-Timing'] = 'db;dur=%.2f;desc="%d queries", render;dur=%.2f, total;dur=%.2f' % (
+            dbMs, timer.queries, renderMs, totalMs)
+        match = request.resolver_match
+        # Requests that matched no URL are counted together
+        view = '%s %s' % (request.method, match.func.__name__ if match else 'unresolved')
+        getRequestMetrics().record(view, timer.queries, dbMs, renderMs, totalMs)
+        return response
+
+    # DRF responses are rendered after the view returns, time that separately
+    def process_template_response(self, request, response):
+        renderStarted = time.perf_counter()
+
+        def rendered(response):
+            request.renderSeconds = time.perf_counter() - renderStarted
+
+        response.add_post_render_callback(rendered)
+        return response
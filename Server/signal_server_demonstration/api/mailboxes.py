@@ -0,0 +1,88 @@
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from api.encoders import MESSAGE_VALUES
+from api.models import Message
+from api.pagination import messagePage
+
+# Mailbox storage. Views store and read messages through the backend named
+# by settings.MAILBOX_BACKEND, which provides:
+#
+#   store(messages)
+#       Stores unsaved Message instances, setting their id and created.
+#   fetch(device, since=None, limit=None)
+#       Returns (messages, hasMore) in mailbox order. Without a limit the
+#       whole mailbox is returned, otherwise a page after the since cursor.
+#       Messages leased by drain are left out until their lease expires.
+#       The messages may be rows of api.encoders.MESSAGE_VALUES instead of
+#       Message instances, as they are only passed to encodeMessages and
+#       encodeCursor.
+#   drain(device, limit, visibilityTimeout=None)
+#       As MessageManager.drain, returns (messages, hasMore).
+#   acknowledge(device, ids)
+#       Removes the device's messages with these ids. Returns the set of ids
+#       removed and the set of ids known to belong to another device.
+#   purgeExpired(cutoff, batchSize, pause=0)
+#       Removes messages created before cutoff, returning how many.
+#   removeDevice(deviceId, batchSize, pause=0)
+#       Removes a deleted device's messages, returning how many.
+#
+# Returned Message instances have sender and recipient devices attached with at least
+# their id, address and registrationId, so they serialize without queries.
+
+
+# Deletes the rows of queryset batchSize at a time, sleeping pause seconds
+# between batches. Returns how many rows were deleted.
+def deleteInBatches(queryset, batchSize, pause=0):
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batchSize])
+        if not ids:
+            return deleted
+        deleted += queryset.model.objects.filter(id__in=ids).delete()[0]
+        if pause:
+            time.sleep(pause)
+
+
+# Keeps messages in the Message table
+class DatabaseMailbox:
+
+    def store(self, messages):
+        return Message.objects.store(messages)
+
+    def fetch(self, device, since=None, limit=None):
+        # Rows with the sender and recipient joined in, which encode without
+        # building model instances or making further queries
+        messages = Message.objects.visible(device, timezone.now()).values(*MESSAGE_VALUES)
+        if limit is None:
+            return list(messages.order_by('created', 'id')), False
+        return messagePage(messages, since, limit)
+
+    def drain(self, device, limit, visibilityTimeout=None):
+        return Message.objects.drain(device, limit, visibilityTimeout)
+
+    def acknowledge(self, device, ids):
+        # One lookup to tell messages owned by another device apart from
+        # messages that do not exist, then one delete of the owned messages
+        recipients = dict(Message.objects.filter(id__in=ids).values_list('id', 'recipient_id'))
+        Message.objects.filter(id__in=ids, recipient=device).delete()
+        acknowledged = {x for x, recipient in recipients.items() if recipient == device.id}
+        return acknowledged, set(recipients) - acknowledged
+
+    def purgeExpired(self, cutoff, batchSize, pause=0):
+        return deleteInBatches(Message.objects.filter(created__lt=cutoff).order_by('created'), batchSize, pause)
+
+    def removeDevice(self, deviceId, batchSize, pause=0):
+        # Sent messages go too, they reference the device being removed
+        messages = Message.objects.filter(Q(recipient=deviceId) | Q(sender=deviceId)).order_by('id')
+        return deleteInBatches(messages, batchSize, pause)
+
+
+@lru_cache(maxsize=None)
+def getMailbox():
+    return import_string(settings.MAILBOX_BACKEND)()
@@ -0,0 +1,49 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.mailboxes import getMailbox, deleteInBatches
+from api.models import Device, PreKey
+
+
+# Purges expired messages and removes deleted devices with their mailboxes
+# and keys. Rows are deleted in bounded batches, each its own short
+# transaction, so the command can run alongside live traffic. Run it
+# periodically, or leave it running with --every.
+class Command(BaseCommand):
+    help = 'Purges expired messages and deleted devices in bounded batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, default=settings.MESSAGE_TTL,
+                            help='seconds after which an undelivered message expires')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='seconds to sleep between batches')
+        parser.add_argument('--every', type=float, default=0,
+                            help='keep running, compacting again after this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            self.compact(options)
+            if not options['every']:
+                return
+            time.sleep(options['every'])
+
+    def compact(self, options):
+        mailbox = getMailbox()
+        batchSize, pause = options['batch_size'], options['pause']
+        cutoff = timezone.now() - timedelta(seconds=options['ttl'])
+        expired = mailbox.purgeExpired(cutoff, batchSize, pause)
+        self.stdout.write('Purged %d expired messages' % expired)
+
+        devices = messages = preKeys = 0
+        for device in Device.objects.filter(user__isnull=True).values_list('id', flat=True):
+            messages += mailbox.removeDevice(device, batchSize, pause)
+            preKeys += deleteInBatches(PreKey.objects.filter(device=device).order_by('id'), batchSize, pause)
+            # Only the device and its signed prekey are left
+            Device.objects.filter(pk=device).delete()
+            devices += 1
+        self.stdout.write('Removed %d deleted devices with %d messages and %d prekeys' % (devices, messages, preKeys))
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q, Sum
+
+from api.models import Device
+
+
+# Reports how depleted the devices' one-time prekey pools are. Reads the
+# counters kept on Device, so the PreKey table is never scanned.
+class Command(BaseCommand):
+    help = 'Reports one-time prekey pool depletion across all devices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--low-water-mark', type=int, default=settings.PREKEY_LOW_WATER_MARK,
+                            help='pools with fewer prekeys than this count as low')
+        parser.add_argument('--list', type=int, default=0, metavar='N',
+                            help='also list up to N devices with low pools, emptiest first')
+
+    def handle(self, *args, **options):
+        lowWaterMark = options['low_water_mark']
+        # Deleted devices waiting to be compacted have no user
+        devices = Device.objects.filter(user__isnull=False)
+        stats = devices.aggregate(
+            devices=Count('id'),
+            preKeys=Sum('preKeyCount'),
+            empty=Count('id', filter=Q(preKeyCount=0)),
+            low=Count('id', filter=Q(preKeyCount__lt=lowWaterMark)),
+        )
+        deviceCount = stats['devices']
+        preKeys = stats['preKeys'] or 0
+        self.stdout.write('Devices: %d' % deviceCount)
+        self.stdout.write('Prekeys stored: %d (%.1f per device)' % (preKeys, preKeys / deviceCount if deviceCount else 0))
+        self.stdout.write('Empty pools: %d' % stats['empty'])
+        self.stdout.write('Below low water mark of %d: %d' % (lowWaterMark, stats['low']))
+
+        if options['list']:
+            lowDevices = (devices.filter(preKeyCount__lt=lowWaterMark)
+                          .order_by('preKeyCount', 'id')
+                          .values_list('user__username', 'address', 'preKeyCount')[:options['list']])
+            for username, address, preKeyCount in lowDevices:
+                self.stdout.write('  %s %s %d' % (username, address, preKeyCount))
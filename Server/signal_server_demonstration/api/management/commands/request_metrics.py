@@ -0,0 +1,44 @@
+import json
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.instrumentation import LATENCY_BUCKETS, latencyPercentile, loadMetrics
+
+
+def formatBound(bound):
+    return '>%d' % LATENCY_BUCKETS[-1] if bound is None else '%d' % bound
+
+
+# Reports the per-view metrics collected by InstrumentationMiddleware
+# across all worker processes, slowest views by total time first
+class Command(BaseCommand):
+    help = 'Reports per-view query counts and latency collected with REQUEST_METRICS on'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='print the merged metrics as JSON')
+        parser.add_argument('--reset', action='store_true', help='delete the collected metrics afterwards')
+
+    def handle(self, *args, **options):
+        directory = settings.REQUEST_METRICS_DIR
+        views = loadMetrics(directory)
+
+        if options['json']:
+            self.stdout.write(json.dumps({'buckets': LATENCY_BUCKETS, 'views': views}, indent=2, sort_keys=True))
+        elif not views:
+            self.stdout.write('No metrics collected in %s' % directory)
+        else:
+            self.stdout.write('%-32s %8s %8s %8s %8s %8s %9s %9s' % (
+                'view', 'requests', 'queries', 'max', 'db ms', 'render', 'total ms', 'p50/p99'))
+            for view, stats in sorted(views.items(), key=lambda x: -x[1]['totalMs']):
+                count = stats['count']
+                self.stdout.write('%-32s %8d %8.1f %8d %8.2f %8.2f %9.2f %9s' % (
+                    view, count, stats['queries'] / count, stats['maxQueries'], stats['dbMs'] / count,
+                    stats['renderMs'] / count, stats['totalMs'] / count,
+                    '%s/%s' % (formatBound(latencyPercentile(stats, 0.5)), formatBound(latencyPercentile(stats, 0.99)))))
+            self.stdout.write('Means per request; p50/p99 are histogram bucket bounds in ms')
+
+        if options['reset'] and os.path.isdir(directory):
+            shutil.rmtree(directory)
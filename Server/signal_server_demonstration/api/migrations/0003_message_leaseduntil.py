@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_auto_20190426_2035'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='leasedUntil',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:26
+
+from django.db import migrations, models
+
+
+# Keyids were not unique before this migration, keep the oldest of each
+# duplicated prekey so the constraint can be added
+def remove_duplicate_prekeys(apps, schema_editor):
+    PreKey = apps.get_model('api', 'PreKey')
+    db = schema_editor.connection.alias
+    duplicates = (PreKey.objects.using(db).values('device', 'keyId')
+                  .annotate(keep=models.Min('id'), count=models.Count('id'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates:
+        (PreKey.objects.using(db).filter(device=duplicate['device'], keyId=duplicate['keyId'])
+         .exclude(id=duplicate['keep']).delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_message_leaseduntil'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_prekeys, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='prekey',
+            unique_together={('device', 'keyId')},
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['recipient', 'created', 'id'], name='api_message_mailbox_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:05
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+# Fill in the counter for existing devices with one UPDATE
+def count_prekeys(apps, schema_editor):
+    Device = apps.get_model('api', 'Device')
+    PreKey = apps.get_model('api', 'PreKey')
+    db = schema_editor.connection.alias
+    counts = (PreKey.objects.filter(device=models.OuterRef('pk')).order_by()
+              .values('device').annotate(count=models.Count('id')).values('count'))
+    Device.objects.using(db).update(preKeyCount=Coalesce(models.Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_mailbox_and_prekey_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='preKeyCount',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_prekeys, migrations.RunPython.noop),
+    ]
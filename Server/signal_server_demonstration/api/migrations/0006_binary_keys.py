@@ -0,0 +1,162 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:40
+
+import base64
+import binascii
+
+from django.db import migrations, models
+
+# (model, field) pairs moving from base64 text to raw bytes
+KEY_FIELDS = (
+    ('device', 'identityKey'),
+    ('prekey', 'publicKey'),
+    ('signedprekey', 'publicKey'),
+    ('signedprekey', 'signature'),
+)
+
+BATCH_SIZE = 1000
+
+
+def decode(text):
+    try:
+        return base64.b64decode(text)
+    except binascii.Error:
+        # Keep anything that was never valid base64 rather than losing it
+        return text.encode('utf-8')
+
+
+def encode(value):
+    return base64.b64encode(value).decode('ascii')
+
+
+# Copies every key between the text column and its binary replacement,
+# a batch of rows at a time
+def copy_keys(apps, db, fromField, toField, convert):
+    for modelName, field in KEY_FIELDS:
+        Model = apps.get_model('api', modelName)
+        objects = Model.objects.using(db)
+        source, target = fromField % field, toField % field
+        batch = []
+        for row in objects.only('id', source).iterator(chunk_size=BATCH_SIZE):
+            setattr(row, target, convert(getattr(row, source)))
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                objects.bulk_update(batch, [target])
+                batch = []
+        objects.bulk_update(batch, [target])
+
+
+def keys_to_binary(apps, schema_editor):
+    copy_keys(apps, schema_editor.connection.alias, '%s', '%sBinary', decode)
+
+
+def keys_to_text(apps, schema_editor):
+    copy_keys(apps, schema_editor.connection.alias, '%sBinary', '%s', encode)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_device_prekeycount'),
+    ]
+
+    # The text columns are made nullable first so the migration can be
+    # reversed, recreating them empty before the keys are copied back
+    operations = [
+        migrations.AlterField(
+            model_name='device',
+            name='identityKey',
+            field=models.CharField(max_length=44, null=True),
+        ),
+        migrations.AlterField(
+            model_name='prekey',
+            name='publicKey',
+            field=models.CharField(max_length=44, null=True),
+        ),
+        migrations.AlterField(
+            model_name='signedprekey',
+            name='publicKey',
+            field=models.CharField(max_length=44, null=True),
+        ),
+        migrations.AlterField(
+            model_name='signedprekey',
+            name='signature',
+            field=models.CharField(max_length=88, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='identityKeyBinary',
+            field=models.BinaryField(max_length=33, null=True),
+        ),
+        migrations.AddField(
+            model_name='prekey',
+            name='publicKeyBinary',
+            field=models.BinaryField(max_length=33, null=True),
+        ),
+        migrations.AddField(
+            model_name='signedprekey',
+            name='publicKeyBinary',
+            field=models.BinaryField(max_length=33, null=True),
+        ),
+        migrations.AddField(
+            model_name='signedprekey',
+            name='signatureBinary',
+            field=models.BinaryField(max_length=64, null=True),
+        ),
+        migrations.RunPython(keys_to_binary, keys_to_text),
+        migrations.RemoveField(
+            model_name='device',
+            name='identityKey',
+        ),
+        migrations.RemoveField(
+            model_name='prekey',
+            name='publicKey',
+        ),
+        migrations.RemoveField(
+            model_name='signedprekey',
+            name='publicKey',
+        ),
+        migrations.RemoveField(
+            model_name='signedprekey',
+            name='signature',
+        ),
+        migrations.RenameField(
+            model_name='device',
+            old_name='identityKeyBinary',
+            new_name='identityKey',
+        ),
+        migrations.RenameField(
+            model_name='prekey',
+            old_name='publicKeyBinary',
+            new_name='publicKey',
+        ),
+        migrations.RenameField(
+            model_name='signedprekey',
+            old_name='publicKeyBinary',
+            new_name='publicKey',
+        ),
+        migrations.RenameField(
+            model_name='signedprekey',
+            old_name='signatureBinary',
+            new_name='signature',
+        ),
+        migrations.AlterField(
+            model_name='device',
+            name='identityKey',
+            field=models.BinaryField(max_length=33),
+        ),
+        migrations.AlterField(
+            model_name='prekey',
+            name='publicKey',
+            field=models.BinaryField(max_length=33),
+        ),
+        migrations.AlterField(
+            model_name='signedprekey',
+            name='publicKey',
+            field=models.BinaryField(max_length=33),
+        ),
+        migrations.AlterField(
+            model_name='signedprekey',
+            name='signature',
+            field=models.BinaryField(max_length=64),
+        ),
+    ]
@@ -0,0 +1,113 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:20
+
+import json
+import zlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+# Most unreadable message ids listed when the migration stops
+MAX_REPORTED_IDS = 100
+
+
+# Splits the stored JSON content into columns. Content that is not a Signal
+# message in the current format stops the migration, listing the messages,
+# so they are fixed or removed by hand rather than lost without a trace.
+def split_content(apps, schema_editor):
+    Message = apps.get_model('api', 'Message')
+    messages = Message.objects.using(schema_editor.connection.alias)
+    batch = []
+    unreadable = []
+    for message in messages.only('id', 'content').iterator(chunk_size=BATCH_SIZE):
+        try:
+            content = json.loads(message.content)
+            message.recipientRegistrationId = int(content['registrationId'])
+            message.messageType = int(content['type'])
+            message.body = content['body'].encode('latin-1')
+        except (TypeError, KeyError, ValueError, AttributeError):
+            unreadable.append(message.id)
+            continue
+        batch.append(message)
+        if len(batch) == BATCH_SIZE:
+            messages.bulk_update(batch, ['recipientRegistrationId', 'messageType', 'body'])
+            batch = []
+    if unreadable:
+        # Nothing is kept, the migration's transaction is rolled back
+        raise ValueError(
+            '%d messages do not hold content in the current format, ids %s%s. Delete or fix them, then '
+            'migrate again.' % (len(unreadable), ', '.join(str(x) for x in unreadable[:MAX_REPORTED_IDS]),
+                                ', ...' if len(unreadable) > MAX_REPORTED_IDS else ''))
+    messages.bulk_update(batch, ['recipientRegistrationId', 'messageType', 'body'])
+
+
+def join_content(apps, schema_editor):
+    Message = apps.get_model('api', 'Message')
+    messages = Message.objects.using(schema_editor.connection.alias)
+    batch = []
+    for message in messages.iterator(chunk_size=BATCH_SIZE):
+        body = zlib.decompress(message.body) if message.compressed else bytes(message.body)
+        message.content = json.dumps({
+            'type': message.messageType,
+            'body': body.decode('latin-1'),
+            'registrationId': message.recipientRegistrationId,
+        }, separators=(',', ':'), ensure_ascii=False)
+        batch.append(message)
+        if len(batch) == BATCH_SIZE:
+            messages.bulk_update(batch, ['content'])
+            batch = []
+    messages.bulk_update(batch, ['content'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_binary_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.CharField(max_length=1000, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='recipientRegistrationId',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='messageType',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='body',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='compressed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(split_content, join_content),
+        migrations.RemoveField(
+            model_name='message',
+            name='content',
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='recipientRegistrationId',
+            field=models.PositiveIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='messageType',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='body',
+            field=models.BinaryField(),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:45
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_message_columns'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='device',
+            name='user',
+            field=models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['created'], name='api_message_created_idx'),
+        ),
+    ]
@@ -1,34 +1,232 @@
-from django.db import models
+from datetime import timedelta
+
+from django.db import models, transaction, connections
+from django.db.models import F, Q
+from django.db.models.sql import InsertQuery
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 
+# Public keys are 33 bytes and signatures 64. They are stored raw and only
+# converted to and from base64 by the serializers.
+KEY_LENGTH = 33
+SIGNATURE_LENGTH = 64
+
 class Device(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE)
-    # Identity key length is 44 text characters
-    identityKey = models.CharField(max_length=44, blank=False)
+    # Cleared when the owner deletes the device. The device is then no longer
+    # served, and the compact_mailboxes command removes it with its messages
+    # and keys later, outside the request.
+    user = models.OneToOneField(User, on_delete=models.CASCADE, null=True)
+    identityKey = models.BinaryField(max_length=KEY_LENGTH)
     registrationId = models.PositiveIntegerField(blank=False)
     address = models.CharField(max_length=100, blank=False)
+    # One-time prekeys left in the pool. Kept in step with the PreKey rows on
+    # every claim and upload so depletion can be read without counting them.
+    preKeyCount = models.PositiveIntegerField(default=0)
     class Meta:
         unique_together = ('user', 'address',)
 
+# Whether the database can return the rows changed by an INSERT, DELETE or
+# UPDATE, letting a row be claimed in the same statement that removes or
+# marks it
+def supportsReturning(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+class PreKeyManager(models.Manager):
+
+    # Removes and returns one prekey for the given device, or None if the
+    # device has run out. The claim is a single DELETE ... RETURNING statement
+    # where the database supports it, so two concurrent bundle requests can
+    # never be handed the same one-time prekey. The device's preKeyCount is
+    # decremented in the same transaction.
+    def claim(self, device):
+        connection = connections[self.db]
+        with transaction.atomic(using=self.db):
+            if supportsReturning(connection):
+                preKey = self._claim_returning(connection, device)
+            else:
+                preKey = self._claim_compare_and_delete(device)
+            if preKey is not None:
+                Device.objects.using(self.db).filter(pk=device.pk, preKeyCount__gt=0).update(
+                    preKeyCount=F('preKeyCount') - 1)
+        return preKey
+
+    def _claim_returning(self, connection, device):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        pk = qn(opts.pk.column)
+        deviceColumn = qn(opts.get_field('device').column)
+        keyIdColumn = qn(opts.get_field('keyId').column)
+        publicKeyColumn = qn(opts.get_field('publicKey').column)
+        # Postgres skips rows locked by other claims rather than queueing
+        # behind them, SQLite serialises the whole statement on its write lock
+        lock = ' FOR UPDATE SKIP LOCKED' if connection.vendor == 'postgresql' else ''
+        sql = (
+            'DELETE FROM {table} WHERE {pk} = ('
+            'SELECT {pk} FROM {table} WHERE {device} = %s ORDER BY {pk} LIMIT 1{lock}'
+            ') RETURNING {pk}, {keyId}, {publicKey}'
+        ).format(table=table, pk=pk, device=deviceColumn, lock=lock,
+                 keyId=keyIdColumn, publicKey=publicKeyColumn)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [device.pk])
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return self.model(id=row[0], device=device, keyId=row[1], publicKey=row[2])
+
+    # Fallback for databases without DELETE ... RETURNING. The prekey only
+    # counts as claimed if this request was the one that deleted the row.
+    def _claim_compare_and_delete(self, device):
+        connection = connections[self.db]
+        while True:
+            with transaction.atomic(using=self.db):
+                candidates = self.filter(device=device).order_by('pk')
+                if connection.features.has_select_for_update_skip_locked:
+                    candidates = candidates.select_for_update(skip_locked=True)
+                preKey = candidates.first()
+                if preKey is None:
+                    return None
+                deleted, _ = self.filter(pk=preKey.pk).delete()
+                if deleted:
+                    return preKey
+
 class PreKey(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE)
     keyId = models.PositiveIntegerField(blank=False)
-    # Public key length is 44 text characters
-    publicKey = models.CharField(max_length=44, blank=False)
+    publicKey = models.BinaryField(max_length=KEY_LENGTH)
+    objects = PreKeyManager()
+    class Meta:
+        # Clients look up the private half of a prekey by its id, so ids
+        # must be unique per device. Also indexes (device, keyId).
+        unique_together = ('device', 'keyId',)
 
 class SignedPreKey(models.Model):
     device = models.OneToOneField(Device, on_delete=models.CASCADE)
     keyId = models.PositiveIntegerField(blank=False)
-    # Public key length is 44 text characters
-    publicKey = models.CharField(max_length=44, blank=False)
-    # Signature length is 88 text characters
-    signature = models.CharField(max_length=88, blank=False)
+    publicKey = models.BinaryField(max_length=KEY_LENGTH)
+    signature = models.BinaryField(max_length=SIGNATURE_LENGTH)
+
+class MessageManager(models.Manager):
+
+    # Inserts unsaved messages, setting their id and created. bulk_create
+    # only sets ids where the database returns them from a multi-row insert,
+    # which Django does for PostgreSQL but not for SQLite, so there the rows
+    # are inserted with INSERT ... RETURNING, or one at a time on versions
+    # without it.
+    def store(self, messages):
+        connection = connections[self.db]
+        if connection.features.can_return_ids_from_bulk_insert:
+            return self.bulk_create(messages)
+        # As bulk_create, all or none of the messages are stored
+        with transaction.atomic(using=self.db, savepoint=False):
+            if supportsReturning(connection):
+                self._insert_returning(connection, messages)
+            else:
+                for message in messages:
+                    message.save(using=self.db)
+        return messages
+
+    def _insert_returning(self, connection, messages):
+        opts = self.model._meta
+        fields = [x for x in opts.concrete_fields if x is not opts.pk]
+        batchSize = connection.ops.bulk_batch_size(fields, messages)
+        for start in range(0, len(messages), batchSize):
+            batch = messages[start:start + batchSize]
+            query = InsertQuery(self.model)
+            query.insert_values(fields, batch)
+            # One multi-row INSERT, which also sets created on each message
+            (sql, params), = query.get_compiler(connection=connection).as_sql()
+            with connection.cursor() as cursor:
+                cursor.execute(sql + ' RETURNING ' + connection.ops.quote_name(opts.pk.column), params)
+                # Rows are numbered in the order they are inserted, whatever
+                # order RETURNING lists them in
+                ids = sorted(row[0] for row in cursor.fetchall())
+            for message, messageId in zip(batch, ids):
+                message.id = messageId
+                message._state.adding = False
+                message._state.db = self.db
+
+    # Takes up to limit messages from the front of a device's mailbox in one
+    # transaction. Without a visibility timeout the messages are deleted;
+    # with one they are leased and are drained again if still unacknowledged
+    # once it expires. Returns the messages and whether more remain.
+    def drain(self, device, limit, visibilityTimeout=None):
+        connection = connections[self.db]
+        now = timezone.now()
+        leasedUntil = now + timedelta(seconds=visibilityTimeout or 0)
+        with transaction.atomic(using=self.db):
+            # Lease the messages first so concurrent drains of one mailbox
+            # can never take the same message
+            if supportsReturning(connection):
+                ids = self._lease_returning(connection, device, limit, now, leasedUntil)
+            else:
+                ids = self._lease_locked(connection, device, limit, now, leasedUntil)
+            drained = self.filter(id__in=ids)
+            messages = list(drained.select_related('sender', 'recipient').order_by('created', 'id'))
+            if visibilityTimeout is None:
+                drained.delete()
+            hasMore = self.visible(device, now).exists()
+        return messages, hasMore
+
+    # The device's messages that are not leased at the given time
+    def visible(self, device, now):
+        return self.filter(recipient=device).filter(Q(leasedUntil__isnull=True) | Q(leasedUntil__lte=now))
+
+    def _lease_returning(self, connection, device, limit, now, leasedUntil):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        pk = qn(opts.pk.column)
+        recipientColumn = qn(opts.get_field('recipient').column)
+        createdColumn = qn(opts.get_field('created').column)
+        leasedUntilColumn = qn(opts.get_field('leasedUntil').column)
+        lock = ' FOR UPDATE SKIP LOCKED' if connection.vendor == 'postgresql' else ''
+        sql = (
+            'UPDATE {table} SET {leasedUntil} = %s WHERE {pk} IN ('
+            'SELECT {pk} FROM {table} WHERE {recipient} = %s '
+            'AND ({leasedUntil} IS NULL OR {leasedUntil} <= %s) '
+            'ORDER BY {created}, {pk} LIMIT %s{lock}'
+            ') RETURNING {pk}'
+        ).format(table=table, pk=pk, recipient=recipientColumn, created=createdColumn,
+                 leasedUntil=leasedUntilColumn, lock=lock)
+        adapt = connection.ops.adapt_datetimefield_value
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [adapt(leasedUntil), device.pk, adapt(now), limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    # Fallback for databases without UPDATE ... RETURNING
+    def _lease_locked(self, connection, device, limit, now, leasedUntil):
+        pending = self.visible(device, now).order_by('created', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)
+        ids = list(pending.values_list('id', flat=True)[:limit])
+        self.filter(id__in=ids).update(leasedUntil=leasedUntil)
+        return ids
 
 class Message(models.Model):
     recipient = models.ForeignKey(Device, on_delete=models.CASCADE, related_name="received_messages")
     created = models.DateTimeField(auto_now_add=True)
-    content = models.CharField(max_length=1000, blank=False)
+    # The client's JSON content is split into columns by MessageSerializer
+    # and put back together when the message is fetched
+    recipientRegistrationId = models.PositiveIntegerField()
+    messageType = models.PositiveSmallIntegerField()
+    # Raw ciphertext, zlib compressed when that made it smaller
+    body = models.BinaryField()
+    compressed = models.BooleanField(default=False)
     sender = models.ForeignKey(Device, on_delete=models.CASCADE, related_name="sent_messages")
+    # Set while a drained message is awaiting acknowledgement
+    leasedUntil = models.DateTimeField(null=True, blank=True)
+    objects = MessageManager()
     class Meta:
         ordering = ('created',)
+        indexes = [
+            # Mailbox reads filter on recipient and page in (created, id) order
+            models.Index(fields=['recipient', 'created', 'id'], name='api_message_mailbox_idx'),
+            # Expired messages are purged oldest first
+            models.Index(fields=['created'], name='api_message_created_idx'),
+        ]
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+# Sets an asyncio.Event from any thread
+class LoopEvent:
+
+    def __init__(self, loop, event):
+        self.loop = loop
+        self.event = event
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+# Wakes long-polling requests within this process when a message is stored
+# for the device they are waiting on. Requests in other worker processes are
+# not woken and fall back to rechecking their mailbox periodically.
+class LocalNotificationBus:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    # Yields an event that is set whenever a message arrives for the device.
+    # Subscribe before checking the mailbox so no message can slip between
+    # the check and the wait.
+    @contextmanager
+    def subscribe(self, deviceId):
+        event = threading.Event()
+        with self._subscribed(deviceId, event):
+            yield event
+
+    # As subscribe, for requests waiting on an event loop. Yields an
+    # asyncio.Event, which is set on its loop whichever thread notifies.
+    @contextmanager
+    def subscribeAsync(self, deviceId):
+        event = asyncio.Event()
+        with self._subscribed(deviceId, LoopEvent(asyncio.get_event_loop(), event)):
+            yield event
+
+    @contextmanager
+    def _subscribed(self, deviceId, event):
+        with self._lock:
+            self._subscribers.setdefault(deviceId, set()).add(event)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._subscribers[deviceId].discard(event)
+                if not self._subscribers[deviceId]:
+                    del self._subscribers[deviceId]
+
+    def notify(self, deviceIds):
+        with self._lock:
+            for deviceId in deviceIds:
+                for event in self._subscribers.get(deviceId, ()):
+                    event.set()
+
+
+@lru_cache(maxsize=None)
+def getNotificationBus():
+    return import_string(settings.MESSAGE_NOTIFICATION_BUS)()
+
+
+# Notifies waiting requests once the messages for these devices are committed
+def notifyRecipients(deviceIds):
+    deviceIds = set(deviceIds)
+    transaction.on_commit(lambda: getNotificationBus().notify(deviceIds))
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta, timezone
+
+from django.db.models import Q
+
+# Page size used when a client asks for a page without giving a limit
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Largest id a database's 64-bit integer column can hold
+MAX_ID = (1 << 63) - 1
+
+
+# Cursors identify a message by its position in the mailbox ordering
+# (created, id), written as "<microseconds since epoch>-<id>". Takes a
+# Message or a row of api.encoders.MESSAGE_VALUES.
+def encodeCursor(message):
+    if isinstance(message, dict):
+        created, messageId = message['created'], message['id']
+    else:
+        created, messageId = message.created, message.id
+    return '%d-%d' % ((created - EPOCH) // timedelta(microseconds=1), messageId)
+
+
+# Raises ValueError for anything that is not a cursor, including one whose
+# time or id is out of range
+def decodeCursor(cursor):
+    microseconds, messageId = cursor.split('-')
+    messageId = int(messageId)
+    if not (0 <= messageId <= MAX_ID):
+        raise ValueError()
+    try:
+        return EPOCH + timedelta(microseconds=int(microseconds)), messageId
+    except OverflowError:
+        raise ValueError()
+
+
+# Reads the since/limit query parameters, returning None if the client did
+# not ask for a page. Raises ValueError if either parameter is invalid.
+def readPageParameters(queryParams):
+    if not ('since' in queryParams or 'limit' in queryParams):
+        return None
+    since = decodeCursor(queryParams['since']) if queryParams.get('since') else None
+    limit = int(queryParams.get('limit', DEFAULT_PAGE_SIZE))
+    if not (0 < limit <= MAX_PAGE_SIZE):
+        raise ValueError()
+    return since, limit
+
+
+# Returns the messages after the since cursor in mailbox order, at most
+# limit of them, and whether more messages remain after the page
+def messagePage(messages, since, limit):
+    if since is not None:
+        created, messageId = since
+        messages = messages.filter(Q(created__gt=created) | Q(created=created, id__gt=messageId))
+    page = list(messages.order_by('created', 'id')[:limit + 1])
+    return page[:limit], len(page) > limit
@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from api.models import Device, SignedPreKey
+
+# Senders look recipients up by username on every message and bundle
+# request. Their device and signed prekey are cached here so repeat sends
+# to the same recipients skip the database. Entries are removed whenever the
+# device or its signed prekey changes.
+
+
+def cacheKey(username):
+    return 'recipient:%s' % username
+
+
+# Keys are copied to bytes as some databases return binary columns as
+# memoryview, which cannot be pickled into the cache
+def toCacheEntry(device):
+    signedPreKey = getattr(device, 'signedprekey', None)
+    return (
+        device.id, device.user_id, device.registrationId, bytes(device.identityKey), device.address,
+        (signedPreKey.id, signedPreKey.keyId, bytes(signedPreKey.publicKey), bytes(signedPreKey.signature))
+        if signedPreKey else None,
+    )
+
+
+def fromCacheEntry(entry):
+    deviceId, userId, registrationId, identityKey, address, signedPreKey = entry
+    device = Device(id=deviceId, user_id=userId, registrationId=registrationId, identityKey=identityKey, address=address)
+    if signedPreKey is not None:
+        signedPreKeyId, keyId, publicKey, signature = signedPreKey
+        device.signedprekey = SignedPreKey(id=signedPreKeyId, device=device, keyId=keyId, publicKey=publicKey, signature=signature)
+    return device
+
+
+# Returns {username: Device} for the usernames that have a registered
+# device, with each device's signed prekey attached. Users without a device
+# are left out.
+def getRecipientDevices(usernames):
+    keys = {cacheKey(x): x for x in usernames}
+    devices = {keys[key]: fromCacheEntry(entry) for key, entry in cache.get_many(keys).items()}
+    missing = [x for x in usernames if x not in devices]
+    if missing:
+        fetched = {
+            device.user.username: device
+            for device in Device.objects.filter(user__username__in=missing).select_related('user', 'signedprekey')
+        }
+        cache.set_many({cacheKey(username): toCacheEntry(device) for username, device in fetched.items()},
+                       settings.RECIPIENT_CACHE_TIMEOUT)
+        devices.update(fetched)
+    return devices
+
+
+def getRecipientDevice(username):
+    return getRecipientDevices([username]).get(username)
+
+
+# Removes the entry now, and again once the change is committed in case a
+# concurrent request cached the old row in between
+def invalidate(username):
+    cache.delete(cacheKey(username))
+    transaction.on_commit(lambda: cache.delete(cacheKey(username)))
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def invalidateDevice(sender, instance, **kwargs):
+    # Deleted devices were detached from their user, and invalidated, already
+    if instance.user_id is not None:
+        invalidate(instance.user.username)
+
+
+@receiver(post_save, sender=SignedPreKey)
+def invalidateSignedPreKey(sender, instance, **kwargs):
+    invalidate(instance.device.user.username)
@@ -0,0 +1,63 @@
+import codecs
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON rendering and parsing through orjson, which encodes and decodes
+# several times faster than the json module. The output is the same as
+# DRF's compact, unicode JSON. Without orjson installed, or for anything
+# orjson cannot handle, these fall back to DRF's json based classes.
+
+# Dates and times are passed to DRF's encoder so they are formatted as before
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+
+
+# JSON text as json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+# gives, for values of the basic JSON types
+def dumpJSON(value):
+    if orjson is None:
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+    return orjson.dumps(value).decode('utf-8')
+
+
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Pretty printing, for the browsable API, is left to DRF
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            # DRF's encoder handles types orjson does not, such as Decimal
+            # and lazy translation strings
+            rendered = orjson.dumps(data, default=JSONEncoder().default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escaped as DRF does so the output is valid javascript
+        if b'\xe2\x80\xa8' in rendered or b'\xe2\x80\xa9' in rendered:
+            rendered = rendered.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return rendered
+
+
+class FastJSONParser(JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        # orjson only reads UTF-8
+        if orjson is None or codecs.lookup(encoding).name != 'utf-8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % exc)
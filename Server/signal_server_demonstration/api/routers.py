@@ -0,0 +1,78 @@
+import asyncio
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+# Read/write routing. Writes always go to the primary database. Handlers
+# decorated with readsFromReplica send their reads to the replica named by
+# settings.REPLICA_DATABASE instead, unless the requesting device has
+# written through the API within the last REPLICA_STICKY_SECONDS, in which
+# case they stay on the primary so the device always sees its own writes.
+# Authentication and everything outside those handlers reads the primary.
+
+_readDatabase = ContextVar('readDatabase', default=None)
+
+
+def stickyKey(deviceId):
+    return 'replica-sticky:%d' % deviceId
+
+
+# Keeps the device's reads on the primary until its write has replicated.
+# Recorded in the default cache, which api.caches requires to be shared, as
+# the device's next request may reach another worker.
+def stickToPrimary(deviceId):
+    if settings.REPLICA_DATABASE:
+        cache.set(stickyKey(deviceId), True, settings.REPLICA_STICKY_SECONDS)
+
+
+# Returns the database the device's reads may go to, None for the primary
+def readDatabaseFor(device):
+    if not settings.REPLICA_DATABASE or cache.get(stickyKey(device.id)):
+        return None
+    return settings.REPLICA_DATABASE
+
+
+# Opts a handler of an OwnDeviceAPIView in to reading from the replica
+def readsFromReplica(handler):
+    if asyncio.iscoroutinefunction(handler):
+        @wraps(handler)
+        async def asyncWrapper(self, request, *args, **kwargs):
+            # Queries run through api.asgi.runInThread, which carries this over
+            token = _readDatabase.set(readDatabaseFor(self.device))
+            try:
+                return await handler(self, request, *args, **kwargs)
+            finally:
+                _readDatabase.reset(token)
+        return asyncWrapper
+
+    @wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        token = _readDatabase.set(readDatabaseFor(self.device))
+        try:
+            return handler(self, request, *args, **kwargs)
+        finally:
+            _readDatabase.reset(token)
+    return wrapper
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        return _readDatabase.get()
+
+    # Without this, saving an instance read from the replica would write to it
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    # Both databases hold the same rows
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    # The replica gets its schema by replicating the primary's
+    def allow_migrate(self, db, app_label, **hints):
+        if db == settings.REPLICA_DATABASE:
+            return False
+        return None
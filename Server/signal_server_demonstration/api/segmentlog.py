@@ -0,0 +1,356 @@
+import fcntl
+import os
+import shutil
+import struct
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from api.models import Device, Message
+from api.pagination import EPOCH
+
+# Keeps each device's mailbox as an append-only log on local disk, avoiding
+# the sorting and index maintenance of a relational table for what is a
+# write-once, read-once queue. A mailbox is a directory holding
+#
+#   lock        flock()ed around every operation, shared for reads
+#   sequence    the next sequence number, the segment being appended to and
+#               its committed length, so a write cut short by a crash is
+#               discarded
+#   *.seg       segments of records, named by their first sequence number.
+#               Sequence numbers are consecutive, so a segment holds those
+#               from its own up to the next segment's, and reads can skip
+#               straight to the segment a page starts in.
+#   acked       sequence numbers of removed records
+#   leases      (sequence number, leased until) pairs, the latest one wins
+#
+# Segments whose records have all been removed are deleted once every
+# segment before them has been, and once the whole mailbox is empty the
+# acked and leases files are cleared too. All worker processes must share
+# the directory on one host.
+
+# Message ids are sequence numbers within the recipient's mailbox, which the
+# URL names, so they stay far below 2^53 and JavaScript clients hold them
+# exactly. Ids of other mailboxes cannot be told apart from missing ones.
+MAX_SEQUENCE = (1 << 53) - 1
+
+# Sequence number, created in microseconds since the epoch, sender id,
+# sender registrationId, recipient registrationId, message type, flags,
+# sender address length and body length, then the address and body
+RECORD = struct.Struct('<QqIIIHBHI')
+COMPRESSED = 1
+
+SEQUENCE = struct.Struct('<QQQ')
+ACKED = struct.Struct('<Q')
+LEASE = struct.Struct('<Qq')
+
+
+def segmentName(firstSequence):
+    return '%016x.seg' % firstSequence
+
+
+def toMicroseconds(moment):
+    return (moment - EPOCH) // timedelta(microseconds=1)
+
+
+class CorruptMailbox(Exception):
+    pass
+
+
+class SegmentLogMailbox:
+
+    # Segments are closed once they reach this size
+    segmentBytes = 1 << 20
+    # Whether writes are flushed to disk before a request returns
+    fsync = True
+
+    def __init__(self, root=None):
+        self.root = root or settings.MAILBOX_DIR
+
+    def store(self, messages):
+        now = timezone.now()
+        byRecipient = {}
+        for message in messages:
+            message.created = now
+            byRecipient.setdefault(message.recipient.id, []).append(message)
+        for deviceId, received in byRecipient.items():
+            with self.locked(deviceId, create=True) as path:
+                nextSequence, segment, length = self.readSequence(path)
+                if segment is None or length >= self.segmentBytes:
+                    segment, length = segmentName(nextSequence), 0
+                records = []
+                for message in received:
+                    message.id = nextSequence
+                    records.append(self.packRecord(nextSequence, message))
+                    nextSequence += 1
+                data = b''.join(records)
+                with open(os.path.join(path, segment), 'ab') as segmentFile:
+                    # Drop anything written after the last committed record
+                    segmentFile.truncate(length)
+                    segmentFile.write(data)
+                    self.sync(segmentFile)
+                self.writeSequence(path, nextSequence, segment, length + len(data))
+        return messages
+
+    def fetch(self, device, since=None, limit=None):
+        now = toMicroseconds(timezone.now())
+        after = min(max(since[1], 0), MAX_SEQUENCE) if since is not None else 0
+        with self.locked(device.id, exclusive=False) as path:
+            if path is None:
+                return [], False
+            records = self.readVisible(path, self.readAcked(path), self.readLeases(path), now, limit, after)
+        if limit is None:
+            return [self.toMessage(device, x) for x in records], False
+        return [self.toMessage(device, x) for x in records[:limit]], len(records) > limit
+
+    def drain(self, device, limit, visibilityTimeout=None):
+        now = toMicroseconds(timezone.now())
+        with self.locked(device.id) as path:
+            if path is None:
+                return [], False
+            acked = self.readAcked(path)
+            leases = self.readLeases(path)
+            visible = self.readVisible(path, acked, leases, now, limit)
+            taken = visible[:limit]
+            sequences = [record[0] for record in taken]
+            if visibilityTimeout is None:
+                self.appendAcked(path, sequences)
+                acked.update(sequences)
+                self.compact(path, acked, leases)
+            else:
+                leasedUntil = now + visibilityTimeout * 1000000
+                self.appendLeases(path, [(x, leasedUntil) for x in sequences])
+        return [self.toMessage(device, record) for record in taken], len(visible) > limit
+
+    def acknowledge(self, device, ids):
+        requested = {x for x in ids if 0 < x <= MAX_SEQUENCE}
+        with self.locked(device.id) as path:
+            if path is None or not requested:
+                return set(), set()
+            acked = self.readAcked(path)
+            ranges = self.segmentRanges(path)
+            removed = {x for x in requested if any(first <= x < end for _, first, end in ranges)} - acked
+            self.appendAcked(path, removed)
+            acked.update(removed)
+            self.compact(path, acked, self.readLeases(path))
+        return removed, set()
+
+    def purgeExpired(self, cutoff, batchSize, pause=0):
+        cutoff = toMicroseconds(cutoff)
+        purged = 0
+        for name in self.mailboxes():
+            # Each mailbox is purged as one batch under its own lock
+            with self.locked(int(name)) as path:
+                if path is None:
+                    continue
+                acked = self.readAcked(path)
+                expired = [record[0] for record in self.readRecords(path, withBodies=False)
+                           if record[0] not in acked and record[1] < cutoff]
+                if not expired:
+                    continue
+                self.appendAcked(path, expired)
+                acked.update(expired)
+                self.compact(path, acked, self.readLeases(path))
+                purged += len(expired)
+            if pause:
+                time.sleep(pause)
+        return purged
+
+    # Removes the device's own mailbox. Messages it sent stay in their
+    # recipients' mailboxes, which hold a copy of the sender's details,
+    # until they are drained or expire.
+    def removeDevice(self, deviceId, batchSize, pause=0):
+        with self.locked(deviceId) as path:
+            if path is None:
+                return 0
+            acked = self.readAcked(path)
+            removed = sum(end - first - sum(1 for x in acked if first <= x < end)
+                          for _, first, end in self.segmentRanges(path))
+            shutil.rmtree(path)
+        return removed
+
+    def mailboxes(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [x for x in os.listdir(self.root) if x.isdigit()]
+
+    @contextmanager
+    def locked(self, deviceId, exclusive=True, create=False):
+        path = os.path.join(self.root, str(deviceId))
+        if create:
+            os.makedirs(path, exist_ok=True)
+        try:
+            lockFile = open(os.path.join(path, 'lock'), 'a')
+        except FileNotFoundError:
+            # No mailbox has been created for this device
+            yield None
+            return
+        with lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            # The mailbox may have been removed while waiting for the lock
+            yield path if os.path.isdir(path) else None
+
+    def sync(self, openFile):
+        if self.fsync:
+            openFile.flush()
+            os.fsync(openFile.fileno())
+
+    def segments(self, path):
+        return sorted(x for x in os.listdir(path) if x.endswith('.seg'))
+
+    # Returns the next sequence number, the segment being appended to, if
+    # any, and its committed length. Starting over from a damaged sequence
+    # file would reuse the ids of queued messages, so that is an error.
+    def readSequence(self, path):
+        try:
+            with open(os.path.join(path, 'sequence'), 'rb') as sequenceFile:
+                data = sequenceFile.read()
+        except FileNotFoundError:
+            return 1, None, 0
+        if len(data) != SEQUENCE.size:
+            raise CorruptMailbox('%s is %d bytes long, expected %d' % (
+                os.path.join(path, 'sequence'), len(data), SEQUENCE.size))
+        nextSequence, openSequence, length = SEQUENCE.unpack(data)
+        return nextSequence, segmentName(openSequence) if openSequence else None, length
+
+    # Replaced rather than overwritten, so a crash leaves the old or the new
+    # contents and never a mix of both
+    def writeSequence(self, path, nextSequence, segment, length):
+        openSequence = int(segment[:-len('.seg')], 16) if segment else 0
+        self.rewrite(path, 'sequence', SEQUENCE.pack(nextSequence, openSequence, length))
+
+    def packRecord(self, sequence, message):
+        address = message.sender.address.encode('utf-8')
+        body = bytes(message.body)
+        return RECORD.pack(
+            sequence, toMicroseconds(message.created), message.sender.id, message.sender.registrationId,
+            message.recipientRegistrationId, message.messageType, COMPRESSED if message.compressed else 0,
+            len(address), len(body),
+        ) + address + body
+
+    # Returns (segment, first, end) for every segment, in sequence order. A
+    # segment holds the sequence numbers from first up to but excluding end.
+    def segmentRanges(self, path):
+        nextSequence, _, _ = self.readSequence(path)
+        firsts = [(x, int(x[:-len('.seg')], 16)) for x in self.segments(path)]
+        ends = [first for _, first in firsts[1:]] + [nextSequence]
+        return [(segment, first, end) for (segment, first), end in zip(firsts, ends)]
+
+    # Yields every committed record after the given sequence number, in
+    # sequence order, skipping the segments that end before it. A record is
+    # the unpacked header followed by the address and body.
+    def readRecords(self, path, withBodies=True, after=0):
+        _, openSegment, committedLength = self.readSequence(path)
+        for segment, _, end in self.segmentRanges(path):
+            if end <= after + 1:
+                continue
+            with open(os.path.join(path, segment), 'rb') as segmentFile:
+                data = segmentFile.read(committedLength if segment == openSegment else -1)
+            offset = 0
+            while offset + RECORD.size <= len(data):
+                header = RECORD.unpack_from(data, offset)
+                start = offset + RECORD.size
+                offset = start + header[-2] + header[-1]
+                if header[0] <= after:
+                    continue
+                if withBodies:
+                    address = data[start:start + header[-2]].decode('utf-8')
+                    yield header + (address, data[start + header[-2]:offset])
+                else:
+                    yield header
+
+    # Returns the records after the given sequence number that are neither
+    # acked nor leased at now, reading no further than the limit + 1 needed
+    # to tell whether more remain
+    def readVisible(self, path, acked, leases, now, limit, after=0):
+        visible = []
+        for record in self.readRecords(path, after=after):
+            if record[0] in acked or leases.get(record[0], 0) > now:
+                continue
+            visible.append(record)
+            if limit is not None and len(visible) > limit:
+                break
+        return visible
+
+    def toMessage(self, device, record):
+        (sequence, created, senderId, senderRegistrationId, recipientRegistrationId,
+         messageType, flags, _, _, address, body) = record
+        return Message(
+            id=sequence,
+            created=EPOCH + timedelta(microseconds=created),
+            recipient=device,
+            sender=Device(id=senderId, registrationId=senderRegistrationId, address=address),
+            recipientRegistrationId=recipientRegistrationId,
+            messageType=messageType,
+            body=body,
+            compressed=bool(flags & COMPRESSED),
+        )
+
+    def readAcked(self, path):
+        try:
+            with open(os.path.join(path, 'acked'), 'rb') as ackedFile:
+                data = ackedFile.read()
+        except FileNotFoundError:
+            return set()
+        # A partly written entry at the end is ignored
+        return {x for (x,) in ACKED.iter_unpack(data[:len(data) - len(data) % ACKED.size])}
+
+    def appendAcked(self, path, sequences):
+        if sequences:
+            with open(os.path.join(path, 'acked'), 'ab') as ackedFile:
+                ackedFile.write(b''.join(ACKED.pack(x) for x in sequences))
+                self.sync(ackedFile)
+
+    def readLeases(self, path):
+        try:
+            with open(os.path.join(path, 'leases'), 'rb') as leasesFile:
+                data = leasesFile.read()
+        except FileNotFoundError:
+            return {}
+        return dict(LEASE.iter_unpack(data[:len(data) - len(data) % LEASE.size]))
+
+    def appendLeases(self, path, leases):
+        if leases:
+            with open(os.path.join(path, 'leases'), 'ab') as leasesFile:
+                leasesFile.write(b''.join(LEASE.pack(*x) for x in leases))
+                self.sync(leasesFile)
+
+    # Deletes the segments at the front of the log whose records have all
+    # been removed, and rewrites the acked and leases files without their
+    # sequence numbers. Segments are only deleted from the front, so the
+    # sequence numbers of those left stay consecutive.
+    def compact(self, path, acked, leases):
+        dead = []
+        for segment, first, end in self.segmentRanges(path):
+            if not all(x in acked for x in range(first, end)):
+                break
+            dead.append((segment, first, end))
+        if not dead:
+            return
+        removedSequences = {x for _, first, end in dead for x in range(first, end)}
+        nextSequence, openSegment, _ = self.readSequence(path)
+        for segment, _, _ in dead:
+            os.remove(os.path.join(path, segment))
+        # The next store starts a new segment
+        if openSegment in (segment for segment, _, _ in dead):
+            self.writeSequence(path, nextSequence, None, 0)
+        self.rewrite(path, 'acked', b''.join(ACKED.pack(x) for x in acked - removedSequences))
+        self.rewrite(path, 'leases', b''.join(
+            LEASE.pack(x, until) for x, until in leases.items() if x not in removedSequences))
+
+    def rewrite(self, path, name, data):
+        temporary = os.path.join(path, name + '.tmp')
+        with open(temporary, 'wb') as temporaryFile:
+            temporaryFile.write(data)
+            self.sync(temporaryFile)
+        os.replace(temporary, os.path.join(path, name))
+        # The rename itself is only durable once the directory is synced
+        if self.fsync:
+            directory = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
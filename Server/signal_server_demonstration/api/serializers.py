@@ -1,17 +1,97 @@
+import base64
+import binascii
+import zlib
+
+from django.conf import settings
 from rest_framework import serializers
-from api.models import Message, Device, PreKey, SignedPreKey
+from api.models import Message, Device, PreKey, SignedPreKey, KEY_LENGTH, SIGNATURE_LENGTH
+from api.mailboxes import getMailbox
+from api.notifications import notifyRecipients
+from api.encoders import encodeContent
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import F
+
+# Keys and signatures are stored as raw bytes and sent over the API as
+# base64 text. Rejects text that is not base64 for exactly length bytes.
+class Base64BytesField(serializers.Field):
+    default_error_messages = {
+        'invalid': 'Must be {length} bytes encoded as base64.',
+    }
+    def __init__(self, length, **kwargs):
+        self.length = length
+        super().__init__(**kwargs)
+    def to_internal_value(self, data):
+        try:
+            value = base64.b64decode(data, validate=True)
+        except (TypeError, binascii.Error):
+            self.fail('invalid', length=self.length)
+        if len(value) != self.length:
+            self.fail('invalid', length=self.length)
+        return value
+    def to_representation(self, value):
+        return base64.b64encode(value).decode('ascii')
+
+# Clients send and receive message content as a JSON string holding the
+# Signal message type, its ciphertext and the registrationId it was encrypted
+# for. The parsed object is split into the Message columns, the ciphertext
+# stored as bytes, and the JSON rebuilt when the message is fetched.
+class MessageContentField(serializers.Field):
+    default_error_messages = {
+        'invalid': 'Must be a Signal message with an integer type and registrationId and a binary string body.',
+        'max_length': 'Message body must be no more than {max_length} bytes.',
+    }
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
+    def to_internal_value(self, data):
+        if not isinstance(data, dict):
+            self.fail('invalid')
+        messageType = data.get('type')
+        body = data.get('body')
+        registrationId = data.get('registrationId')
+        if not (isinstance(messageType, int) and isinstance(body, str) and isinstance(registrationId, (int, str))):
+            self.fail('invalid')
+        # libsignal ciphertext is a string of byte values, one per character
+        try:
+            registrationId = int(registrationId)
+            body = body.encode('latin-1')
+        except ValueError:
+            self.fail('invalid')
+        if not (0 <= messageType <= 32767 and registrationId >= 0):
+            self.fail('invalid')
+        if len(body) > settings.MESSAGE_MAX_BODY_BYTES:
+            self.fail('max_length', max_length=settings.MESSAGE_MAX_BODY_BYTES)
+        compressed = False
+        threshold = settings.MESSAGE_COMPRESSION_THRESHOLD
+        if threshold is not None and len(body) > threshold:
+            packed = zlib.compress(body)
+            # Ciphertext often does not compress, keep whichever is smaller
+            if len(packed) < len(body):
+                body, compressed = packed, True
+        return {
+            'recipientRegistrationId': registrationId,
+            'messageType': messageType,
+            'body': body,
+            'compressed': compressed,
+        }
+    def to_representation(self, message):
+        return encodeContent(message.messageType, message.body, message.compressed, message.recipientRegistrationId)
 
 class MessageSerializer(serializers.Serializer):
     id = serializers.ReadOnlyField()
     senderAddress = serializers.SerializerMethodField('get_sender_address')
     senderRegistrationID = serializers.SerializerMethodField('get_sender_registration_id')
-    content = serializers.CharField(max_length=1000, min_length=0)
+    content = MessageContentField()
     recipientAddress = serializers.SerializerMethodField('get_recipient_address')
     def create(self, validated_data):
         senderDevice = self.context['senderDevice']
         recipientDevice = self.context['recipientDevice']
-        return Message.objects.create(recipient=recipientDevice, sender=senderDevice, **validated_data)
+        message = Message(recipient=recipientDevice, sender=senderDevice, **validated_data)
+        getMailbox().store([message])
+        # Wake any long-polling request waiting on the recipient's mailbox
+        notifyRecipients([recipientDevice.id])
+        return message
     def get_sender_address(self, obj):
         return obj.sender.address
     def get_recipient_address(self, obj):
@@ -19,30 +99,60 @@ class MessageSerializer(serializers.Serializer):
     def get_sender_registration_id(self, obj):
         return obj.sender.registrationId
 
+# Maximum number of prekeys stored for a device
+MAX_PREKEYS = 100
+
+# Adds count to the device's preKeyCount if the pool stays within
+# MAX_PREKEYS, otherwise raises PermissionDenied. The check and the increment
+# are a single UPDATE, which also locks the device row until the surrounding
+# transaction ends, so concurrent uploads cannot both pass the limit check.
+def reservePreKeys(device, count):
+    reserved = Device.objects.filter(pk=device.pk, preKeyCount__lte=MAX_PREKEYS - count).update(
+        preKeyCount=F('preKeyCount') + count)
+    if not reserved:
+        raise PermissionDenied()
+    # A device loaded without its counter reads the updated one when needed
+    if 'preKeyCount' not in device.get_deferred_fields():
+        device.preKeyCount += count
+
+class PreKeyListSerializer(serializers.ListSerializer):
+    def validate(self, attrs):
+        if len(attrs) > MAX_PREKEYS:
+            raise serializers.ValidationError('No more than %d prekeys can be stored' % MAX_PREKEYS)
+        # Prekey ids must be unique per device
+        if len({x['keyId'] for x in attrs}) != len(attrs):
+            raise serializers.ValidationError('Prekey keyIds must be unique')
+        return attrs
+    # Stores the whole batch with one insert. Must be called inside a
+    # transaction so the limit check and the insert happen together.
+    def create(self, validated_data):
+        device = self.context['device']
+        # Limit to max 100 prekeys
+        reservePreKeys(device, len(validated_data))
+        return PreKey.objects.bulk_create(PreKey(device=device, **x) for x in validated_data)
+
 class PreKeySerializer(serializers.Serializer):
     keyId = serializers.IntegerField(min_value=0, max_value= 999999)
-    publicKey = serializers.CharField(max_length=44, min_length=44)
+    publicKey = Base64BytesField(KEY_LENGTH)
+    class Meta:
+        list_serializer_class = PreKeyListSerializer
     def create(self, validated_data):
-        user = self.context['user']
-        registrationId = self.context['registrationId']
-        deviceReference = Device.objects.filter(user=user, registrationId=registrationId).get()
+        device = self.context['device']
         # Limit to max 100 prekeys
-        if deviceReference.prekey_set.count() > 99:
-            raise PermissionDenied()
-        return PreKey.objects.create(device=deviceReference, **validated_data)
+        with transaction.atomic():
+            reservePreKeys(device, 1)
+            return PreKey.objects.create(device=device, **validated_data)
 
 class SignedPreKeySerializer(serializers.Serializer):
     keyId = serializers.IntegerField(min_value=0, max_value=999999)
-    publicKey = serializers.CharField(max_length=44, min_length=44)
-    signature = serializers.CharField(max_length=88, min_length=88)
+    publicKey = Base64BytesField(KEY_LENGTH)
+    signature = Base64BytesField(SIGNATURE_LENGTH)
     def create(self, validated_data):
-        user = self.context['user']
-        registrationId = self.context['registrationId']
-        deviceReference = Device.objects.filter(user=user, registrationId=registrationId).get()
-        return SignedPreKey.objects.create(device=deviceReference, **validated_data)
+        device = self.context['device']
+        return SignedPreKey.objects.create(device=device, **validated_data)
 
 class DeviceSerializer(serializers.Serializer):
-    identityKey = serializers.CharField(max_length=44, min_length=44)
+    identityKey = Base64BytesField(KEY_LENGTH)
     address = serializers.CharField(max_length=100)
     registrationId = serializers.IntegerField(min_value=0, max_value=999999)
     preKeys = PreKeySerializer(many=True)
@@ -54,16 +164,16 @@ class DeviceSerializer(serializers.Serializer):
             raise PermissionDenied()
         signedPreKey = validated_data.pop('signedPreKey')
         preKeys = validated_data.pop('preKeys')
-        deviceReference = Device.objects.create(user=user, **validated_data)
-        SignedPreKey.objects.create(device=deviceReference, **signedPreKey)
-        for x in preKeys:
-            PreKey.objects.create(device=deviceReference, **x)
+        # Register the device and all its keys together or not at all
+        with transaction.atomic():
+            deviceReference = Device.objects.create(user=user, preKeyCount=len(preKeys), **validated_data)
+            SignedPreKey.objects.create(device=deviceReference, **signedPreKey)
+            PreKey.objects.bulk_create(PreKey(device=deviceReference, **x) for x in preKeys)
         return deviceReference
 
 class PreKeyBundleSerializer(serializers.Serializer):
     address = serializers.CharField(max_length=100, min_length=1)
-    identityKey = serializers.CharField(max_length=33, min_length=33)
+    identityKey = Base64BytesField(KEY_LENGTH)
     registrationId = serializers.IntegerField(min_value=0, max_value=999999)
     preKey = PreKeySerializer()
     signedPreKey = SignedPreKeySerializer()
-
@@ -1,3 +1,1519 @@
-from django.test import TestCase
+import asyncio
+import base64
+import contextvars
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_jwt.settings import api_settings
+import jwt
+
+jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
+jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
+
+from api import errors
+from api.serializers import DeviceSerializer, MessageSerializer, PreKeyBundleSerializer
+from api.encoders import MESSAGE_VALUES, encodeMessages, encodeBundle
+from api.renderers import FastJSONRenderer, FastJSONParser
+from api.instrumentation import getRequestMetrics, loadMetrics
+from api.authentication import invalidateTokens
+from api.caches import checkDeployedCache, checkSharedCache
+from api.recipients import getRecipientDevice, invalidate
+from api.asgi import ASGIHandler, getExecutor, runInThread
+from api.views import MessageList
+from api.routers import ReplicaRouter, stickToPrimary, stickyKey
+from api.throttling import CacheThrottleStore, LocalThrottleStore, WindowRateThrottle, getThrottleStore
+from api.notifications import LocalNotificationBus
+from api.mailboxes import DatabaseMailbox, getMailbox
+from api.pagination import decodeCursor, encodeCursor
+from api.segmentlog import CorruptMailbox, SegmentLogMailbox
+from api.models import Device, Message, PreKey, SignedPreKey
+
+# Keys are stored as 33 raw bytes and signatures as 64, and sent over the
+# API as base64
+KEY_BYTES = b'\x05' + bytes(range(32))
+SIGNATURE_BYTES = bytes(range(64))
+KEY = base64.b64encode(KEY_BYTES).decode()
+SIGNATURE = base64.b64encode(SIGNATURE_BYTES).decode()
+
+
+def createDevice(username, registrationId, preKeyCount=10):
+    user = User.objects.create_user(username=username, password='password')
+    device = Device.objects.create(user=user, identityKey=KEY_BYTES, registrationId=registrationId, address=username + '.1',
+                                   preKeyCount=preKeyCount)
+    SignedPreKey.objects.create(device=device, keyId=1, publicKey=KEY_BYTES, signature=SIGNATURE_BYTES)
+    PreKey.objects.bulk_create(PreKey(device=device, keyId=i, publicKey=KEY_BYTES) for i in range(1, preKeyCount + 1))
+    return device
+
+
+def envelope(recipient, registrationId, body='ciphertext'):
+    return {'recipient': recipient.user.username, 'message': json.dumps({'type': 1, 'body': body, 'registrationId': registrationId})}
+
+
+# A message as stored after a client sent envelope(recipient, ..., body)
+def storedMessage(recipient, sender, body):
+    return Message(recipient=recipient, sender=sender, recipientRegistrationId=recipient.registrationId,
+                   messageType=1, body=body.encode('latin-1'))
+
+
+# The ciphertext bodies of serialized messages
+def bodiesOf(messages):
+    return [json.loads(x['content'])['body'] for x in messages]
+
+
+def tokenFor(user):
+    return jwt_encode_handler(jwt_payload_handler(user))
+
+
+# Authenticates with a real JWT so query counts include authentication
+def clientFor(device):
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + tokenFor(device.user))
+    return client
+
+
+# CACHES with a default cache that separate worker processes could share,
+# kept in files removed after the test
+def sharedCaches(testCase):
+    location = tempfile.mkdtemp()
+    testCase.addCleanup(shutil.rmtree, location, True)
+    return {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}
+
+
+# Calls fn on another thread, which gets cache instances of its own, as
+# another worker process would
+def inOtherWorker(fn):
+    failures = []
+
+    def run():
+        try:
+            fn()
+        except Exception as exc:
+            failures.append(exc)
+        finally:
+            connection.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if failures:
+        raise failures[0]
+
+
+class MessagePostTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.sender = createDevice('sender', 1111)
+        self.alice = createDevice('alice', 2222)
+        self.bob = createDevice('bob', 3333)
+        self.client = clientFor(self.sender)
+        self.url = '/messages/%d/' % self.sender.registrationId
+
+    def test_single_message(self):
+        response = self.client.post(self.url, envelope(self.alice, 2222), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['recipientAddress'], 'alice.1')
+        self.assertEqual(self.alice.received_messages.count(), 1)
+
+    def test_single_message_identity_changed(self):
+        response = self.client.post(self.url, envelope(self.alice, 9999), format='json')
+        self.assertEqual(response.data['code'], 'recipient_identity_changed')
+
+    def test_content_is_stored_in_columns_and_rebuilt(self):
+        # libsignal ciphertext is a string of byte values
+        body = '\x00\x05\xff\xe9"\\ciphertext'
+        self.client.post(self.url, envelope(self.alice, 2222, body), format='json')
+        message = Message.objects.get()
+        self.assertEqual(message.recipientRegistrationId, 2222)
+        self.assertEqual(message.messageType, 1)
+        self.assertEqual(bytes(message.body), body.encode('latin-1'))
+        response = clientFor(self.alice).get('/messages/2222/')
+        # Rebuilt the way the client's JSON.stringify wrote it
+        self.assertEqual(response.data[0]['content'],
+                         json.dumps({'type': 1, 'body': body, 'registrationId': 2222}, separators=(',', ':'), ensure_ascii=False))
+
+    def test_body_must_be_binary_string(self):
+        response = self.client.post(self.url, envelope(self.alice, 2222, '\u20ac'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Message.objects.exists())
+
+    @override_settings(MESSAGE_MAX_BODY_BYTES=16)
+    def test_body_byte_limit(self):
+        response = self.client.post(self.url, envelope(self.alice, 2222, 'x' * 16), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(self.url, [envelope(self.alice, 2222, 'x' * 17)], format='json')
+        self.assertEqual(response.data[0]['code'], 'invalid_data')
+        self.assertEqual(Message.objects.count(), 1)
+
+    @override_settings(MESSAGE_COMPRESSION_THRESHOLD=64)
+    def test_large_bodies_are_compressed(self):
+        self.client.post(self.url, [envelope(self.alice, 2222, 'a' * 1000), envelope(self.alice, 2222, 'b' * 10)], format='json')
+        large, small = Message.objects.order_by('id')
+        self.assertTrue(large.compressed)
+        self.assertLess(len(large.body), 100)
+        self.assertFalse(small.compressed)
+        response = clientFor(self.alice).get('/messages/2222/')
+        self.assertEqual(bodiesOf(response.data), ['a' * 1000, 'b' * 10])
+
+    def test_batch_reports_each_envelope(self):
+        User.objects.create_user(username='nodevice', password='password')
+        envelopes = [
+            envelope(self.alice, 2222),
+            envelope(self.bob, 3333),
+            envelope(self.bob, 9999),
+            {'recipient': 'nobody', 'message': json.dumps({'registrationId': 1})},
+            {'recipient': 'nodevice', 'message': json.dumps({'registrationId': 1})},
+            {'recipient': 'alice', 'message': 'not json'},
+        ]
+        response = self.client.post(self.url, envelopes, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['recipientAddress'], 'alice.1')
+        self.assertEqual(response.data[1]['recipientAddress'], 'bob.1')
+        self.assertEqual(response.data[1]['senderAddress'], 'sender.1')
+        self.assertEqual([x.get('code') for x in response.data[2:]],
+                         ['recipient_identity_changed', 'no_recipient', 'no_device', 'incorrect_arguments'])
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_batch_query_count(self):
+        envelopes = [envelope(self.alice, 2222), envelope(self.bob, 3333)] * 10
+        # User and device, recipient devices, bulk insert
+        with self.assertNumQueries(3):
+            self.client.post(self.url, envelopes, format='json')
+        self.assertEqual(Message.objects.count(), 20)
+
+    def test_batch_returns_stored_ids(self):
+        envelopes = [envelope(self.alice, 2222, 'first'), envelope(self.bob, 3333, 'second'), envelope(self.alice, 2222, 'third')]
+        response = self.client.post(self.url, envelopes, format='json')
+        ids = [x['id'] for x in response.data]
+        self.assertNotIn(None, ids)
+        self.assertEqual([bytes(Message.objects.get(id=x).body) for x in ids], [b'first', b'second', b'third'])
+
+    def test_batch_returns_stored_ids_without_returning(self):
+        with mock.patch('api.models.supportsReturning', return_value=False):
+            response = self.client.post(self.url, [envelope(self.alice, 2222), envelope(self.bob, 3333)], format='json')
+        self.assertEqual(sorted(x['id'] for x in response.data), sorted(Message.objects.values_list('id', flat=True)))
+
+    def test_batch_size_limit(self):
+        response = self.client.post(self.url, [envelope(self.alice, 2222)] * 101, format='json')
+        self.assertEqual(response.data['code'], 'incorrect_arguments')
+
+
+class MessageGetTests(TestCase):
+
+    def setUp(self):
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222)
+        self.client = clientFor(self.recipient)
+        self.url = '/messages/%d/' % self.recipient.registrationId
+        Message.objects.bulk_create(
+            storedMessage(self.recipient, self.sender, str(i)) for i in range(25))
+        # Give some messages the same timestamp so paging has to fall back to the id
+        Message.objects.filter(body__in=[b'3', b'4', b'5']).update(created=Message.objects.get(body=b'3').created)
+
+    def test_unbounded_mode(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(bodiesOf(response.data), [str(i) for i in range(25)])
+        self.assertEqual(response.data[0]['senderAddress'], 'sender.1')
+        self.assertEqual(response.data[0]['senderRegistrationID'], 1111)
+        self.assertEqual(response.data[0]['recipientAddress'], 'recipient.1')
+
+    def test_pages_follow_cursor(self):
+        contents = []
+        since = ''
+        # Caches the token, so each page below reads the user and device from it
+        clientFor(self.recipient).get(self.url)
+        while True:
+            client = clientFor(self.recipient)
+            # The page itself, however large the mailbox
+            with self.assertNumQueries(1):
+                response = client.get(self.url, {'since': since, 'limit': 4})
+            contents += bodiesOf(response.data['messages'])
+            since = response.data['next']
+            if not response.data['hasMore']:
+                break
+        self.assertEqual(contents, [str(i) for i in range(25)])
+
+        # Polling from the last cursor returns nothing new until a message arrives
+        response = self.client.get(self.url, {'since': since})
+        self.assertEqual(response.data, {'messages': [], 'next': since, 'hasMore': False})
+        storedMessage(self.recipient, self.sender, 'new').save()
+        response = self.client.get(self.url, {'since': since})
+        self.assertEqual(bodiesOf(response.data['messages']), ['new'])
+
+    def test_invalid_page_parameters(self):
+        for params in [{'since': 'abc'}, {'limit': 0}, {'limit': 1001}, {'limit': 'x'},
+                       # Out of range times and ids
+                       {'since': '9' * 20 + '-1'}, {'since': '-' + '9' * 17 + '-1'}, {'since': '1-' + '9' * 30}]:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.data['code'], 'incorrect_arguments')
+
+
+class MessageDrainTests(TestCase):
+
+    def setUp(self):
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222)
+        self.client = clientFor(self.recipient)
+        self.url = '/messages/%d/drain/' % self.recipient.registrationId
+        Message.objects.bulk_create(
+            storedMessage(self.recipient, self.sender, str(i)) for i in range(5))
+
+    def test_drain_deletes_returned_messages(self):
+        response = self.client.post(self.url, {'limit': 3}, format='json')
+        self.assertEqual(bodiesOf(response.data['messages']), ['0', '1', '2'])
+        self.assertEqual(response.data['messages'][0]['senderAddress'], 'sender.1')
+        self.assertTrue(response.data['hasMore'])
+        response = self.client.post(self.url, {'limit': 3}, format='json')
+        self.assertEqual(bodiesOf(response.data['messages']), ['3', '4'])
+        self.assertFalse(response.data['hasMore'])
+        self.assertFalse(Message.objects.exists())
+
+    def test_leased_messages_reappear_until_acknowledged(self):
+        response = self.client.post(self.url, {'limit': 2, 'visibilityTimeout': 30}, format='json')
+        leased = [x['id'] for x in response.data['messages']]
+        response = self.client.post(self.url, {'limit': 10, 'visibilityTimeout': 30}, format='json')
+        self.assertEqual(bodiesOf(response.data['messages']), ['2', '3', '4'])
+
+        # Acknowledge one leased message and let the other lease expire
+        self.client.delete('/messages/%d/' % self.recipient.registrationId, [leased[0]], format='json')
+        Message.objects.filter(id=leased[1]).update(leasedUntil=timezone.now() - timedelta(seconds=1))
+        response = self.client.post(self.url, {'visibilityTimeout': 30}, format='json')
+        self.assertEqual([x['id'] for x in response.data['messages']], [leased[1]])
+
+    def test_drain_without_update_returning(self):
+        with mock.patch('api.models.supportsReturning', return_value=False):
+            messages, hasMore = Message.objects.drain(self.recipient, 4, visibilityTimeout=30)
+            self.assertEqual([bytes(x.body).decode() for x in messages], ['0', '1', '2', '3'])
+            self.assertTrue(hasMore)
+            messages, hasMore = Message.objects.drain(self.recipient, 4)
+            self.assertEqual([bytes(x.body).decode() for x in messages], ['4'])
+            self.assertFalse(hasMore)
+        self.assertEqual(Message.objects.count(), 4)
+
+    def test_invalid_arguments(self):
+        for data in [{'limit': 0}, {'limit': 'x'}, {'limit': True}, {'visibilityTimeout': 0}, {'visibilityTimeout': 3601},
+                     {'visibilityTimeout': True}, []]:
+            response = self.client.post(self.url, data, format='json')
+            self.assertEqual(response.data['code'], 'incorrect_arguments')
+
+
+class MessageDeleteTests(TestCase):
+
+    def setUp(self):
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222)
+        self.client = clientFor(self.recipient)
+        self.url = '/messages/%d/' % self.recipient.registrationId
+
+    def createMessages(self, recipient, count):
+        Message.objects.bulk_create(storedMessage(recipient, self.sender, '') for _ in range(count))
+        return list(recipient.received_messages.values_list('id', flat=True))
+
+    def test_reports_each_id(self):
+        own = self.createMessages(self.recipient, 2)
+        other = self.createMessages(self.sender, 1)
+        response = self.client.delete(self.url, [own[0], other[0], 999999, 'abc', own[1]], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [
+            'success',
+            errors.not_message_owner.data,
+            errors.non_existant_message.data,
+            errors.non_existant_message.data,
+            'success',
+        ])
+        self.assertFalse(self.recipient.received_messages.exists())
+        self.assertTrue(Message.objects.filter(id=other[0]).exists())
+
+    def test_only_integers_and_digit_strings_are_ids(self):
+        own = self.createMessages(self.recipient, 7)
+        malformed = [True, own[0] + 0.5, ' %d ' % own[6], '%d.0' % own[6], None, {'id': own[0]}]
+        response = self.client.delete(self.url, malformed + [str(own[1]), own[2]], format='json')
+        self.assertEqual(response.data, [errors.non_existant_message.data] * len(malformed) + ['success', 'success'])
+        self.assertEqual(Message.objects.filter(id__in=[own[0], own[6]]).count(), 2)
+
+    def test_query_count_is_independent_of_batch_size(self):
+        ids = self.createMessages(self.recipient, 500)
+        # User and device, ownership lookup, delete
+        with self.assertNumQueries(3):
+            response = self.client.delete(self.url, ids, format='json')
+        self.assertEqual(response.data, ['success'] * 500)
+
+
+class PreKeyUploadTests(TestCase):
+
+    def setUp(self):
+        self.device = createDevice('owner', 1111, preKeyCount=5)
+        self.client = clientFor(self.device)
+        self.url = '/prekeys/%d/' % self.device.registrationId
+
+    def preKeys(self, keyIds):
+        return [{'keyId': x, 'publicKey': KEY} for x in keyIds]
+
+    def test_stores_batch_in_fixed_queries(self):
+        # User and device, savepoint, counter update, insert, release
+        with self.assertNumQueries(5):
+            response = self.client.post(self.url, self.preKeys(range(6, 96)), format='json')
+        self.assertEqual(response.data['code'], 'prekeys_stored')
+        self.assertEqual(self.device.prekey_set.count(), 95)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.preKeyCount, 95)
+        self.assertEqual(response['X-PreKeys-Remaining'], '95')
+
+    def test_accepts_wrapped_list(self):
+        response = self.client.post(self.url, {'preKeys': self.preKeys([6, 7])}, format='json')
+        self.assertEqual(response.data['code'], 'prekeys_stored')
+        self.assertEqual(self.device.prekey_set.count(), 7)
+
+    def test_limit_rejects_whole_batch(self):
+        response = self.client.post(self.url, self.preKeys(range(6, 102)), format='json')
+        self.assertEqual(response.data['code'], 'reached_max_prekeys')
+        self.assertEqual(self.device.prekey_set.count(), 5)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.preKeyCount, 5)
+
+    def test_invalid_key_rejects_whole_batch(self):
+        preKeys = self.preKeys([6, 7]) + [{'keyId': 8, 'publicKey': 'short'}]
+        response = self.client.post(self.url, preKeys, format='json')
+        self.assertEqual(response.data['code'], 'invalid_data')
+        self.assertEqual(self.device.prekey_set.count(), 5)
+
+    def test_duplicate_key_id_is_rejected(self):
+        response = self.client.post(self.url, self.preKeys([6, 5]), format='json')
+        self.assertEqual(response.data['code'], 'duplicate_prekey')
+        self.assertEqual(self.device.prekey_set.count(), 5)
+        response = self.client.post(self.url, self.preKeys([6, 6]), format='json')
+        self.assertEqual(response.data['code'], 'invalid_data')
+
+
+class DeviceRegistrationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='newuser', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def registration(self, keyIds):
+        return {
+            'identityKey': KEY,
+            'address': 'newuser.1',
+            'registrationId': 4444,
+            'preKeys': [{'keyId': x, 'publicKey': KEY} for x in keyIds],
+            'signedPreKey': {'keyId': 1, 'publicKey': KEY, 'signature': SIGNATURE},
+        }
+
+    def test_registers_device(self):
+        response = self.client.post('/device/', self.registration(range(1, 11)), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Device.objects.get(user=self.user).prekey_set.count(), 10)
+        self.assertEqual(Device.objects.get(user=self.user).preKeyCount, 10)
+        self.assertEqual(response['X-PreKeys-Remaining'], '10')
+        self.assertFalse(response.has_header('X-PreKeys-Replenish'))
+
+    def test_keys_are_stored_as_bytes(self):
+        self.client.post('/device/', self.registration([1]), format='json')
+        device = Device.objects.get(user=self.user)
+        self.assertEqual(bytes(device.identityKey), KEY_BYTES)
+        self.assertEqual(bytes(device.prekey_set.get().publicKey), KEY_BYTES)
+        self.assertEqual(bytes(device.signedprekey.signature), SIGNATURE_BYTES)
+
+    def test_keys_must_decode_to_exact_length(self):
+        registration = self.registration([1])
+        # 44 characters of valid base64, but only 32 bytes
+        registration['identityKey'] = 'A' * 43 + '='
+        response = self.client.post('/device/', registration, format='json')
+        self.assertEqual(response.data['code'], 'invalid_data')
+        registration = self.registration([1])
+        registration['signedPreKey']['signature'] = '*' * 88
+        response = self.client.post('/device/', registration, format='json')
+        self.assertEqual(response.data['code'], 'invalid_data')
+        self.assertFalse(Device.objects.exists())
+
+    def test_registration_query_count(self):
+        # Own device, savepoint, device, signed prekey, prekeys, release
+        with self.assertNumQueries(6):
+            self.client.post('/device/', self.registration(range(1, 101)), format='json')
+
+    def test_failed_registration_leaves_no_rows(self):
+        with mock.patch.object(PreKey.objects, 'bulk_create', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                serializer = DeviceSerializer(data=self.registration([1]), context={'user': self.user})
+                serializer.is_valid()
+                serializer.save()
+        self.assertFalse(Device.objects.exists())
+        self.assertFalse(SignedPreKey.objects.exists())
+
+    def test_duplicate_key_ids_are_rejected(self):
+        response = self.client.post('/device/', self.registration([1, 2, 2]), format='json')
+        self.assertEqual(response.data['code'], 'invalid_data')
+        self.assertFalse(Device.objects.exists())
+
+
+class SignedPreKeyUploadTests(TestCase):
+
+    def setUp(self):
+        self.device = createDevice('owner', 1111)
+        self.client = clientFor(self.device)
+        self.url = '/signedprekey/%d/' % self.device.registrationId
+
+    def test_replaces_signed_prekey(self):
+        # User and device, savepoint, delete, insert, release
+        with self.assertNumQueries(5):
+            response = self.client.post(self.url, {'keyId': 2, 'publicKey': KEY, 'signature': SIGNATURE}, format='json')
+        self.assertEqual(response.data['code'], 'signed_prekey_stored')
+        self.assertEqual(SignedPreKey.objects.get(device=self.device).keyId, 2)
+
+
+class OwnDeviceCheckTests(TestCase):
+
+    def setUp(self):
+        self.device = createDevice('owner', 1111)
+
+    def test_device_changed(self):
+        for url in ['/messages/2222/', '/prekeybundle/owner/2222/']:
+            response = clientFor(self.device).get(url)
+            self.assertEqual(response.data['code'], 'device_changed')
+
+    def test_no_device(self):
+        self.device.delete()
+        response = clientFor(self.device).post('/prekeys/1111/', [{'keyId': 1, 'publicKey': KEY}], format='json')
+        self.assertEqual(response.data['code'], 'no_device')
+
+    def test_requires_authentication(self):
+        response = APIClient().get('/messages/1111/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class RecipientCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222)
+        self.client = clientFor(self.sender)
+        self.messagesUrl = '/messages/%d/' % self.sender.registrationId
+        self.bundleUrl = '/prekeybundle/recipient/%d/' % self.sender.registrationId
+
+    def test_repeat_sends_skip_recipient_lookup(self):
+        self.client.post(self.messagesUrl, envelope(self.recipient, 2222), format='json')
+        # The insert, with the user, device and recipient all cached
+        with self.assertNumQueries(1):
+            response = self.client.post(self.messagesUrl, envelope(self.recipient, 2222), format='json')
+        self.assertEqual(response.data['recipientAddress'], 'recipient.1')
+
+    def test_repeat_bundles_skip_recipient_lookup(self):
+        self.client.get(self.bundleUrl)
+        # Savepoint, prekey claim, counter update, release
+        with self.assertNumQueries(4):
+            response = self.client.get(self.bundleUrl)
+        self.assertEqual(response.data['signedPreKey']['keyId'], 1)
+
+    def test_replaced_device_is_not_served_stale(self):
+        self.client.post(self.messagesUrl, envelope(self.recipient, 2222), format='json')
+        self.recipient.delete()
+        replacement = Device.objects.create(user=self.recipient.user, identityKey=KEY_BYTES, registrationId=3333, address='recipient.1')
+        SignedPreKey.objects.create(device=replacement, keyId=1, publicKey=KEY_BYTES, signature=SIGNATURE_BYTES)
+        response = self.client.post(self.messagesUrl, envelope(self.recipient, 2222), format='json')
+        self.assertEqual(response.data['code'], 'recipient_identity_changed')
+        response = self.client.post(self.messagesUrl, envelope(self.recipient, 3333), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replacement.received_messages.count(), 1)
+
+    def test_rotated_signed_prekey_is_not_served_stale(self):
+        self.client.get(self.bundleUrl)
+        clientFor(self.recipient).post('/signedprekey/2222/', {'keyId': 2, 'publicKey': KEY, 'signature': SIGNATURE}, format='json')
+        response = self.client.get(self.bundleUrl)
+        self.assertEqual(response.data['signedPreKey']['keyId'], 2)
+
+    def test_invalidation_reaches_other_workers(self):
+        with override_settings(CACHES=sharedCaches(self)):
+            self.assertEqual(getRecipientDevice('recipient').registrationId, 2222)
+            # Changed without signals, and invalidated by another worker
+            Device.objects.filter(id=self.recipient.id).update(registrationId=3333)
+            inOtherWorker(lambda: invalidate('recipient'))
+            self.assertEqual(getRecipientDevice('recipient').registrationId, 3333)
+
+    @override_settings(WORKER_PROCESSES=2)
+    def test_several_workers_need_a_shared_cache(self):
+        self.assertEqual([x.id for x in checkSharedCache(None)], ['api.W001'])
+        self.assertEqual(checkDeployedCache(None), [])
+        with override_settings(CACHES=sharedCaches(self)):
+            self.assertEqual(checkSharedCache(None), [])
+
+    def test_deploy_check_warns_of_a_process_local_cache(self):
+        self.assertEqual(checkSharedCache(None), [])
+        self.assertEqual([x.id for x in checkDeployedCache(None)], ['api.W003'])
+        with override_settings(CACHES=sharedCaches(self)):
+            self.assertEqual(checkDeployedCache(None), [])
+
+
+class PreKeyBundleTests(TestCase):
+
+    def setUp(self):
+        # Throttle counters live in the cache, reset it so bundle requests are not rate limited
+        cache.clear()
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222, preKeyCount=2)
+        self.client = clientFor(self.sender)
+
+    def url(self, username):
+        return '/prekeybundle/%s/%d/' % (username, self.sender.registrationId)
+
+    def test_claims_one_prekey(self):
+        response = self.client.get(self.url('recipient'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['address'], 'recipient.1')
+        self.assertEqual(response.data['registrationId'], 2222)
+        self.assertEqual(response.data['identityKey'], KEY)
+        self.assertEqual(response.data['preKey'], {'keyId': 1, 'publicKey': KEY})
+        self.assertEqual(response.data['signedPreKey']['signature'], SIGNATURE)
+        self.assertEqual(list(self.recipient.prekey_set.values_list('keyId', flat=True)), [2])
+        self.recipient.refresh_from_db()
+        self.assertEqual(self.recipient.preKeyCount, 1)
+
+    def test_bundle_query_count(self):
+        # User and device, recipient device joined with signed prekey,
+        # savepoint, prekey claim, counter update, release
+        with self.assertNumQueries(6):
+            self.client.get(self.url('recipient'))
+
+    def test_claim_without_delete_returning(self):
+        with mock.patch('api.models.supportsReturning', return_value=False):
+            self.assertEqual(PreKey.objects.claim(self.recipient).keyId, 1)
+            self.assertEqual(PreKey.objects.claim(self.recipient).keyId, 2)
+            self.assertIsNone(PreKey.objects.claim(self.recipient))
+        self.recipient.refresh_from_db()
+        self.assertEqual(self.recipient.preKeyCount, 0)
+
+    def test_no_prekeys(self):
+        self.recipient.prekey_set.all().delete()
+        response = self.client.get(self.url('recipient'))
+        self.assertEqual(response.data['code'], 'no_prekeys')
+
+    def test_no_recipient(self):
+        response = self.client.get(self.url('nobody'))
+        self.assertEqual(response.data['code'], 'no_recipient')
+
+    def test_no_recipient_device(self):
+        User.objects.create_user(username='nodevice', password='password')
+        response = self.client.get(self.url('nodevice'))
+        self.assertEqual(response.data['code'], 'no_device')
+
+
+class MailboxCompactionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222)
+
+    def compact(self, *args):
+        out = StringIO()
+        call_command('compact_mailboxes', *args, stdout=out)
+        return out.getvalue()
+
+    def test_expired_messages_are_purged_in_batches(self):
+        Message.objects.bulk_create(storedMessage(self.recipient, self.sender, str(i)) for i in range(5))
+        Message.objects.filter(body__in=[b'0', b'1', b'2']).update(created=timezone.now() - timedelta(days=31))
+        report = self.compact('--batch-size', '2')
+        self.assertIn('Purged 3 expired messages', report)
+        self.assertEqual(sorted(bytes(x) for x in Message.objects.values_list('body', flat=True)), [b'3', b'4'])
+        self.assertIn('Purged 0 expired messages', self.compact('--ttl', '3600'))
+
+    def test_device_deletion_does_not_touch_mailbox(self):
+        Message.objects.bulk_create(storedMessage(self.recipient, self.sender, str(i)) for i in range(50))
+        client = clientFor(self.recipient)
+        # User and device, detach device
+        with self.assertNumQueries(2):
+            response = client.delete('/device/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Message.objects.count(), 50)
+
+        # The deleted device is no longer served and the user can register again
+        response = clientFor(self.sender).get('/prekeybundle/recipient/1111/')
+        self.assertEqual(response.data['code'], 'no_device')
+        response = client.get('/messages/2222/')
+        self.assertEqual(response.data['code'], 'no_device')
+        response = client.post('/device/', {
+            'identityKey': KEY, 'address': 'recipient.1', 'registrationId': 3333,
+            'preKeys': [{'keyId': 1, 'publicKey': KEY}],
+            'signedPreKey': {'keyId': 1, 'publicKey': KEY, 'signature': SIGNATURE},
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_deleted_devices_are_compacted(self):
+        Message.objects.bulk_create(storedMessage(self.recipient, self.sender, str(i)) for i in range(5))
+        Message.objects.bulk_create(storedMessage(self.sender, self.recipient, str(i)) for i in range(3))
+        clientFor(self.recipient).delete('/device/')
+        report = self.compact('--batch-size', '2')
+        self.assertIn('Removed 1 deleted devices with 8 messages and 10 prekeys', report)
+        self.assertEqual(list(Device.objects.all()), [self.sender])
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(PreKey.objects.count(), 10)
+        self.assertEqual(SignedPreKey.objects.count(), 1)
+
+
+class PreKeyPoolTests(TestCase):
+
+    def setUp(self):
+        self.full = createDevice('full', 1111, preKeyCount=50)
+        self.low = createDevice('low', 2222, preKeyCount=3)
+        self.empty = createDevice('empty', 3333, preKeyCount=0)
+
+    def test_owner_is_told_to_replenish(self):
+        response = clientFor(self.low).get('/messages/2222/')
+        self.assertEqual(response['X-PreKeys-Remaining'], '3')
+        self.assertEqual(response['X-PreKeys-Replenish'], 'true')
+        response = clientFor(self.full).get('/messages/1111/')
+        self.assertEqual(response['X-PreKeys-Remaining'], '50')
+        self.assertFalse(response.has_header('X-PreKeys-Replenish'))
+
+    def test_errors_carry_no_hint(self):
+        response = clientFor(self.low).post('/prekeys/2222/', [], format='json')
+        self.assertEqual(response.data['code'], 'incorrect_arguments')
+        self.assertFalse(response.has_header('X-PreKeys-Remaining'))
+
+    def test_stats_command_reads_counters_only(self):
+        out = StringIO()
+        # Device aggregate and the listed devices, never the PreKey table
+        with self.assertNumQueries(2):
+            call_command('prekey_pool_stats', '--list', '5', stdout=out)
+        report = out.getvalue()
+        self.assertIn('Devices: 3', report)
+        self.assertIn('Prekeys stored: 53', report)
+        self.assertIn('Empty pools: 1', report)
+        self.assertIn('Below low water mark of 10: 2', report)
+        self.assertIn('  empty empty.1 0\n  low low.1 3\n', report)
+
+
+class ConcurrentPreKeyClaimTests(TransactionTestCase):
+
+    def test_prekeys_are_never_handed_out_twice(self):
+        device = createDevice('popular', 3333, preKeyCount=20)
+        claimed = []
+        failures = []
+        start = threading.Barrier(8)
+
+        def claimMany():
+            try:
+                start.wait()
+                for _ in range(5):
+                    preKey = PreKey.objects.claim(device)
+                    if preKey is not None:
+                        claimed.append(preKey.keyId)
+            except Exception as e:
+                failures.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claimMany) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(sorted(claimed), list(range(1, 21)))
+        self.assertFalse(PreKey.objects.filter(device=device).exists())
+
+
+class ConcurrentMessageDrainTests(TransactionTestCase):
+
+    def test_messages_are_drained_once(self):
+        sender = createDevice('sender', 1111)
+        recipient = createDevice('recipient', 2222)
+        Message.objects.bulk_create(storedMessage(recipient, sender, str(i)) for i in range(40))
+        drained = []
+        failures = []
+        start = threading.Barrier(4)
+
+        def drainMany():
+            try:
+                start.wait()
+                for _ in range(10):
+                    messages, _ = Message.objects.drain(recipient, 2)
+                    drained.extend(bytes(x.body).decode() for x in messages)
+            except Exception as e:
+                failures.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=drainMany) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(sorted(drained, key=int), [str(i) for i in range(40)])
+
+
+class LongPollTests(TransactionTestCase):
+
+    def setUp(self):
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222)
+        self.url = '/messages/%d/' % self.recipient.registrationId
+
+    def pollInBackground(self, params):
+        result = {}
+
+        def poll():
+            try:
+                started = time.monotonic()
+                result['response'] = clientFor(self.recipient).get(self.url, params)
+                result['elapsed'] = time.monotonic() - started
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=poll)
+        thread.start()
+        return thread, result
+
+    # Recheck the mailbox rarely so only a notification can wake the request quickly
+    @mock.patch('api.views.LONG_POLL_RECHECK_INTERVAL', 30)
+    def test_new_message_wakes_waiting_request(self):
+        thread, result = self.pollInBackground({'wait': 10, 'since': ''})
+        time.sleep(0.2)
+        clientFor(self.sender).post('/messages/%d/' % self.sender.registrationId, envelope(self.recipient, 2222), format='json')
+        thread.join()
+        self.assertLess(result['elapsed'], 5)
+        self.assertEqual(len(result['response'].data['messages']), 1)
+
+    @mock.patch('api.views.LONG_POLL_RECHECK_INTERVAL', 30)
+    def test_batch_wakes_waiting_request(self):
+        thread, result = self.pollInBackground({'wait': 10})
+        time.sleep(0.2)
+        clientFor(self.sender).post('/messages/%d/' % self.sender.registrationId, [envelope(self.recipient, 2222)], format='json')
+        thread.join()
+        self.assertLess(result['elapsed'], 5)
+        self.assertEqual(len(result['response'].data), 1)
+
+    def test_wait_expires_with_empty_mailbox(self):
+        thread, result = self.pollInBackground({'wait': 0.3})
+        thread.join()
+        self.assertGreaterEqual(result['elapsed'], 0.3)
+        self.assertEqual(result['response'].data, [])
+
+    def test_wait_is_bounded(self):
+        response = clientFor(self.recipient).get(self.url, {'wait': 31})
+        self.assertEqual(response.data['code'], 'incorrect_arguments')
+
+
+# Serves requests through the ASGI handler, which runs them on its own
+# worker threads, so data must be committed for it to be seen
+@override_settings(ASGI_THREADS=2)
+class ASGIHandlerTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        getExecutor.cache_clear()
+        self.addCleanup(getExecutor.cache_clear)
+        self.addCleanup(lambda: getExecutor().shutdown())
+        self.handler = ASGIHandler()
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222)
+
+    # Returns (status, headers, body, elapsed seconds), with JSON bodies decoded
+    async def request(self, method, path, device=None, data=None, query='', headers=None):
+        headers = headers or [(b'host', b'testserver')]
+        headers.append((b'content-type', b'application/json'))
+        if device is not None:
+            headers.append((b'authorization', ('Bearer ' + tokenFor(device.user)).encode()))
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(), 'headers': headers}
+        messages = [{'type': 'http.request', 'body': json.dumps(data).encode() if data is not None else b''}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        started = time.monotonic()
+        await self.handler(scope, receive, send)
+        elapsed = time.monotonic() - started
+        headers = dict(sent[0]['headers'])
+        body = sent[1]['body']
+        if headers.get(b'Content-Type') == b'application/json':
+            body = json.loads(body.decode())
+        return sent[0]['status'], headers, body, elapsed
+
+    def test_send_and_fetch(self):
+        async def exchange():
+            sent = await self.request('POST', '/messages/1111/', self.sender, envelope(self.recipient, 2222))
+            fetched = await self.request('GET', '/messages/2222/', self.recipient)
+            return sent, fetched
+
+        sent, fetched = asyncio.run(exchange())
+        self.assertEqual(sent[0], 201)
+        self.assertEqual(fetched[0], 200)
+        self.assertEqual(bodiesOf(fetched[2]), ['ciphertext'])
+        self.assertEqual(fetched[1][b'X-PreKeys-Remaining'], b'10')
+        # Neither is a long poll, so both went through the middleware
+        self.assertIn(b'X-Frame-Options', sent[1])
+        self.assertIn(b'X-Frame-Options', fetched[1])
+
+    def test_only_long_polls_are_served_async(self):
+        def servesAsync(method, query):
+            return MessageList.servesAsync({'REQUEST_METHOD': method, 'QUERY_STRING': query})
+        self.assertTrue(servesAsync('GET', 'wait=5&since='))
+        self.assertFalse(servesAsync('GET', ''))
+        self.assertFalse(servesAsync('GET', 'wait=0'))
+        self.assertFalse(servesAsync('GET', 'wait=abc'))
+        self.assertFalse(servesAsync('GET', 'wait=3600'))
+        self.assertFalse(servesAsync('POST', 'wait=5'))
+
+    @mock.patch('api.views.LONG_POLL_RECHECK_INTERVAL', 30)
+    def test_new_message_wakes_waiting_request(self):
+        async def pollAndSend():
+            poll = asyncio.ensure_future(self.request('GET', '/messages/2222/', self.recipient, query='wait=10&since='))
+            await asyncio.sleep(0.2)
+            await self.request('POST', '/messages/1111/', self.sender, envelope(self.recipient, 2222))
+            return await poll
+
+        statusCode, _, data, elapsed = asyncio.run(pollAndSend())
+        self.assertEqual(statusCode, 200)
+        self.assertLess(elapsed, 5)
+        self.assertEqual(bodiesOf(data['messages']), ['ciphertext'])
+
+    # With two threads, ten waits of half a second would take 2.5s if each held one
+    def test_waiting_requests_hold_no_thread(self):
+        async def pollMany():
+            started = time.monotonic()
+            await asyncio.gather(*(self.request('GET', '/messages/2222/', self.recipient, query='wait=0.5')
+                                   for _ in range(10)))
+            return time.monotonic() - started
+
+        self.assertLess(asyncio.run(pollMany()), 2)
+
+    def test_bundle_claim(self):
+        async def claim():
+            return (
+                await self.request('GET', '/prekeybundle/recipient/1111/', self.sender),
+                await self.request('GET', '/prekeybundle/recipient/9999/', self.sender),
+                await self.request('GET', '/prekeybundle/recipient/1111/'),
+            )
+
+        claimed, deviceChanged, anonymous = asyncio.run(claim())
+        self.assertEqual(claimed[0], 200)
+        self.assertEqual(claimed[2]['preKey']['keyId'], 1)
+        self.assertEqual(deviceChanged[2]['code'], 'device_changed')
+        self.assertEqual(anonymous[0], status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(PreKey.objects.filter(device=self.recipient).count(), 9)
+        self.assertIn(b'X-Frame-Options', claimed[1])
+
+    def test_host_is_checked(self):
+        async def claim():
+            statusCode, _, _, _ = await self.request('GET', '/prekeybundle/recipient/1111/', self.sender,
+                                                     headers=[(b'host', b'example.com')])
+            return statusCode
+
+        self.assertEqual(asyncio.run(claim()), status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(PreKey.objects.filter(device=self.recipient).count(), 10)
+
+    def test_context_carries_over_to_worker_threads(self):
+        variable = contextvars.ContextVar('variable', default=None)
+
+        async def readInThread():
+            variable.set('routed')
+            return await runInThread(variable.get)
+
+        self.assertEqual(asyncio.run(readInThread()), 'routed')
+
+    # Views without an async handler run through the middleware as under WSGI
+    def test_other_views_run_as_usual(self):
+        statusCode, headers, data, _ = asyncio.run(
+            self.request('POST', '/signedprekey/1111/', self.sender, {'keyId': 2, 'publicKey': KEY, 'signature': SIGNATURE}))
+        self.assertEqual(data['code'], 'signed_prekey_stored')
+        self.assertIn(b'X-Frame-Options', headers)
+
+
+# The replica is a second test database that nothing replicates to, so the
+# messages a request returns show which database it read
+@override_settings(REPLICA_DATABASE='replica')
+class ReplicaRoutingTests(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222)
+        for instance in (self.sender.user, self.sender, self.recipient.user, self.recipient):
+            instance.save(using='replica', force_insert=True)
+        storedMessage(self.recipient, self.sender, 'primary').save()
+        storedMessage(self.recipient, self.sender, 'replica').save(using='replica')
+
+    def fetchBodies(self):
+        return bodiesOf(clientFor(self.recipient).get('/messages/2222/').data)
+
+    def test_mailbox_reads_from_replica(self):
+        self.assertEqual(self.fetchBodies(), ['replica'])
+
+    def test_device_reads_its_own_writes(self):
+        clientFor(self.recipient).delete('/messages/2222/', [999999], format='json')
+        self.assertEqual(self.fetchBodies(), ['primary'])
+        # Once the write has had time to replicate
+        cache.delete(stickyKey(self.recipient.id))
+        self.assertEqual(self.fetchBodies(), ['replica'])
+
+    def test_writes_go_to_primary(self):
+        response = clientFor(self.sender).post('/messages/1111/', envelope(self.recipient, 2222, 'sent'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(Message.objects.using('default').filter(body=b'sent').exists())
+        self.assertFalse(Message.objects.using('replica').filter(body=b'sent').exists())
+        # Only the sender now reads from the primary
+        self.assertEqual(self.fetchBodies(), ['replica'])
+
+    def test_instances_read_from_replica_are_saved_to_primary(self):
+        message = Message.objects.using('replica').get()
+        self.assertEqual(ReplicaRouter().db_for_write(Message, instance=message), 'default')
+
+    def test_replica_is_never_migrated(self):
+        self.assertFalse(ReplicaRouter().allow_migrate('replica', 'api'))
+        self.assertIsNone(ReplicaRouter().allow_migrate('default', 'api'))
+
+    @override_settings(REPLICA_DATABASE=None)
+    def test_reads_primary_without_replica(self):
+        self.assertEqual(self.fetchBodies(), ['primary'])
+
+    def test_stickiness_reaches_other_workers(self):
+        with override_settings(CACHES=sharedCaches(self)):
+            # The device's write was served by another worker
+            inOtherWorker(lambda: stickToPrimary(self.recipient.id))
+            self.assertEqual(self.fetchBodies(), ['primary'])
+
+    def test_replica_needs_a_shared_cache(self):
+        self.assertEqual([x.id for x in checkSharedCache(None)], ['api.W002'])
+        with override_settings(CACHES=sharedCaches(self)):
+            self.assertEqual(checkSharedCache(None), [])
+
+
+class LocalNotificationBusTests(TestCase):
+
+    def test_notifies_only_subscribers_of_device(self):
+        bus = LocalNotificationBus()
+        with bus.subscribe(1) as first, bus.subscribe(2) as second:
+            bus.notify([1])
+            self.assertTrue(first.is_set())
+            self.assertFalse(second.is_set())
+        self.assertEqual(bus._subscribers, {})
+
+    def test_wakes_async_subscribers_from_other_threads(self):
+        bus = LocalNotificationBus()
+
+        async def waitForNotification():
+            with bus.subscribeAsync(1) as arrived:
+                threading.Thread(target=bus.notify, args=([1],)).start()
+                await asyncio.wait_for(arrived.wait(), 5)
+
+        asyncio.run(waitForNotification())
+        self.assertEqual(bus._subscribers, {})
+
+
+# Behaviour every mailbox backend must provide, run once per backend below
+class MailboxBackendTests:
+
+    def setUp(self):
+        self.sender = createDevice('sender', 1111, preKeyCount=0)
+        self.recipient = createDevice('recipient', 2222, preKeyCount=0)
+        self.mailbox = self.createMailbox()
+
+    # Stores each body as its own message, so every one has an id
+    def store(self, *bodies, recipient=None):
+        return [self.mailbox.store([storedMessage(recipient or self.recipient, self.sender, x)])[0] for x in bodies]
+
+    # fetch may return values() rows, so messages are compared as encoded
+    def bodies(self, messages):
+        return bodiesOf(encodeMessages(messages))
+
+    def test_store_sets_id_and_created(self):
+        first, second = self.store('0', '1')
+        self.assertIsNotNone(first.id)
+        self.assertNotEqual(first.id, second.id)
+        self.assertLessEqual(first.created, second.created)
+
+    def test_store_sets_ids_of_a_batch(self):
+        messages = self.mailbox.store([storedMessage(self.recipient, self.sender, x) for x in ('0', '1', '2')])
+        self.assertNotIn(None, [x.id for x in messages])
+        self.assertEqual(len({x.id for x in messages}), 3)
+        acknowledged, _ = self.mailbox.acknowledge(self.recipient, {messages[1].id})
+        self.assertEqual(acknowledged, {messages[1].id})
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['0', '2'])
+
+    def test_fetch_returns_mailbox_in_order(self):
+        self.store('0', '1', '2')
+        self.store('other', recipient=self.sender)
+        self.mailbox.store([storedMessage(self.recipient, self.sender, x) for x in ('3', '4')])
+        messages, hasMore = self.mailbox.fetch(self.recipient)
+        self.assertEqual(self.bodies(messages), ['0', '1', '2', '3', '4'])
+        self.assertFalse(hasMore)
+        encoded = encodeMessages(messages)[0]
+        self.assertEqual(encoded['senderAddress'], 'sender.1')
+        self.assertEqual(encoded['senderRegistrationID'], 1111)
+        self.assertEqual(encoded['recipientAddress'], 'recipient.1')
+        self.assertEqual(json.loads(encoded['content']), {'type': 1, 'body': '0', 'registrationId': 2222})
+
+    def test_fetch_pages_after_cursor(self):
+        self.store('0', '1', '2', '3', '4')
+        page, hasMore = self.mailbox.fetch(self.recipient, None, 2)
+        self.assertEqual((self.bodies(page), hasMore), (['0', '1'], True))
+        page, hasMore = self.mailbox.fetch(self.recipient, decodeCursor(encodeCursor(page[-1])), 3)
+        self.assertEqual((self.bodies(page), hasMore), (['2', '3', '4'], False))
+        page, hasMore = self.mailbox.fetch(self.recipient, decodeCursor(encodeCursor(page[-1])), 3)
+        self.assertEqual((page, hasMore), ([], False))
+
+    def test_drain_removes_messages(self):
+        self.store('0', '1', '2', '3', '4')
+        messages, hasMore = self.mailbox.drain(self.recipient, 3)
+        self.assertEqual((self.bodies(messages), hasMore), (['0', '1', '2'], True))
+        messages, hasMore = self.mailbox.drain(self.recipient, 3)
+        self.assertEqual((self.bodies(messages), hasMore), (['3', '4'], False))
+        self.assertEqual(self.mailbox.fetch(self.recipient), ([], False))
+
+    def test_leased_messages_reappear_until_acknowledged(self):
+        self.store('0', '1', '2')
+        leased, _ = self.mailbox.drain(self.recipient, 2, visibilityTimeout=30)
+        messages, hasMore = self.mailbox.drain(self.recipient, 10, visibilityTimeout=30)
+        self.assertEqual((self.bodies(messages), hasMore), (['2'], False))
+        self.mailbox.acknowledge(self.recipient, {leased[0].id})
+        later = timezone.now() + timedelta(seconds=31)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            messages, _ = self.mailbox.drain(self.recipient, 10)
+        self.assertEqual(self.bodies(messages), ['1', '2'])
+
+    def test_fetch_leaves_out_leased_messages(self):
+        self.store('0', '1', '2')
+        self.mailbox.drain(self.recipient, 2, visibilityTimeout=30)
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['2'])
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient, None, 10)[0]), ['2'])
+        later = timezone.now() + timedelta(seconds=31)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['0', '1', '2'])
+
+    def test_acknowledge_removes_own_messages(self):
+        own = self.store('0', '1')
+        self.store('2', recipient=self.sender)
+        acknowledged, _ = self.mailbox.acknowledge(self.recipient, {own[0].id, 999999})
+        self.assertEqual(acknowledged, {own[0].id})
+        self.assertEqual(self.mailbox.acknowledge(self.recipient, {own[0].id}), (set(), set()))
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['1'])
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.sender)[0]), ['2'])
+
+    def test_purge_expired(self):
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() - timedelta(days=2)):
+            self.store('0', '1')
+            self.store('2', recipient=self.sender)
+        self.store('3')
+        self.assertEqual(self.mailbox.purgeExpired(timezone.now() - timedelta(days=1), 1), 3)
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['3'])
+        self.assertEqual(self.mailbox.fetch(self.sender), ([], False))
+
+    def test_remove_device(self):
+        self.store('0', '1', '2')
+        self.assertEqual(self.mailbox.removeDevice(self.recipient.id, 2), 3)
+        self.assertEqual(self.mailbox.fetch(self.recipient), ([], False))
+        self.assertEqual(self.mailbox.removeDevice(self.recipient.id, 2), 0)
+
+
+class DatabaseMailboxTests(MailboxBackendTests, TestCase):
+
+    def createMailbox(self):
+        return DatabaseMailbox()
+
+    def test_fetch_returns_rows_to_encode(self):
+        self.store('0')
+        messages, _ = self.mailbox.fetch(self.recipient, None, 10)
+        self.assertEqual(set(messages[0]), set(MESSAGE_VALUES))
+
+    def test_acknowledge_reports_foreign_ids(self):
+        own = self.store('0')
+        other = self.store('1', recipient=self.sender)
+        acknowledged, foreign = self.mailbox.acknowledge(self.recipient, {own[0].id, other[0].id, 999999})
+        self.assertEqual((acknowledged, foreign), ({own[0].id}, {other[0].id}))
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.sender)[0]), ['1'])
+
+
+class SegmentLogMailboxTests(MailboxBackendTests, TestCase):
+
+    def createMailbox(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        return SegmentLogMailbox(self.root)
+
+    def files(self):
+        return sorted(os.listdir(os.path.join(self.root, str(self.recipient.id))))
+
+    def test_drained_segments_are_deleted(self):
+        self.mailbox.segmentBytes = 1
+        self.store('0', '1', '2')
+        self.assertEqual(len([x for x in self.files() if x.endswith('.seg')]), 3)
+        self.mailbox.drain(self.recipient, 2)
+        self.assertEqual(len([x for x in self.files() if x.endswith('.seg')]), 1)
+        self.mailbox.drain(self.recipient, 2)
+        self.assertFalse([x for x in self.files() if x.endswith('.seg')])
+        # Sequence numbers carry on, so old ids are never reused
+        self.assertEqual(self.store('3')[0].id, 4)
+
+    def test_ids_are_numbered_per_mailbox(self):
+        # Far past the device ids that would push device and sequence
+        # packed together beyond what JavaScript holds exactly
+        recipient = Device(id=1 << 40, registrationId=3333, address='large.1')
+        first, = self.store('0', recipient=recipient)
+        self.assertEqual(first.id, self.store('1')[0].id)
+        self.assertLess(first.id, 1 << 53)
+        self.assertEqual(self.mailbox.acknowledge(recipient, {first.id}), ({first.id}, set()))
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['1'])
+
+    def test_damaged_sequence_file_is_an_error(self):
+        self.store('0')
+        with open(os.path.join(self.root, str(self.recipient.id), 'sequence'), 'r+b') as sequenceFile:
+            sequenceFile.truncate(5)
+        # Rather than starting over and reusing the queued message's id
+        with self.assertRaises(CorruptMailbox):
+            self.store('1')
+        with self.assertRaises(CorruptMailbox):
+            self.mailbox.fetch(self.recipient)
+
+    def test_pages_read_only_from_the_cursor(self):
+        self.mailbox.segmentBytes = 1
+        self.store(*(str(i) for i in range(10)))
+        opened = []
+        realOpen = open
+
+        def recordingOpen(name, *args, **kwargs):
+            if name.endswith('.seg'):
+                opened.append(os.path.basename(name))
+            return realOpen(name, *args, **kwargs)
+        page, _ = self.mailbox.fetch(self.recipient, None, 3)
+        with mock.patch('builtins.open', recordingOpen):
+            page, hasMore = self.mailbox.fetch(self.recipient, decodeCursor(encodeCursor(page[-1])), 3)
+        self.assertEqual((self.bodies(page), hasMore), (['3', '4', '5'], True))
+        # The three records of the page, and one more to tell there are more
+        self.assertEqual(opened, ['%016x.seg' % x for x in (4, 5, 6, 7)])
+
+    def test_acknowledge_across_segments(self):
+        self.mailbox.segmentBytes = 1
+        messages = self.store('0', '1', '2')
+        acknowledged, _ = self.mailbox.acknowledge(self.recipient, {messages[1].id, messages[2].id + 1})
+        self.assertEqual(acknowledged, {messages[1].id})
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['0', '2'])
+        # Emptied segments go once the ones before them have
+        self.assertEqual(len([x for x in self.files() if x.endswith('.seg')]), 3)
+        self.mailbox.acknowledge(self.recipient, {messages[0].id})
+        self.assertEqual(len([x for x in self.files() if x.endswith('.seg')]), 1)
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['2'])
+        self.assertEqual(self.mailbox.removeDevice(self.recipient.id, 10), 1)
+
+    def test_uncommitted_write_is_discarded(self):
+        self.store('0')
+        segment = [x for x in self.files() if x.endswith('.seg')][0]
+        # A crash part way through appending a record
+        with open(os.path.join(self.root, str(self.recipient.id), segment), 'ab') as segmentFile:
+            segmentFile.write(b'\x01\x02\x03')
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['0'])
+        self.store('1')
+        self.assertEqual(self.bodies(self.mailbox.fetch(self.recipient)[0]), ['0', '1'])
+
+    def test_api_round_trip(self):
+        getMailbox.cache_clear()
+        self.addCleanup(getMailbox.cache_clear)
+        cache.clear()
+        with self.settings(MAILBOX_BACKEND='api.segmentlog.SegmentLogMailbox', MAILBOX_DIR=self.root):
+            response = clientFor(self.sender).post('/messages/1111/', envelope(self.recipient, 2222, 'hello'), format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            client = clientFor(self.recipient)
+            response = client.get('/messages/2222/')
+            self.assertEqual(bodiesOf(response.data), ['hello'])
+            self.assertEqual(response.data[0]['senderAddress'], 'sender.1')
+            response = client.delete('/messages/2222/', [response.data[0]['id']], format='json')
+            self.assertEqual(response.data, ['success'])
+            self.assertEqual(client.get('/messages/2222/').data, [])
+        self.assertFalse(Message.objects.exists())
+
+
+class DatabaseConfigurationTests(TestCase):
+
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def test_sqlite_connections_use_busy_timeout(self):
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        # WAL is only used with SQLITE_WAL set
+        self.assertEqual(self.pragma('journal_mode'), 'wal' if os.environ.get('SQLITE_WAL') else 'delete')
+
+    def test_pragmas_come_from_settings(self):
+        # A new connection, outside the test's transaction
+        newConnection = connection.copy()
+        self.addCleanup(newConnection.close)
+        with self.settings(SQLITE_PRAGMAS={'busy_timeout': 250, 'synchronous': 'normal'}):
+            newConnection.connect()
+        with newConnection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 250)
+            # 1 is NORMAL
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class FastJSONTests(TestCase):
+
+    def test_renders_as_drf_does(self):
+        data = {
+            'messages': [{'id': 1, 'content': ''.join(map(chr, range(256))) + '\u2028\u2029\U0001f600'}],
+            'created': timezone.now(),
+            'amount': Decimal('1.50'),
+            7: None,
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(data, 'application/json; indent=4'),
+                         JSONRenderer().render(data, 'application/json; indent=4'))
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+    def test_parses_json(self):
+        self.assertEqual(FastJSONParser().parse(BytesIO('{"a": ["\u00e9", 1.5, null]}'.encode())), {'a': ['\xe9', 1.5, None]})
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(BytesIO(b'{"a": NaN}'))
+
+    def test_malformed_request_body(self):
+        sender = createDevice('sender', 1111)
+        response = clientFor(sender).post('/messages/1111/', '{"recipient": ', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class EncoderTests(TestCase):
+
+    def setUp(self):
+        self.sender = createDevice('sender', 1111, preKeyCount=1)
+        self.recipient = createDevice('recipient', 2222, preKeyCount=1)
+
+    def test_messages_encode_as_serializer(self):
+        messages = [storedMessage(self.recipient, self.sender, x) for x in ('', 'hello', '\x00\xff\u00e9')]
+        messages.append(Message(recipient=self.recipient, sender=self.sender, recipientRegistrationId=2222,
+                                messageType=3, body=zlib.compress(b'x' * 100), compressed=True))
+        for message in messages:
+            DatabaseMailbox().store([message])
+        expected = MessageSerializer(messages, many=True).data
+        self.assertEqual(encodeMessages(messages), expected)
+        # Rows from values() encode the same without model instances
+        rows = Message.objects.filter(recipient=self.recipient).order_by('id').values(*MESSAGE_VALUES)
+        self.assertEqual(encodeMessages(rows), expected)
+        # Rendered byte for byte the same
+        self.assertEqual(JSONRenderer().render(encodeMessages(rows)), JSONRenderer().render(expected))
+
+    def test_bundle_encodes_as_serializer(self):
+        preKey = self.recipient.prekey_set.get()
+        bundle = {
+            'address': self.recipient.address, 'identityKey': self.recipient.identityKey,
+            'registrationId': self.recipient.registrationId, 'preKey': preKey, 'signedPreKey': self.recipient.signedprekey,
+        }
+        expected = PreKeyBundleSerializer(bundle).data
+        self.assertEqual(encodeBundle(self.recipient, preKey), expected)
+        self.assertEqual(JSONRenderer().render(encodeBundle(self.recipient, preKey)), JSONRenderer().render(expected))
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.device = createDevice('owner', 1111)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        getRequestMetrics.cache_clear()
+        self.addCleanup(getRequestMetrics.cache_clear)
+
+    def test_disabled_by_default(self):
+        response = clientFor(self.device).get('/messages/1111/')
+        self.assertNotIn('Server-Timing', response)
+
+    def test_reports_and_aggregates_metrics(self):
+        with self.settings(REQUEST_METRICS=True, REQUEST_METRICS_DIR=self.directory):
+            client = clientFor(self.device)
+            client.get('/messages/1111/')
+            response = client.get('/messages/1111/')
+            getRequestMetrics().flush()
+        # The mailbox read, the second request authenticated from the token cache
+        self.assertRegex(response['Server-Timing'],
+                         r'^db;dur=[0-9.]+;desc="1 queries", render;dur=[0-9.]+, total;dur=[0-9.]+$')
+        stats = loadMetrics(self.directory)['GET MessageList']
+        self.assertEqual((stats['count'], stats['queries'], stats['maxQueries']), (2, 3, 2))
+        self.assertEqual(sum(stats['latency']), 2)
+
+        output = StringIO()
+        with self.settings(REQUEST_METRICS_DIR=self.directory):
+            call_command('request_metrics', '--reset', stdout=output)
+        self.assertIn('GET MessageList', output.getvalue())
+        self.assertFalse(os.path.exists(self.directory))
+
+
+# Counter behaviour both throttle stores must provide
+class ThrottleStoreTests:
+
+    def test_counts_until_expiry(self):
+        self.assertEqual([self.store.incr('a', 60) for _ in range(3)], [1, 2, 3])
+        self.assertEqual(self.store.incr('b', 60), 1)
+
+    def test_concurrent_increments_are_not_lost(self):
+        def increment():
+            for _ in range(200):
+                self.store.incr('shared', 60)
+        threads = [threading.Thread(target=increment) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.store.incr('shared', 60), 1001)
+
+
+class CacheThrottleStoreTests(ThrottleStoreTests, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.store = CacheThrottleStore()
+
+
+class LocalThrottleStoreTests(ThrottleStoreTests, TestCase):
+
+    def setUp(self):
+        self.store = LocalThrottleStore()
+
+    def test_counter_restarts_after_timeout(self):
+        self.store.incr('a', 60)
+        later = time.monotonic() + 61
+        with mock.patch('time.monotonic', return_value=later):
+            self.assertEqual(self.store.incr('a', 60), 1)
+
+
+@override_settings(THROTTLE_STORE='api.throttling.LocalThrottleStore')
+class WindowRateThrottleTests(TestCase):
+
+    def setUp(self):
+        getThrottleStore.cache_clear()
+        self.addCleanup(getThrottleStore.cache_clear)
+        self.sender = createDevice('sender', 1111)
+        self.recipient = createDevice('recipient', 2222)
+        self.client = clientFor(self.sender)
+
+    # Sets the throttles' clock
+    def clock(self, now):
+        return mock.patch.object(WindowRateThrottle, 'timer', staticmethod(lambda: now))
+
+    def test_bundle_requests_limited_per_day(self):
+        url = '/prekeybundle/recipient/1111/'
+        now = time.time()
+        with self.clock(now):
+            statuses = [self.client.get(url).status_code for _ in range(4)]
+        self.assertEqual(statuses, [200, 200, 200, 429])
+        # The limit applies per window, a new day starts a new count
+        with self.clock(now + 86400):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_throttled_response_says_when_to_retry(self):
+        url = '/prekeybundle/recipient/1111/'
+        dayStart = time.time() // 86400 * 86400
+        with self.clock(dayStart + 3600):
+            for _ in range(3):
+                self.client.get(url)
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], str(86400 - 3600))
+
+
+class TokenCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.device = createDevice('owner', 1111)
+        self.client = clientFor(self.device)
+
+    def test_repeat_requests_skip_verification_and_user_query(self):
+        self.client.get('/messages/1111/')
+        with mock.patch('rest_framework_jwt.authentication.jwt_decode_handler') as decode, \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/messages/1111/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        decode.assert_not_called()
+        self.assertFalse([x for x in queries if 'auth_user' in x['sql']])
+        # The prekey hint reads the counter from the cache too
+        self.assertFalse([x for x in queries if 'preKeyCount' in x['sql']])
+        self.assertEqual(response['X-PreKeys-Remaining'], '10')
+
+    def test_cached_device_still_checked(self):
+        self.client.get('/messages/1111/')
+        self.assertEqual(self.client.get('/messages/2222/').data, errors.device_changed.data)
+
+    def test_uploads_report_new_prekey_count(self):
+        self.client.get('/messages/1111/')
+        response = self.client.post('/prekeys/1111/', [{'keyId': 100, 'publicKey': KEY}], format='json')
+        self.assertEqual(response.data['code'], 'prekeys_stored')
+        self.assertEqual(response['X-PreKeys-Remaining'], '11')
+        self.assertEqual(self.client.get('/messages/1111/')['X-PreKeys-Remaining'], '11')
+
+    def test_claims_report_new_prekey_count(self):
+        self.client.get('/messages/1111/')
+        other = createDevice('other', 2222)
+        response = clientFor(other).get('/prekeybundle/owner/2222/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/messages/1111/')['X-PreKeys-Remaining'], '9')
+
+    def test_deleted_device_is_not_served(self):
+        self.client.get('/messages/1111/')
+        self.client.delete('/device/')
+        # Deleting commits in a real request, which invalidates again
+        invalidateTokens('owner')
+        self.assertEqual(self.client.get('/messages/1111/').data, errors.no_device.data)
+
+    def test_reregistered_device_is_served(self):
+        self.client.get('/messages/1111/')
+        Device.objects.filter(pk=self.device.pk).update(user=None)
+        invalidateTokens('owner')
+        Device.objects.create(user=self.device.user, identityKey=KEY_BYTES, registrationId=3333, address='owner.2')
+        self.assertEqual(self.client.get('/messages/1111/').data, errors.device_changed.data)
+        self.assertEqual(self.client.get('/messages/3333/').status_code, status.HTTP_200_OK)
+
+    def test_invalidation_reaches_other_workers(self):
+        with override_settings(CACHES=sharedCaches(self)):
+            self.client.get('/messages/1111/')
+            # Deleted without signals, so only the cached token still names the device
+            Device.objects.filter(pk=self.device.pk).update(user=None)
+            self.assertEqual(self.client.get('/messages/1111/').status_code, status.HTTP_200_OK)
+            inOtherWorker(lambda: invalidateTokens('owner'))
+            self.assertEqual(self.client.get('/messages/1111/').data, errors.no_device.data)
+
+    def test_disabled_user_is_rejected(self):
+        self.client.get('/messages/1111/')
+        self.device.user.is_active = False
+        self.device.user.save()
+        response = self.client.get('/messages/1111/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_expired_token_is_rejected(self):
+        self.client.get('/messages/1111/')
+        later = time.time() + api_settings.JWT_EXPIRATION_DELTA.total_seconds() + 1
+        # The cached entry expires with the token, which is then checked again
+        with mock.patch('time.time', return_value=later), \
+                mock.patch('rest_framework_jwt.authentication.jwt_decode_handler', side_effect=jwt.ExpiredSignature):
+            response = self.client.get('/messages/1111/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
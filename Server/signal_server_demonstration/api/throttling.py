@@ -0,0 +1,101 @@
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework import throttling
+
+# DRF's throttles keep a list of request timestamps per client in the cache
+# and rewrite the whole list on every check, so the cost grows with the
+# rate limit. These throttles count requests in fixed windows instead: each
+# check is one atomic increment of a counter named after the client and the
+# current window, in the store named by settings.THROTTLE_STORE. With a
+# store shared by every worker, such as memcached or Redis behind the cache
+# named by THROTTLE_CACHE, limits hold across workers rather than per
+# process.
+#
+# A fixed window can let through up to twice the rate around a window
+# boundary, which is fine for abuse limits like these.
+
+
+# Counts in a Django cache. incr is atomic on memcached and Redis, and
+# within one process on the local memory cache. A check is one round trip,
+# plus an add the first time a key is used in a window.
+class CacheThrottleStore:
+
+    def __init__(self, alias=None):
+        self.cache = caches[alias or settings.THROTTLE_CACHE]
+
+    # Adds one to the counter, creating it to expire after timeout seconds
+    # if needed, and returns the new count
+    def incr(self, key, timeout):
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            if self.cache.add(key, 1, timeout):
+                return 1
+            # Another request created the counter first
+            return self.cache.incr(key)
+
+
+# Counts in this process's memory. A stand-in for a shared store in tests
+# and single process deployments.
+class LocalThrottleStore:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def incr(self, key, timeout):
+        now = time.monotonic()
+        with self._lock:
+            count, expires = self._counters.get(key, (0, now + timeout))
+            if expires <= now:
+                count, expires = 0, now + timeout
+            self._counters[key] = (count + 1, expires)
+            # Drop expired counters once in a while so memory stays bounded
+            if len(self._counters) > 10000:
+                self._counters = {k: v for k, v in self._counters.items() if v[1] > now}
+            return count + 1
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+
+
+@lru_cache(maxsize=None)
+def getThrottleStore():
+    return import_string(settings.THROTTLE_STORE)()
+
+
+class WindowRateThrottle(throttling.SimpleRateThrottle):
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        window = int(self.timer() // self.duration)
+        self.windowEnds = (window + 1) * self.duration
+        count = getThrottleStore().incr('%s:%d' % (self.key, window), self.duration)
+        return count <= self.num_requests
+
+    def wait(self):
+        return max(self.windowEnds - self.timer(), 0)
+
+
+class AnonRateThrottle(throttling.AnonRateThrottle, WindowRateThrottle):
+    pass
+
+
+class UserRateThrottle(throttling.UserRateThrottle, WindowRateThrottle):
+    pass
+
+
+class ScopedRateThrottle(throttling.ScopedRateThrottle, WindowRateThrottle):
+    pass
@@ -1,127 +1,367 @@
 from api.models import Message, Device, PreKey, SignedPreKey
+from django.conf import settings
 from django.contrib.auth.models import User
-from api.serializers import MessageSerializer, DeviceSerializer, PreKeyBundleSerializer, PreKeySerializer, SignedPreKeySerializer
+from api.serializers import MessageSerializer, DeviceSerializer, PreKeySerializer, SignedPreKeySerializer
+from api.encoders import encodeMessage, encodeMessages, encodeBundle
 from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, transaction
 
 from django.http import Http404
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, permissions
 from api import errors
-
+from api.recipients import getRecipientDevice, getRecipientDevices, invalidate
+from api.authentication import invalidateTokens
+from api.notifications import getNotificationBus, notifyRecipients
+from api.mailboxes import getMailbox
+from api.pagination import readPageParameters, encodeCursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from api.asgi import runInThread
+from api.routers import readsFromReplica, stickToPrimary
+
+import asyncio
 import json
-from urllib.parse import unquote, quote
-
-
-class MessageList(APIView):
-
-    # User can get a list of messages for their device
-    def get(self, request, **kwargs):
-        user = self.request.user
-
+import re
+import time
+from urllib.parse import unquote, quote, parse_qs
+
+# Maximum number of envelopes accepted in a single batch POST
+MAX_MESSAGE_BATCH = 100
+
+# Longest lease, in seconds, a client can hold on drained messages
+MAX_VISIBILITY_TIMEOUT = 3600
+
+# Longest time, in seconds, a mailbox request can be held open waiting for
+# a message, and how often a waiting request rechecks the mailbox in case
+# the message was stored by another worker process
+MAX_LONG_POLL_WAIT = 30
+LONG_POLL_RECHECK_INTERVAL = 1
+
+
+# Reads the recipient, the parsed message content and the registrationId the
+# message was encrypted for from an envelope, raising ValueError if the
+# envelope is malformed. The content is parsed here once and handed to
+# MessageSerializer as an object.
+def readEnvelope(envelope):
+    if not isinstance(envelope, dict):
+        raise ValueError()
+    recipientUsername = envelope.get("recipient")
+    messageData = envelope.get("message")
+    if not (isinstance(recipientUsername, str) & isinstance(messageData, str)):
+        raise ValueError()
+    try:
+        content = json.loads(messageData)
+        registrationId = int(content['registrationId'])
+    except (TypeError, KeyError, ValueError):
+        raise ValueError()
+    return recipientUsername, content, registrationId
+
+
+# Returns the message id a client sent in a DELETE, a JSON integer or a
+# string of digits, or None for anything else, including true, 1.5 and " 7"
+def readMessageId(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and re.fullmatch('[0-9]+', value):
+        return int(value)
+    return None
+
+
+# Tells the owner of a device how many one-time prekeys it has left, and
+# whether the pool has fallen below the low water mark and should be topped up
+def addPreKeyHint(response, device):
+    response['X-PreKeys-Remaining'] = str(device.preKeyCount)
+    if device.preKeyCount < settings.PREKEY_LOW_WATER_MARK:
+        response['X-PreKeys-Replenish'] = 'true'
+    return response
+
+
+# Raised while resolving the requesting device to return one of the errors responses
+class DeviceCheckFailed(Exception):
+    def __init__(self, response):
+        self.response = response
+
+
+# Base for views acting on the requesting user's own device. The device is
+# resolved and checked once, before the handler runs, and is available to
+# handlers as self.device. The device itself is loaded with the user during
+# authentication, so this costs no queries.
+class OwnDeviceAPIView(APIView):
+
+    # URL kwarg holding the registrationId the client believes its device has
+    registrationIdKwarg = 'requestedDeviceRegistrationID'
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.device = self.checkOwnDevice(request.user, kwargs)
+
+    def checkOwnDevice(self, user, kwargs):
         # Check correct arguments provided
-        if not 'requestedDeviceRegistrationID' in kwargs:
-            return errors.incorrect_arguments
+        if not self.registrationIdKwarg in kwargs:
+            raise DeviceCheckFailed(errors.incorrect_arguments)
 
         # Check device exists and owned by user
         if not hasattr(user, "device"):
-            return errors.no_device
+            raise DeviceCheckFailed(errors.no_device)
 
         # Check device ID has not changed
-        if int(kwargs['requestedDeviceRegistrationID']) != user.device.registrationId:
-            return errors.device_changed
-            
-        messages = user.device.received_messages.all()
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        if int(kwargs[self.registrationIdKwarg]) != user.device.registrationId:
+            raise DeviceCheckFailed(errors.device_changed)
 
-    # User can post multiple messages. They will be defined as the sender
-    def post(self, request, **kwargs):
+        return user.device
 
-        # Check correct arguments provided
-        if not 'requestedDeviceRegistrationID' in kwargs:
-            return errors.incorrect_arguments
-        if not (hasattr(request, "data") & isinstance(request.data, object)):
-            return errors.incorrect_arguments
-        if not (("recipient" in request.data) & isinstance(request.data["recipient"], str)):
-            return errors.incorrect_arguments
-        if not (("message" in request.data) & isinstance(request.data["message"], str)):
+    def handle_exception(self, exc):
+        if isinstance(exc, DeviceCheckFailed):
+            return exc.response
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        # Errors are shared Response objects, so only successes carry the hint
+        device = getattr(self, 'device', None)
+        if device is not None and status.is_success(response.status_code):
+            addPreKeyHint(response, device)
+            if request.method in ('POST', 'DELETE'):
+                stickToPrimary(device.id)
+        return response
+
+
+class MessageList(OwnDeviceAPIView):
+
+    # User can get a list of messages for their device
+    @readsFromReplica
+    def get(self, request, **kwargs):
+        try:
+            pageParameters, wait = self.readFetchParameters(request)
+        except ValueError:
             return errors.incorrect_arguments
+        fetch = self.fetchFunction(pageParameters)
+        page, hasMore = self.waitForMessages(self.device, wait, fetch)
+        return self.fetchResponse(request, pageParameters, page, hasMore)
 
-        ownUser = self.request.user
-        recipientUsername = request.data["recipient"]
+    # As get, under ASGI. Waiting for a message holds no worker thread.
+    @readsFromReplica
+    async def asyncGet(self, request, **kwargs):
         try:
-            messageData = request.data["message"]
-        except:
+            pageParameters, wait = self.readFetchParameters(request)
+        except ValueError:
             return errors.incorrect_arguments
-        
-        # Check device exists and owned by user
-        if not hasattr(ownUser, "device"):
-            return errors.no_device
+        fetch = self.fetchFunction(pageParameters)
+        page, hasMore = await self.waitForMessagesAsync(self.device, wait, fetch)
+        return self.fetchResponse(request, pageParameters, page, hasMore)
+
+    # Under ASGI only long polls are served by asyncGet, which skips the
+    # middleware chain. Every other request runs through it on a worker thread.
+    @staticmethod
+    def servesAsync(environ):
+        if environ['REQUEST_METHOD'] != 'GET':
+            return False
+        try:
+            wait = float(parse_qs(environ['QUERY_STRING']).get('wait', ['0'])[-1])
+        except ValueError:
+            return False
+        return 0 < wait <= MAX_LONG_POLL_WAIT
+
+    def readFetchParameters(self, request):
+        pageParameters = readPageParameters(request.query_params)
+        wait = float(request.query_params.get('wait', 0))
+        if not (0 <= wait <= MAX_LONG_POLL_WAIT):
+            raise ValueError()
+        return pageParameters, wait
+
+    def fetchFunction(self, pageParameters):
+        mailbox = getMailbox()
+        # Without since/limit return the whole mailbox, as older clients expect
+        if pageParameters is None:
+            return lambda: mailbox.fetch(self.device)
+        since, limit = pageParameters
+        return lambda: mailbox.fetch(self.device, since, limit)
+
+    def fetchResponse(self, request, pageParameters, page, hasMore):
+        if pageParameters is None:
+            return Response(encodeMessages(page), status=status.HTTP_200_OK)
+        return Response({
+            "messages": encodeMessages(page),
+            # Clients pass this back as since to fetch the next page
+            "next": encodeCursor(page[-1]) if page else request.query_params.get('since'),
+            "hasMore": hasMore,
+        }, status=status.HTTP_200_OK)
+
+    # Calls fetch until it returns messages or wait seconds have passed,
+    # sleeping until the notification bus reports a new message in between
+    def waitForMessages(self, device, wait, fetch):
+        if not wait:
+            return fetch()
+        deadline = time.monotonic() + wait
+        with getNotificationBus().subscribe(device.id) as arrived:
+            page, hasMore = fetch()
+            while not page:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                arrived.wait(min(remaining, LONG_POLL_RECHECK_INTERVAL))
+                arrived.clear()
+                page, hasMore = fetch()
+        return page, hasMore
+
+    # As waitForMessages, with fetch run on a worker thread and the wait on
+    # the event loop
+    async def waitForMessagesAsync(self, device, wait, fetch):
+        if not wait:
+            return await runInThread(fetch)
+        deadline = time.monotonic() + wait
+        with getNotificationBus().subscribeAsync(device.id) as arrived:
+            page, hasMore = await runInThread(fetch)
+            while not page:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(arrived.wait(), min(remaining, LONG_POLL_RECHECK_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+                arrived.clear()
+                page, hasMore = await runInThread(fetch)
+        return page, hasMore
+
+    # User can post a message, or a list of messages to several recipients.
+    # They will be defined as the sender
+    def post(self, request, **kwargs):
 
-        # Check device ID has not changed
-        if int(kwargs['requestedDeviceRegistrationID']) != ownUser.device.registrationId:
-            return errors.device_changed
+        # Check correct arguments provided
+        if not hasattr(request, "data"):
+            return errors.incorrect_arguments
+
+        if isinstance(request.data, list):
+            return self.postBatch(request.data, self.device)
 
-        # Check repipient user exists
         try:
-            recipientUser = User.objects.get(username=recipientUsername)
-        except:
-            return errors.no_recipient
+            recipientUsername, content, registrationId = readEnvelope(request.data)
+        except ValueError:
+            return errors.incorrect_arguments
 
-        # Check recipient device exists
-        if not hasattr(recipientUser, "device"):
+        # Check recipient exists and has a registered device
+        recipientDevice = getRecipientDevice(recipientUsername)
+        if recipientDevice is None:
+            if not User.objects.filter(username=recipientUsername).exists():
+                return errors.no_recipient
             return errors.no_recipient_device
-        recipientDevice = recipientUser.device
 
         # Check recipient device registrationId matches that sent in message
-        print(recipientUser.device.registrationId)
-        print(json.loads(messageData)['registrationId'])
-        if not (recipientUser.device.registrationId == int(json.loads(messageData)['registrationId'])):
+        if not (recipientDevice.registrationId == registrationId):
             return errors.recipient_identity_changed
 
-        serializer = MessageSerializer(data={'content': messageData}, context={'senderDevice': ownUser.device, 'recipientDevice': recipientDevice})
+        serializer = MessageSerializer(data={'content': content}, context={'senderDevice': self.device, 'recipientDevice': recipientDevice})
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         else: 
             serializer.save()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    # Stores a list of envelopes, returning a result for each one in order.
+    # All recipient devices are resolved in a single query and the valid
+    # messages are inserted together.
+    def postBatch(self, envelopes, ownDevice):
+
+        if not (0 < len(envelopes) <= MAX_MESSAGE_BATCH):
+            return errors.incorrect_arguments
+
+        # Parse every envelope before touching the database
+        parsed = []
+        for envelope in envelopes:
+            try:
+                parsed.append(readEnvelope(envelope))
+            except ValueError:
+                parsed.append(None)
+
+        usernames = {x[0] for x in parsed if x is not None}
+        recipientDevices = getRecipientDevices(usernames)
+        # Only look up users when a recipient has no device, to tell the two errors apart
+        missing = usernames - recipientDevices.keys()
+        existingUsers = set(User.objects.filter(username__in=missing).values_list('username', flat=True)) if missing else set()
+
+        response = []
+        messages = []
+        for x in parsed:
+            if x is None:
+                response.append(errors.incorrect_arguments.data)
+                continue
+            recipientUsername, content, registrationId = x
+            recipientDevice = recipientDevices.get(recipientUsername)
+            if recipientDevice is None:
+                if recipientUsername in existingUsers:
+                    response.append(errors.no_recipient_device.data)
+                else:
+                    response.append(errors.no_recipient.data)
+                continue
+            # Check recipient device registrationId matches that sent in message
+            if recipientDevice.registrationId != registrationId:
+                response.append(errors.recipient_identity_changed.data)
+                continue
+            serializer = MessageSerializer(data={'content': content})
+            if not serializer.is_valid():
+                response.append(errors.invalidData(serializer.errors).data)
+                continue
+            message = Message(recipient=recipientDevice, sender=ownDevice, **serializer.validated_data)
+            messages.append(message)
+            # Placeholder, replaced with the stored message below
+            response.append(message)
+
+        getMailbox().store(messages)
+        notifyRecipients(x.recipient_id for x in messages)
+
+        response = [encodeMessage(x) if isinstance(x, Message) else x for x in response]
+        return Response(response, status=status.HTTP_200_OK)
+
     # User can delete any message for which they are the recipient
     def delete(self, request, **kwargs):
 
         # Check correct arguments provided
-        if not 'requestedDeviceRegistrationID' in kwargs:
-            return errors.incorrect_arguments
-        if not (hasattr(request, "data") & isinstance(request.data, list) & len(request.data) > 0):
+        if not (hasattr(request, "data") and isinstance(request.data, list) and len(request.data) > 0):
             return errors.incorrect_arguments
 
-        user = self.request.user
         messageList = request.data
         response = []
 
-        # Check device exists and owned by user
-        if not hasattr(user, "device"):
-            return errors.no_device
+        # Ignore anything that cannot be a message id, it is reported as non-existant below
+        messageIds = [readMessageId(x) for x in messageList]
+        requestedIds = {x for x in messageIds if x is not None}
 
-        # Check device ID has not changed
-        if int(kwargs['requestedDeviceRegistrationID']) != user.device.registrationId:
-            return errors.device_changed
+        acknowledged, foreign = getMailbox().acknowledge(self.device, requestedIds)
 
-        for messageId in messageList:
-            try:
-                message = Message.objects.get(id=messageId)
-                # Check user owns meaage
-                if not message.recipient.user == user:
-                    response.append(errors.not_message_owner)
-                else:
-                    message.delete()
-                    response.append('success')
-            except:
-                response.append(errors.non_existant_message)
+        for messageId in messageIds:
+            if messageId in acknowledged:
+                response.append('success')
+            # Check user owns message
+            elif messageId in foreign:
+                response.append(errors.not_message_owner.data)
+            else:
+                response.append(errors.non_existant_message.data)
 
         return Response(response, status=status.HTTP_200_OK)
 
+class MessageDrain(OwnDeviceAPIView):
+
+    # User can fetch and remove messages for their device in one request.
+    # With a visibilityTimeout the messages are only hidden until it expires
+    # and must still be acknowledged with a DELETE on MessageList.
+    def post(self, request, **kwargs):
+
+        # Check correct arguments provided
+        if not isinstance(request.data, dict):
+            return errors.incorrect_arguments
+        limit = request.data.get('limit', DEFAULT_PAGE_SIZE)
+        visibilityTimeout = request.data.get('visibilityTimeout')
+        # JSON true and false arrive as bool, which is also an int
+        if not (isinstance(limit, int) and not isinstance(limit, bool) and 0 < limit <= MAX_PAGE_SIZE):
+            return errors.incorrect_arguments
+        if not (visibilityTimeout is None or (isinstance(visibilityTimeout, int) and not isinstance(visibilityTimeout, bool)
+                                              and 0 < visibilityTimeout <= MAX_VISIBILITY_TIMEOUT)):
+            return errors.incorrect_arguments
+
+        messages, hasMore = getMailbox().drain(self.device, limit, visibilityTimeout)
+        return Response({"messages": encodeMessages(messages), "hasMore": hasMore}, status=status.HTTP_200_OK)
+
 class DeviceView(APIView):
 
     # User can register details of a new device
@@ -130,7 +370,7 @@ class DeviceView(APIView):
         # Check correct arguments provided
         # Note - do not verify registrationID here as device should not exist
         if not (hasattr(request, "data") & isinstance(request.data, object)):
-            return error.incorrect_arguments
+            return errors.incorrect_arguments
 
         user = self.request.user
 
@@ -143,9 +383,14 @@ class DeviceView(APIView):
 
         if not serializer.is_valid():
             return errors.invalidData(serializer.errors)
-            
-        serializer.save()
-        return Response({"code": "device_created", "message": "Device successfully created"}, status=status.HTTP_201_CREATED)
+
+        # A concurrent registration for the same user won the race
+        try:
+            device = serializer.save()
+        except IntegrityError:
+            return errors.device_exists
+        response = Response({"code": "device_created", "message": "Device successfully created"}, status=status.HTTP_201_CREATED)
+        return addPreKeyHint(response, device)
 
     # User can delete a device they own
     def delete(self, requested, **kwargs):
@@ -154,129 +399,92 @@ class DeviceView(APIView):
         # Check device exists and owned by user
         if not hasattr(user, "device"):
             return errors.no_device
-        device = user.device
-        device.delete()
+        # Detach the device rather than deleting it, so the request does not
+        # depend on the size of its mailbox. It stops being served at once and
+        # the user can register again; compact_mailboxes removes the rest.
+        Device.objects.filter(pk=user.device.pk).update(user=None)
+        invalidate(user.username)
+        invalidateTokens(user.username)
         return Response({"code": "device_deleted", "message": "Device successfully deleted"}, status=status.HTTP_204_NO_CONTENT)
 
 
-class PreKeyBundleView(APIView):
+class PreKeyBundleView(OwnDeviceAPIView):
     throttle_scope = 'preKeyBundle'
+    registrationIdKwarg = 'ownDeviceRegistrationID'
     # User can optain a preKeyBundle from another user
     def get(self, request, **kwargs):
 
-        ownUser = self.request.user
-
         # Check correct arguments provided
-        if not (('recipientUsername' in kwargs) & ('ownDeviceRegistrationID' in kwargs)):
+        if not 'recipientUsername' in kwargs:
             return errors.incorrect_arguments
 
-        # Check device exists and owned by user
-        if not hasattr(ownUser, "device"):
-            return errors.no_device
-
-        # Check device ID has not changed
-        if int(kwargs['ownDeviceRegistrationID']) != ownUser.device.registrationId:
-            return errors.device_changed
-
-        # Check recipient user exists
-        recipientUser = {}
-        try:
-            recipientUser = User.objects.get(username=kwargs['recipientUsername'])
-        except:
-            return errors.no_recipient
-
-        # Check user has a registered device
-        if not hasattr(recipientUser, "device"):
+        # Load the recipient's device and signed prekey, from the cache if possible
+        device = getRecipientDevice(kwargs['recipientUsername'])
+        if device is None:
+            # Distinguish a missing user from a user without a device
+            if not User.objects.filter(username=kwargs['recipientUsername']).exists():
+                return errors.no_recipient
             return errors.no_recipient_device
-        device = recipientUser.device
 
-        # Check prekey available for device before proceeding
-        if device.prekey_set.count() == 0:
+        # Remove a preKey from the requested device's pool in one atomic statement
+        preKeyToReturn = PreKey.objects.claim(device)
+        if preKeyToReturn is None:
             # Handle no pre keys available for device - throw an error for security
             return errors.no_prekeys
-
-        # Build pre key bundle, removing a preKey from the requested user's list
-        preKeyToReturn = device.prekey_set.all()[:1].get()
-        signedPreKey = device.signedprekey
-    
-        preKeyBundle = device.__dict__
-        preKeyBundle['preKey'] = preKeyToReturn
-        preKeyBundle['signedPreKey'] = signedPreKey
-        serializer = PreKeyBundleSerializer(preKeyBundle)
-
-        # Update stored pre key
-        preKeyToReturn.delete()
+        # The recipient's cached tokens hold the count the claim lowered
+        invalidateTokens(kwargs['recipientUsername'])
 
         # Return bundle
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(encodeBundle(device, preKeyToReturn), status=status.HTTP_200_OK)
             
         
 
-class UserPreKeys(APIView):
+class UserPreKeys(OwnDeviceAPIView):
 
-    # User can post a new set of preKeys
+    # User can post a new set of preKeys. The batch is stored in full or not at all.
     def post(self, request, **kwargs):
 
-        try: 
-
-            user = self.request.user
-
-            # Check correct arguments provided
-            if not 'requestedDeviceRegistrationID' in kwargs:
-                return errors.incorrect_arguments
-            if not (hasattr(request, "data") & isinstance(request.data, list) & len(request.data) > 0):
-                return errors.incorrect_arguments
-
-             # Check device exists and owned by user
-            if not hasattr(user, "device"):
-                return errors.no_device
-
-            # Check device ID has not changed
-            if int(kwargs['requestedDeviceRegistrationID']) != user.device.registrationId:
-                return errors.device_changed
-            
-            newPreKeys = request.data
+        # Check correct arguments provided
+        newPreKeys = getattr(request, "data", None)
+        # The reference client wraps the list as {"preKeys": [...]}
+        if isinstance(newPreKeys, dict):
+            newPreKeys = newPreKeys.get("preKeys")
+        if not (isinstance(newPreKeys, list) and len(newPreKeys) > 0):
+            return errors.incorrect_arguments
 
-            for x in newPreKeys:
-                serializer = PreKeySerializer(data=x, context={'user': user, 'registrationId': user.device.registrationId})
+        serializer = PreKeySerializer(data=newPreKeys, many=True, context={'device': self.device})
 
-                if not serializer.is_valid():
-                    return errors.invalidData(serializer.errors)
+        if not serializer.is_valid():
+            return errors.invalidData(serializer.errors)
 
+        try:
+            with transaction.atomic():
                 serializer.save()
-
-            return Response({"code": "prekeys_stored", "message": "Prekeys successfully stored"}, status=status.HTTP_200_OK)
-
         except PermissionDenied:
             return errors.reached_max_prekeys
+        except IntegrityError:
+            return errors.duplicate_prekey
+        # Cached tokens hold the count the upload raised
+        invalidateTokens(request.user.username)
+
+        return Response({"code": "prekeys_stored", "message": "Prekeys successfully stored"}, status=status.HTTP_200_OK)
         
 
-class UserSignedPreKeys(APIView):
+class UserSignedPreKeys(OwnDeviceAPIView):
     # User can post a new signedPreKey
     def post(self, request, **kwargs):
 
-        user = self.request.user
-
         # Check correct arguments provided
-        if not 'requestedDeviceRegistrationID' in kwargs:
-            return errors.incorrect_arguments
         if not (hasattr(request, "data") & isinstance(request.data, object)):
             return errors.incorrect_arguments
 
-        # Check device exists and owned by user
-        if not hasattr(user, "device"):
-            return errors.no_device
-
-        # Check device ID has not changed
-        if int(kwargs['requestedDeviceRegistrationID']) != user.device.registrationId:
-            return errors.device_changed
-            
-        serializer = SignedPreKeySerializer(data=request.data, context={'user': user, 'registrationId': user.device.registrationId})
+        serializer = SignedPreKeySerializer(data=request.data, context={'device': self.device})
 
         if not serializer.is_valid():
             return errors.invalidData(serializer.errors)
-            
-        user.device.signedprekey.delete()
-        serializer.save()
+
+        # Replace the stored signed prekey in one transaction
+        with transaction.atomic():
+            SignedPreKey.objects.filter(device=self.device).delete()
+            serializer.save()
         return Response({"code": "signed_prekey_stored", "message": "Signed prekey successfully stored"}, status=status.HTTP_200_OK)
-            
\ No newline at end of file
@@ -0,0 +1,223 @@
+"""
+Serves many concurrent clients over WSGI and over ASGI and compares
+requests/s and latency. Clients form a ring: each one repeatedly claims a
+prekey bundle for the next client, sends it a message, and long polls its
+own mailbox for the message from the previous client.
+
+  wsgi  Django's WSGIHandler on a pool of --threads threads, as a threaded
+        WSGI server such as gunicorn --threads runs it
+  asgi  api.asgi.ASGIHandler on one event loop, with ASGI_THREADS set to
+        --threads
+
+Clients are coroutines on the benchmark's event loop calling the handlers
+directly, so the comparison leaves out HTTP parsing and sockets. Latency
+includes time spent queued for a thread.
+
+    python -m benchmarks.asgi --clients 10 100 --threads 8 --duration 10 --wait 5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import setupDjango, summarise, formatSummary
+
+ENDPOINTS = ('claim bundle', 'send message', 'fetch mailbox')
+
+
+def resetDatabase(databaseName):
+    from django.core.management import call_command
+    from django.db import connection
+
+    connection.close()
+    if connection.vendor == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(databaseName + suffix):
+                os.remove(databaseName + suffix)
+        call_command('migrate', verbosity=0)
+    else:
+        call_command('migrate', verbosity=0)
+        call_command('flush', interactive=False, verbosity=0)
+
+
+# Creates a device with prekeys for every client, returning their tokens
+def seed(clients, prekeys):
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from rest_framework_jwt.settings import api_settings
+    from api.models import Device, PreKey, SignedPreKey
+
+    key = b'\x05' * 33
+    tokens = []
+    encode, payload = api_settings.JWT_ENCODE_HANDLER, api_settings.JWT_PAYLOAD_HANDLER
+    for i in range(clients):
+        user = User.objects.create_user(username='user%d' % i)
+        device = Device.objects.create(user=user, identityKey=key, registrationId=i + 1, address=user.username + '.1',
+                                       preKeyCount=prekeys)
+        SignedPreKey.objects.create(device=device, keyId=1, publicKey=key, signature=b'\x00' * 64)
+        PreKey.objects.bulk_create((PreKey(device=device, keyId=k, publicKey=key) for k in range(1, prekeys + 1)),
+                                   batch_size=500)
+        tokens.append(encode(payload(user)))
+    # Request threads must not share this thread's connection
+    connection.close()
+    return tokens
+
+
+def scope(method, path, token, query=''):
+    return {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [
+            (b'host', b'localhost'),
+            (b'authorization', ('Bearer ' + token).encode()),
+            (b'content-type', b'application/json'),
+        ],
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+
+
+# Calls the WSGI handler on one of the pool's threads, as a threaded WSGI
+# server would for each request
+def wsgiCaller(executor):
+    from django.core.handlers.wsgi import WSGIHandler
+    from api.asgi import buildEnviron
+
+    handler = WSGIHandler()
+
+    def call(scope, body):
+        statuses = []
+        response = handler(buildEnviron(scope, body), lambda status, headers: statuses.append(status))
+        try:
+            content = b''.join(response)
+        finally:
+            response.close()
+        return int(statuses[0].split()[0]), content
+
+    async def request(scope, body=b''):
+        return await asyncio.get_event_loop().run_in_executor(executor, call, scope, body)
+
+    return request
+
+
+def asgiCaller():
+    from api.asgi import ASGIHandler
+
+    handler = ASGIHandler()
+
+    async def request(scope, body=b''):
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await handler(scope, receive, send)
+        return sent[0]['status'], sent[1]['body']
+
+    return request
+
+
+async def client(request, i, clients, token, wait, deadline, samples, failures):
+    registrationId = i + 1
+    peer = (i + 1) % clients
+    since = ''
+    message = json.dumps({
+        'recipient': 'user%d' % peer,
+        'message': json.dumps({'type': 1, 'body': 'x' * 256, 'registrationId': peer + 1}),
+    }).encode()
+
+    async def timed(endpoint, scope, body=b''):
+        started = time.perf_counter()
+        statusCode, content = await request(scope, body)
+        samples[endpoint].append(time.perf_counter() - started)
+        if statusCode >= 400:
+            failures[endpoint] += 1
+        return content
+
+    while time.monotonic() < deadline:
+        await timed('claim bundle', scope('GET', '/prekeybundle/user%d/%d/' % (peer, registrationId), token))
+        await timed('send message', scope('POST', '/messages/%d/' % registrationId, token), message)
+        content = await timed('fetch mailbox', scope('GET', '/messages/%d/' % registrationId, token,
+                                                    'wait=%g&since=%s' % (wait, since)))
+        since = json.loads(content.decode()).get('next') or since
+
+
+async def load(request, tokens, wait, duration):
+    samples = {x: [] for x in ENDPOINTS}
+    failures = {x: 0 for x in ENDPOINTS}
+    started = time.perf_counter()
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*(
+        client(request, i, len(tokens), token, wait, deadline, samples, failures) for i, token in enumerate(tokens)
+    ))
+    return samples, failures, time.perf_counter() - started
+
+
+def run(databaseName, mode, clients, options):
+    from django.conf import settings
+    from api import asgi
+
+    resetDatabase(databaseName)
+    tokens = seed(clients, options.prekeys)
+    if mode == 'wsgi':
+        executor = ThreadPoolExecutor(options.threads)
+        request = wsgiCaller(executor)
+    else:
+        settings.ASGI_THREADS = options.threads
+        asgi.getExecutor.cache_clear()
+        executor = asgi.getExecutor()
+        request = asgiCaller()
+
+    samples, failures, elapsed = asyncio.run(load(request, tokens, options.wait, options.duration))
+    executor.shutdown()
+
+    total = sum(len(x) for x in samples.values())
+    print('%s, %d clients: %.1f requests/s, %d failed' % (mode, clients, total / elapsed, sum(failures.values())))
+    for endpoint in ENDPOINTS:
+        if samples[endpoint]:
+            print('  ' + formatSummary(endpoint, summarise(samples[endpoint])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='seconds each run lasts')
+    parser.add_argument('--wait', type=float, default=5, help='long poll wait in seconds, 0 to poll without waiting')
+    parser.add_argument('--prekeys', type=int, default=500, help='prekeys per device')
+    options = parser.parse_args()
+
+    databaseName = setupDjango()
+    from django.conf import settings
+    from django.db import connection
+
+    # The load test is not what the throttles are protecting against
+    settings.REST_FRAMEWORK['DEFAULT_THROTTLE_CLASSES'] = ()
+    # Failed requests are counted, not logged
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+
+    print('%d threads, long poll wait %gs, %gs per run' % (options.threads, options.wait, options.duration))
+    for clients in options.clients:
+        for mode in ('wsgi', 'asgi'):
+            run(databaseName, mode, clients, options)
+
+    connection.close()
+    if connection.vendor == 'sqlite':
+        shutil.rmtree(os.path.dirname(databaseName))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Configures Django against a scratch SQLite database so benchmarks never
+# touch the development database. Returns the database path, or the name
+# of the PostgreSQL database when POSTGRES_DB is set.
+def setupDjango(databaseName=None):
+    if PROJECT_DIR not in sys.path:
+        sys.path.insert(0, PROJECT_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'signal_server_demonstration.settings')
+    from django.conf import settings
+    if settings.DATABASES['default']['ENGINE'] != 'django.db.backends.sqlite3':
+        # Other databases are used as configured, and must be scratch ones
+        databaseName = settings.DATABASES['default']['NAME']
+    else:
+        if databaseName is None:
+            databaseName = os.path.join(tempfile.mkdtemp(prefix='signal-bench-'), 'bench.sqlite3')
+        settings.DATABASES['default']['NAME'] = databaseName
+        # The replica benchmark points this at its copy of the database
+        settings.DATABASES['replica'] = dict(settings.DATABASES['default'])
+        # Scratch databases run as they would with SQLITE_WAL set
+        settings.SQLITE_PRAGMAS = dict(settings.SQLITE_PRAGMAS, journal_mode='wal', synchronous='normal')
+    # Query logging would dominate the timings
+    settings.DEBUG = False
+    # Requests made through the test client or a local server
+    settings.ALLOWED_HOSTS = ['testserver', 'localhost', '127.0.0.1']
+    import django
+    django.setup()
+    return databaseName
+
+
+# Calls fn once per argument tuple, returning the duration of each call in seconds
+def timeCalls(fn, argsList):
+    samples = []
+    for args in argsList:
+        started = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Summarises durations in seconds as milliseconds
+def summarise(samples):
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+    }
+
+
+def formatSummary(name, summary):
+    return '{:<40} n={count:<7} mean={mean_ms:8.3f}ms p50={p50_ms:8.3f}ms p99={p99_ms:8.3f}ms'.format(name, **summary)
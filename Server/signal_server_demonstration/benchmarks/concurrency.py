@@ -0,0 +1,153 @@
+"""
+Runs concurrent writers against POST /messages/ and compares database
+profiles. Each writer is its own process, like a WSGI worker, posting
+messages through Django's WSGI handler so connections are opened and closed
+as they would be in production.
+
+  default     connections closed after every request, SQLite's rollback
+              journal and default locking
+  production  the profile in settings.py with SQLITE_WAL set: persistent
+              connections, and WAL with busy_timeout on SQLite
+
+    python -m benchmarks.concurrency --writers 8 --messages 500
+
+With POSTGRES_DB set the benchmark runs against that PostgreSQL database
+instead, where only connection persistence differs between the profiles.
+It must be a scratch database, as it is flushed before each run.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+
+from benchmarks.common import setupDjango, summarise, formatSummary
+
+PROFILES = {
+    'default': {'CONN_MAX_AGE': 0, 'SQLITE_PRAGMAS': {}},
+    'production': {'CONN_MAX_AGE': 60, 'SQLITE_PRAGMAS': None},
+}
+
+
+def applyProfile(profile):
+    from django.conf import settings
+    settings.DATABASES['default']['CONN_MAX_AGE'] = profile['CONN_MAX_AGE']
+    if profile['SQLITE_PRAGMAS'] is not None:
+        settings.SQLITE_PRAGMAS = profile['SQLITE_PRAGMAS']
+    # The load test is not what the throttles are protecting against
+    settings.REST_FRAMEWORK['DEFAULT_THROTTLE_CLASSES'] = ()
+
+
+# Creates a sender per writer and one recipient, returning each sender's
+# (token, registrationId)
+def seed(writers):
+    from django.contrib.auth.models import User
+    from rest_framework_jwt.settings import api_settings
+    from api.models import Device
+
+    users = [User.objects.create_user(username='user%d' % i) for i in range(writers + 1)]
+    for i, user in enumerate(users):
+        Device.objects.create(user=user, identityKey=b'\x05' * 33, registrationId=i + 1, address=user.username + '.1')
+    encode, payload = api_settings.JWT_ENCODE_HANDLER, api_settings.JWT_PAYLOAD_HANDLER
+    return [(encode(payload(user)), i + 1) for i, user in enumerate(users[:-1])]
+
+
+def writer(databaseName, profileName, recipient, token, registrationId, messages, start, results):
+    setupDjango(databaseName)
+    applyProfile(PROFILES[profileName])
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test import RequestFactory
+
+    # Failed requests are counted, not logged
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    handler = WSGIHandler()
+    factory = RequestFactory()
+    # Every writer sends to the recipient, the last device seed() created
+    body = json.dumps({
+        'recipient': 'user%d' % recipient,
+        'message': json.dumps({'type': 1, 'body': 'x' * 256, 'registrationId': recipient + 1}),
+    })
+    url = '/messages/%d/' % registrationId
+    samples, failures = [], 0
+    start.wait()
+    for _ in range(messages):
+        request = factory.post(url, body, content_type='application/json', HTTP_AUTHORIZATION='Bearer ' + token)
+        statuses = []
+        started = time.perf_counter()
+        response = handler(request.environ, lambda status, headers: statuses.append(status))
+        # Sends request_finished, which closes the connection when CONN_MAX_AGE is 0
+        response.close()
+        samples.append(time.perf_counter() - started)
+        if not statuses[0].startswith('201'):
+            failures += 1
+    results.put((samples, failures))
+
+
+def run(databaseName, profileName, writers, messages):
+    from django.core.management import call_command
+    from django.db import connection
+
+    applyProfile(PROFILES[profileName])
+    if connection.vendor == 'sqlite':
+        # A fresh file, as the journal mode is stored in the database
+        connection.close()
+        if os.path.exists(databaseName):
+            os.remove(databaseName)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(databaseName + suffix):
+                os.remove(databaseName + suffix)
+        call_command('migrate', verbosity=0)
+    else:
+        call_command('migrate', verbosity=0)
+        call_command('flush', interactive=False, verbosity=0)
+    senders = seed(writers)
+    # Workers must not inherit this process's connection
+    connection.close()
+
+    context = multiprocessing.get_context('spawn')
+    start = context.Event()
+    results = context.Queue()
+    processes = [
+        context.Process(target=writer, args=(databaseName, profileName, writers, token, registrationId, messages, start, results))
+        for token, registrationId in senders
+    ]
+    for process in processes:
+        process.start()
+    # Give every worker time to import Django before the clock starts
+    time.sleep(2)
+    started = time.perf_counter()
+    start.set()
+    samples, failures = [], 0
+    for _ in processes:
+        workerSamples, workerFailures = results.get()
+        samples += workerSamples
+        failures += workerFailures
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    print(formatSummary(profileName, summarise(samples)) +
+          '  %.1f messages/s  %d failed' % (len(samples) / elapsed, failures))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=500, help='messages posted by each writer')
+    options = parser.parse_args()
+
+    databaseName = setupDjango()
+    from django.db import connection
+
+    print('%d writers posting %d messages each to %s' % (options.writers, options.messages, databaseName))
+    for profileName in PROFILES:
+        run(databaseName, profileName, options.writers, options.messages)
+
+    connection.close()
+    if connection.vendor == 'sqlite':
+        shutil.rmtree(os.path.dirname(databaseName))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Times reading and encoding a mailbox of 10, 1000 and 10000 messages,
+comparing MessageSerializer with encodeMessages over model instances and
+over values() rows, which are what DatabaseMailbox.fetch returns.
+
+    python -m benchmarks.encoders --sizes 10 1000 10000
+"""
+import argparse
+import os
+import shutil
+
+from benchmarks.common import setupDjango, timeCalls, summarise, formatSummary
+
+
+def seed(size):
+    from django.contrib.auth.models import User
+    from api.models import Device, Message
+
+    Message.objects.all().delete()
+    if not Device.objects.exists():
+        for i, username in enumerate(('sender', 'recipient')):
+            user = User.objects.create_user(username=username)
+            Device.objects.create(user=user, identityKey=b'\x05' * 33, registrationId=i + 1, address=username + '.1')
+    sender, recipient = Device.objects.order_by('id')
+    Message.objects.bulk_create(
+        Message(recipient=recipient, sender=sender, recipientRegistrationId=2, messageType=1, body=os.urandom(300))
+        for _ in range(size))
+    return recipient
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=20)
+    options = parser.parse_args()
+
+    databaseName = setupDjango()
+    from django.core.management import call_command
+    from django.db import connection
+    from api.encoders import MESSAGE_VALUES, encodeMessages
+    from api.mailboxes import DatabaseMailbox
+    from api.models import Message
+    from api.serializers import MessageSerializer
+
+    call_command('migrate', verbosity=0)
+    for size in options.sizes:
+        recipient = seed(size)
+        mailbox = Message.objects.filter(recipient=recipient).order_by('created', 'id')
+        messages = list(mailbox.select_related('sender', 'recipient'))
+        runs = [()] * options.repeat
+        print('%d messages' % size)
+        cases = [
+            ('encode: serializer', lambda: MessageSerializer(messages, many=True).data),
+            ('encode: encodeMessages', lambda: encodeMessages(messages)),
+            ('fetch and encode: serializer',
+             lambda: MessageSerializer(list(mailbox.select_related('sender', 'recipient')), many=True).data),
+            ('fetch and encode: encodeMessages',
+             lambda: encodeMessages(list(mailbox.select_related('sender', 'recipient')))),
+            ('fetch and encode: values() rows', lambda: encodeMessages(list(mailbox.values(*MESSAGE_VALUES)))),
+            ('fetch and encode: DatabaseMailbox', lambda: encodeMessages(DatabaseMailbox().fetch(recipient)[0])),
+        ]
+        for name, run in cases:
+            print('  ' + formatSummary(name, summarise(timeCalls(run, runs))))
+
+    connection.close()
+    if connection.vendor == 'sqlite':
+        shutil.rmtree(os.path.dirname(databaseName))
+
+
+if __name__ == '__main__':
+    main()
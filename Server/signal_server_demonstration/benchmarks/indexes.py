@@ -0,0 +1,131 @@
+"""
+Measures the mailbox and prekey queries before and after the composite
+indexes added in migration 0004.
+
+Seeds a scratch SQLite database at the schema of migration 0003, prints the
+query plans and latencies, applies 0004 and measures again.
+
+    python -m benchmarks.indexes --devices 100000 --messages 1000000
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+from datetime import datetime, timedelta
+
+from benchmarks.common import setupDjango, timeCalls, summarise, formatSummary
+
+QUERIES = {
+    'mailbox page': (
+        'SELECT "id", "created", "content", "sender_id" FROM "api_message" '
+        'WHERE "recipient_id" = %s ORDER BY "created", "id" LIMIT 100'
+    ),
+    'prekey by keyId': (
+        'SELECT "id" FROM "api_prekey" WHERE "device_id" = %s AND "keyId" = %s'
+    ),
+    'prekey claim candidate': (
+        'SELECT "id" FROM "api_prekey" WHERE "device_id" = %s ORDER BY "id" LIMIT 1'
+    ),
+}
+
+KEY = 'A' * 43 + '='
+
+
+def seed(cursor, devices, messages, preKeysPerDevice, hotShare):
+    now = datetime(2019, 1, 1).strftime('%Y-%m-%d %H:%M:%S')
+    cursor.executemany(
+        'INSERT INTO "auth_user" ("id", "password", "is_superuser", "username", "first_name", "last_name", '
+        '"email", "is_staff", "is_active", "date_joined") VALUES (%s, \'\', 0, %s, \'\', \'\', \'\', 0, 1, %s)',
+        [(i, 'user%d' % i, now) for i in range(1, devices + 1)])
+    cursor.executemany(
+        'INSERT INTO "api_device" ("id", "user_id", "identityKey", "registrationId", "address") '
+        'VALUES (%s, %s, %s, %s, %s)',
+        [(i, i, KEY, i, 'user%d.1' % i) for i in range(1, devices + 1)])
+    cursor.executemany(
+        'INSERT INTO "api_prekey" ("device_id", "keyId", "publicKey") VALUES (%s, %s, %s)',
+        [(device, keyId, KEY) for device in range(1, devices + 1) for keyId in range(1, preKeysPerDevice + 1)])
+
+    # Device 1 is a popular recipient holding hotShare of all messages, the
+    # rest are spread evenly. Messages arrive in created order.
+    start = datetime(2019, 1, 1)
+    rows = []
+    for i in range(messages):
+        recipient = 1 if random.random() < hotShare else random.randint(2, devices)
+        created = (start + timedelta(milliseconds=i)).strftime('%Y-%m-%d %H:%M:%S.%f')
+        rows.append((recipient, created, '{}', random.randint(1, devices)))
+        if len(rows) == 100000:
+            insertMessages(cursor, rows)
+            rows = []
+    insertMessages(cursor, rows)
+
+
+def insertMessages(cursor, rows):
+    cursor.executemany(
+        'INSERT INTO "api_message" ("recipient_id", "created", "content", "sender_id") VALUES (%s, %s, %s, %s)', rows)
+
+
+def measure(cursor, devices, preKeysPerDevice, samples):
+    randomDevices = [random.randint(2, devices) for _ in range(samples)]
+    arguments = {
+        'mailbox page': [(x,) for x in randomDevices],
+        'mailbox page (popular device)': [(1,)] * samples,
+        'prekey by keyId': [(x, random.randint(1, preKeysPerDevice)) for x in randomDevices],
+        'prekey claim candidate': [(x,) for x in randomDevices],
+    }
+    for name, argsList in arguments.items():
+        sql = QUERIES[name.replace(' (popular device)', '')]
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, argsList[0])
+        print('  %s' % name)
+        for row in cursor.fetchall():
+            print('    plan: %s' % row[-1])
+
+        def run(*args):
+            cursor.execute(sql, args)
+            cursor.fetchall()
+
+        print('    ' + formatSummary('latency', summarise(timeCalls(run, argsList))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--prekeys-per-device', type=int, default=10)
+    parser.add_argument('--hot-share', type=float, default=0.05, help='share of messages sent to one popular device')
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch database')
+    options = parser.parse_args()
+
+    databaseName = setupDjango()
+    from django.core.management import call_command
+    from django.db import connection, transaction
+
+    # The seeding SQL and query plans are SQLite's, and migrating back to
+    # 0003 would drop data from a configured database
+    if connection.vendor != 'sqlite':
+        sys.exit('benchmarks.indexes runs on SQLite only, unset POSTGRES_DB')
+    random.seed(0)
+    call_command('migrate', 'auth', verbosity=0)
+    call_command('migrate', 'api', '0003', verbosity=0)
+    print('Seeding %d devices, %d messages in %s' % (options.devices, options.messages, databaseName))
+    with transaction.atomic(), connection.cursor() as cursor:
+        seed(cursor, options.devices, options.messages, options.prekeys_per_device, options.hot_share)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+        print('Before (migration 0003)')
+        measure(cursor, options.devices, options.prekeys_per_device, options.samples)
+
+    call_command('migrate', 'api', '0004', verbosity=0)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+        print('After (migration 0004)')
+        measure(cursor, options.devices, options.prekeys_per_device, options.samples)
+
+    connection.close()
+    if connection.vendor == 'sqlite' and not options.keep:
+        shutil.rmtree(os.path.dirname(databaseName))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Compares storing keys and signatures as base64 text against raw bytes.
+
+Seeds a scratch SQLite database at the schema of migration 0005, where keys
+are text, and reports the on-disk size of the key tables and their indexes
+and the latency of GET /prekeybundle/. Then applies migration 0006, which
+converts the keys to bytes, and measures again.
+
+    python -m benchmarks.keystorage --devices 10000 --prekeys-per-device 100
+"""
+import argparse
+import base64
+import os
+import random
+import shutil
+import time
+from datetime import datetime
+from unittest import mock
+
+from benchmarks.common import setupDjango, summarise, formatSummary
+
+TABLES = ('api_device', 'api_prekey', 'api_signedprekey')
+
+
+# The text-era cache entry, before keys were copied to bytes
+def textCacheEntry(device):
+    signedPreKey = device.signedprekey
+    return (
+        device.id, device.user_id, device.registrationId, device.identityKey, device.address,
+        (signedPreKey.id, signedPreKey.keyId, signedPreKey.publicKey, signedPreKey.signature),
+    )
+
+
+def randomKey(length):
+    return base64.b64encode(os.urandom(length)).decode('ascii')
+
+
+def seed(cursor, devices, preKeysPerDevice):
+    now = datetime(2019, 1, 1).strftime('%Y-%m-%d %H:%M:%S')
+    cursor.executemany(
+        'INSERT INTO "auth_user" ("id", "password", "is_superuser", "username", "first_name", "last_name", '
+        '"email", "is_staff", "is_active", "date_joined") VALUES (%s, \'\', 0, %s, \'\', \'\', \'\', 0, 1, %s)',
+        [(i, 'user%d' % i, now) for i in range(1, devices + 1)])
+    cursor.executemany(
+        'INSERT INTO "api_device" ("id", "user_id", "identityKey", "registrationId", "address", "preKeyCount") '
+        'VALUES (%s, %s, %s, %s, %s, %s)',
+        [(i, i, randomKey(33), i, 'user%d.1' % i, preKeysPerDevice) for i in range(1, devices + 1)])
+    cursor.executemany(
+        'INSERT INTO "api_signedprekey" ("device_id", "keyId", "publicKey", "signature") VALUES (%s, 1, %s, %s)',
+        [(i, randomKey(33), randomKey(64)) for i in range(1, devices + 1)])
+    for device in range(1, devices + 1):
+        cursor.executemany(
+            'INSERT INTO "api_prekey" ("device_id", "keyId", "publicKey") VALUES (%s, %s, %s)',
+            [(device, keyId, randomKey(33)) for keyId in range(1, preKeysPerDevice + 1)])
+
+
+# Bytes used by each key table and its indexes, from SQLite's dbstat table
+def tableSizes(cursor):
+    cursor.execute('VACUUM')
+    sizes = {}
+    for table in TABLES:
+        cursor.execute(
+            'SELECT SUM(pgsize) FROM dbstat WHERE name = %s', [table])
+        tableSize = cursor.fetchone()[0]
+        cursor.execute(
+            'SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+            '(SELECT name FROM sqlite_master WHERE type = \'index\' AND tbl_name = %s)', [table])
+        sizes[table] = (tableSize, cursor.fetchone()[0] or 0)
+    return sizes
+
+
+def printSizes(sizes):
+    for table, (tableSize, indexSize) in sizes.items():
+        print('  %-20s table %8.1f MiB  indexes %8.1f MiB' % (table, tableSize / 2 ** 20, indexSize / 2 ** 20))
+
+
+# Fetches bundles for random recipients through the API, each claiming a prekey
+def measureBundles(devices, samples):
+    from django.contrib.auth.models import User
+    from django.core.cache import cache
+    from rest_framework.test import APIClient
+
+    cache.clear()
+    client = APIClient()
+    client.force_authenticate(user=User.objects.get(username='user1'))
+    timings = []
+    for _ in range(samples):
+        url = '/prekeybundle/user%d/1/' % random.randint(2, devices)
+        started = time.perf_counter()
+        response = client.get(url)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.data
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--prekeys-per-device', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch database')
+    options = parser.parse_args()
+
+    databaseName = setupDjango()
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection, transaction
+
+    # The load test is not what the throttles are protecting against
+    settings.REST_FRAMEWORK['DEFAULT_THROTTLE_CLASSES'] = ()
+    random.seed(0)
+    call_command('migrate', 'auth', verbosity=0)
+    call_command('migrate', 'api', '0005', verbosity=0)
+    print('Seeding %d devices with %d prekeys each in %s' % (options.devices, options.prekeys_per_device, databaseName))
+    with transaction.atomic(), connection.cursor() as cursor:
+        seed(cursor, options.devices, options.prekeys_per_device)
+
+    print('Before (migration 0005, base64 text)')
+    with connection.cursor() as cursor:
+        printSizes(tableSizes(cursor))
+    # Serve the text columns as they were, passed through without conversion
+    with mock.patch('api.encoders.encodeKey', lambda value: value), \
+            mock.patch('api.recipients.toCacheEntry', textCacheEntry):
+        samples = measureBundles(options.devices, options.samples)
+    print('  ' + formatSummary('bundle fetch', summarise(samples)))
+
+    call_command('migrate', 'api', '0006', verbosity=0)
+    print('After (migration 0006, raw bytes)')
+    with connection.cursor() as cursor:
+        printSizes(tableSizes(cursor))
+    print('  ' + formatSummary('bundle fetch', summarise(measureBundles(options.devices, options.samples))))
+
+    connection.close()
+    if connection.vendor == 'sqlite' and not options.keep:
+        shutil.rmtree(os.path.dirname(databaseName))
+
+
+if __name__ == '__main__':
+    main()
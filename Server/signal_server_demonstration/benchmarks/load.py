@@ -0,0 +1,343 @@
+"""
+End-to-end load test of the API over HTTP. Starts the server on a local
+port against a scratch database, then runs client processes against it in
+three phases, every client acting for its share of the users:
+
+  register  create the user through djoser, obtain a JWT and register a
+            device with 100 prekeys
+  traffic   --rounds times: claim the next user's prekey bundle, send it a
+            message, read the mailbox, drain it and acknowledge what was
+            drained, then top the prekey pool back up. Each user finally
+            rotates its signed prekey.
+  teardown  delete the device
+
+Reports throughput per phase and, per endpoint, throughput, p50/p99
+latency and queries per request, read from the Server-Timing header that
+REQUEST_METRICS adds. --output writes the results as JSON, and --compare
+prints the change against results saved from another commit.
+
+    python -m benchmarks.load --users 1000 --processes 4 --rounds 3 --output load.json
+    python -m benchmarks.load --users 1000 --processes 4 --rounds 3 --compare load.json
+
+The server is Django's threaded development server, one thread per client
+connection. Passwords are hashed with MD5 so registration measures the API
+rather than PBKDF2, unless --pbkdf2 is given.
+"""
+import argparse
+import base64
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import subprocess
+import time
+from datetime import timedelta
+
+from benchmarks.common import PROJECT_DIR, setupDjango, summarise
+
+PHASES = ('register', 'traffic', 'teardown')
+
+# Every endpoint exercised, with the phase it runs in
+ENDPOINTS = {
+    'POST /auth/users/': 'register',
+    'POST /auth/jwt/create/': 'register',
+    'POST /device/': 'register',
+    'GET /prekeybundle/': 'traffic',
+    'POST /messages/': 'traffic',
+    'GET /messages/': 'traffic',
+    'POST /messages/drain/': 'traffic',
+    'DELETE /messages/': 'traffic',
+    'POST /prekeys/': 'traffic',
+    'POST /signedprekey/': 'traffic',
+    'DELETE /device/': 'teardown',
+}
+
+PREKEYS = 100
+KEY = base64.b64encode(b'\x05' * 33).decode()
+SIGNATURE = base64.b64encode(b'\x00' * 64).decode()
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def serve(databaseName, metricsDir, pbkdf2, ports):
+    setupDjango(databaseName)
+    from django.conf import settings
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+
+    # The load test is not what the throttles are protecting against
+    settings.REST_FRAMEWORK['DEFAULT_THROTTLE_CLASSES'] = ()
+    settings.REQUEST_METRICS = True
+    settings.REQUEST_METRICS_DIR = metricsDir
+    settings.JWT_AUTH['JWT_EXPIRATION_DELTA'] = timedelta(hours=1)
+    if not pbkdf2:
+        settings.PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+    # Neither requests nor failures are logged
+    logging.getLogger('django.server').setLevel(logging.CRITICAL)
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+
+    class RequestHandler(WSGIRequestHandler):
+        # Headers and body are written separately, and without TCP_NODELAY
+        # the body waits on the client's delayed ACK. Production servers
+        # set it too.
+        def setup(self):
+            super().setup()
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), RequestHandler)
+    server.set_app(WSGIHandler())
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+# A keep-alive connection to the server that records every request as
+# (endpoint, seconds, status, queries)
+class Client:
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port)
+        self.samples = []
+
+    def request(self, endpoint, method, path, token=None, data=None):
+        headers = {'Content-Type': 'application/json'}
+        if token is not None:
+            headers['Authorization'] = 'Bearer ' + token
+        body = json.dumps(data) if data is not None else None
+        started = time.perf_counter()
+        try:
+            response = self.send(method, path, body, headers)
+        except ConnectionError:
+            # The server closed the connection between requests
+            self.connection.close()
+            response = self.send(method, path, body, headers)
+        content = response.read()
+        elapsed = time.perf_counter() - started
+        # DELETE /device/ answers 204 with a body, which http.client leaves
+        # unread, so the connection cannot be used for another request
+        if response.status == 204:
+            self.connection.close()
+
+        queries = QUERIES.search(response.getheader('Server-Timing', ''))
+        self.samples.append((endpoint, elapsed, response.status, int(queries.group(1)) if queries else None))
+        isJson = content and response.getheader('Content-Type', '').startswith('application/json')
+        return response, json.loads(content.decode()) if isJson else None
+
+    def send(self, method, path, body, headers):
+        self.connection.request(method, path, body, headers)
+        return self.connection.getresponse()
+
+
+class User:
+
+    def __init__(self, index, users):
+        self.username = 'user%d' % index
+        self.password = 'battery-staple-%d' % index
+        self.registrationId = index + 1
+        self.peer = (index + 1) % users
+        self.token = None
+        self.nextKeyId = PREKEYS + 1
+
+    def preKeys(self, count):
+        keys = [{'keyId': self.nextKeyId + i, 'publicKey': KEY} for i in range(count)]
+        self.nextKeyId += count
+        return keys
+
+
+def register(client, user):
+    credentials = {'username': user.username, 'password': user.password}
+    client.request('POST /auth/users/', 'POST', '/auth/users/', data=credentials)
+    _, data = client.request('POST /auth/jwt/create/', 'POST', '/auth/jwt/create/', data=credentials)
+    user.token = data['token'] if data else None
+    client.request('POST /device/', 'POST', '/device/', user.token, {
+        'identityKey': KEY,
+        'address': user.username + '.1',
+        'registrationId': user.registrationId,
+        'preKeys': [{'keyId': i, 'publicKey': KEY} for i in range(1, PREKEYS + 1)],
+        'signedPreKey': {'keyId': 1, 'publicKey': KEY, 'signature': SIGNATURE},
+    })
+
+
+def exchange(client, user):
+    own = user.registrationId
+    client.request('GET /prekeybundle/', 'GET', '/prekeybundle/user%d/%d/' % (user.peer, own), user.token)
+    client.request('POST /messages/', 'POST', '/messages/%d/' % own, user.token, {
+        'recipient': 'user%d' % user.peer,
+        'message': json.dumps({'type': 1, 'body': 'x' * 256, 'registrationId': user.peer + 1}),
+    })
+    client.request('GET /messages/', 'GET', '/messages/%d/?since=&limit=50' % own, user.token)
+    response, data = client.request('POST /messages/drain/', 'POST', '/messages/%d/drain/' % own, user.token,
+                                    {'limit': 50, 'visibilityTimeout': 60})
+    drained = [x['id'] for x in data['messages']] if data and 'messages' in data else []
+    if drained:
+        response, _ = client.request('DELETE /messages/', 'DELETE', '/messages/%d/' % own, user.token, drained)
+    # Responses to the device's owner report how many prekeys it has left
+    remaining = response.getheader('X-PreKeys-Remaining')
+    if remaining is not None and int(remaining) < PREKEYS:
+        client.request('POST /prekeys/', 'POST', '/prekeys/%d/' % own, user.token,
+                       user.preKeys(PREKEYS - int(remaining)))
+
+
+def rotateSignedPreKey(client, user):
+    client.request('POST /signedprekey/', 'POST', '/signedprekey/%d/' % user.registrationId, user.token,
+                   {'keyId': 2, 'publicKey': KEY, 'signature': SIGNATURE})
+
+
+def clientProcess(port, indexes, users, rounds, barrier, results):
+    client = Client(port)
+    own = [User(i, users) for i in indexes]
+    barrier.wait()
+    for user in own:
+        register(client, user)
+    barrier.wait()
+    for _ in range(rounds):
+        for user in own:
+            exchange(client, user)
+    for user in own:
+        rotateSignedPreKey(client, user)
+    barrier.wait()
+    for user in own:
+        client.request('DELETE /device/', 'DELETE', '/device/', user.token)
+    barrier.wait()
+    results.put(client.samples)
+
+
+def report(samples, elapsed):
+    phases = {}
+    for phase in PHASES:
+        count = sum(1 for x in samples if ENDPOINTS[x[0]] == phase)
+        phases[phase] = {'requests': count, 'seconds': elapsed[phase], 'requestsPerSecond': count / elapsed[phase]}
+    endpoints = {}
+    for endpoint, phase in ENDPOINTS.items():
+        own = [x for x in samples if x[0] == endpoint]
+        if not own:
+            continue
+        queries = [x[3] for x in own if x[3] is not None]
+        endpoints[endpoint] = dict(
+            summarise([x[1] for x in own]),
+            failed=sum(1 for x in own if x[2] >= 400),
+            requestsPerSecond=len(own) / elapsed[phase],
+            queriesPerRequest=sum(queries) / len(queries) if queries else None,
+            maxQueries=max(queries) if queries else None,
+        )
+    return {'phases': phases, 'endpoints': endpoints}
+
+
+def formatResults(results):
+    lines = []
+    for phase, stats in results['phases'].items():
+        lines.append('{:<10} {requests:>7} requests in {seconds:7.2f}s  {requestsPerSecond:8.1f} requests/s'.format(
+            phase, **stats))
+    lines.append('')
+    lines.append('{:<24} {:>7} {:>7} {:>9} {:>9} {:>9} {:>8}'.format(
+        'endpoint', 'count', 'failed', 'req/s', 'p50 ms', 'p99 ms', 'queries'))
+    for endpoint, stats in results['endpoints'].items():
+        queries = stats['queriesPerRequest']
+        lines.append('{:<24} {count:>7} {failed:>7} {requestsPerSecond:>9.1f} {p50_ms:>9.2f} {p99_ms:>9.2f} {:>8}'.format(
+            endpoint, '-' if queries is None else '%.2f' % queries, **stats))
+    return '\n'.join(lines)
+
+
+# Lists the change in each endpoint's figures against earlier results
+def formatComparison(results, baseline):
+    lines = ['Against %s' % (baseline.get('commit') or 'baseline')]
+    lines.append('{:<24} {:>10} {:>10} {:>10} {:>10}'.format('endpoint', 'req/s', 'p50', 'p99', 'queries'))
+    for endpoint, stats in results['endpoints'].items():
+        before = baseline['endpoints'].get(endpoint)
+        if before is None:
+            continue
+
+        def change(key):
+            if not before.get(key) or stats.get(key) is None:
+                return '-'
+            return '%+.1f%%' % ((stats[key] - before[key]) / before[key] * 100)
+
+        lines.append('{:<24} {:>10} {:>10} {:>10} {:>10}'.format(
+            endpoint, change('requestsPerSecond'), change('p50_ms'), change('p99_ms'), change('queriesPerRequest')))
+    return '\n'.join(lines)
+
+
+def currentCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=4, help='client processes')
+    parser.add_argument('--rounds', type=int, default=3, help='message exchanges per user')
+    parser.add_argument('--pbkdf2', action='store_true', help="hash passwords with the project's hashers")
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    options = parser.parse_args()
+
+    databaseName = setupDjango()
+    from django.core.management import call_command
+    from django.db import connection
+
+    call_command('migrate', verbosity=0)
+    if connection.vendor != 'sqlite':
+        call_command('flush', interactive=False, verbosity=0)
+    # The server must not inherit this process's connection
+    connection.close()
+    workDir = os.path.dirname(databaseName) if connection.vendor == 'sqlite' else None
+
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    metricsDir = os.path.join(workDir or PROJECT_DIR, 'load-metrics')
+    server = context.Process(target=serve, args=(databaseName, metricsDir, options.pbkdf2, ports), daemon=True)
+    server.start()
+    port = ports.get(timeout=60)
+
+    barrier = context.Barrier(options.processes + 1)
+    results = context.Queue()
+    clients = [
+        context.Process(target=clientProcess, args=(
+            port, range(p, options.users, options.processes), options.users, options.rounds, barrier, results))
+        for p in range(options.processes)
+    ]
+    for process in clients:
+        process.start()
+
+    print('%d users, %d client processes, %d rounds, server on port %d' % (
+        options.users, options.processes, options.rounds, port))
+    barrier.wait()
+    elapsed = {}
+    for phase in PHASES:
+        started = time.perf_counter()
+        barrier.wait()
+        elapsed[phase] = time.perf_counter() - started
+    samples = []
+    for _ in clients:
+        samples += results.get()
+    for process in clients:
+        process.join()
+    server.terminate()
+    server.join()
+
+    results = dict(report(samples, elapsed), commit=currentCommit(), options={
+        'users': options.users, 'processes': options.processes, 'rounds': options.rounds, 'pbkdf2': options.pbkdf2,
+    })
+    print(formatResults(results))
+    if options.compare:
+        with open(options.compare) as baselineFile:
+            print()
+            print(formatComparison(results, json.load(baselineFile)))
+    if options.output:
+        with open(options.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2)
+
+    if workDir is not None:
+        shutil.rmtree(workDir)
+    else:
+        shutil.rmtree(metricsDir, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Compares the mailbox backends. Each device is sent messages one at a time,
+as POST /messages/ stores them, then its mailbox is drained in pages, and
+the store and drain latencies are reported per backend.
+
+    python -m benchmarks.mailbox --devices 100 --messages-per-device 200
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+from benchmarks.common import setupDjango, timeCalls, summarise, formatSummary
+
+BODY = os.urandom(512)
+
+
+def createDevices(count):
+    from django.contrib.auth.models import User
+    from api.models import Device
+
+    User.objects.bulk_create(User(username='user%d' % i) for i in range(count))
+    users = User.objects.order_by('id')
+    Device.objects.bulk_create(
+        Device(user=user, identityKey=b'\x05' * 33, registrationId=i + 1, address=user.username + '.1')
+        for i, user in enumerate(users))
+    return list(Device.objects.order_by('id'))
+
+
+def measure(name, mailbox, devices, messagesPerDevice, pageSize):
+    from api.models import Message
+
+    def store(recipient, sender):
+        mailbox.store([Message(
+            recipient=recipient, sender=sender, recipientRegistrationId=recipient.registrationId,
+            messageType=1, body=BODY)])
+
+    def drain(device):
+        hasMore = True
+        while hasMore:
+            _, hasMore = mailbox.drain(device, pageSize)
+
+    stores = [(devices[i % len(devices)], devices[(i + 1) % len(devices)])
+              for i in range(len(devices) * messagesPerDevice)]
+    print(formatSummary('%s store' % name, summarise(timeCalls(store, stores))))
+    print(formatSummary('%s drain (page %d)' % (name, pageSize),
+                        summarise(timeCalls(drain, [(x,) for x in devices]))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--messages-per-device', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--no-fsync', action='store_true', help='do not fsync segment log writes')
+    options = parser.parse_args()
+
+    databaseName = setupDjango()
+    from django.core.management import call_command
+    from django.db import connection
+    from api.mailboxes import DatabaseMailbox
+    from api.segmentlog import SegmentLogMailbox
+
+    call_command('migrate', verbosity=0)
+    devices = createDevices(options.devices)
+    measure('database', DatabaseMailbox(), devices, options.messages_per_device, options.page_size)
+
+    root = tempfile.mkdtemp(prefix='signal-mailboxes-')
+    segmentLog = SegmentLogMailbox(root)
+    segmentLog.fsync = not options.no_fsync
+    measure('segment log', segmentLog, devices, options.messages_per_device, options.page_size)
+
+    connection.close()
+    shutil.rmtree(root)
+    if connection.vendor == 'sqlite':
+        shutil.rmtree(os.path.dirname(databaseName))
+
+
+if __name__ == '__main__':
+    main()
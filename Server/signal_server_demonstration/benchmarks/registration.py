@@ -0,0 +1,94 @@
+"""
+Registers devices with a full set of prekeys through POST /device/ and
+reports throughput, comparing the original per-row registration with the
+current transactional bulk insert.
+
+    python -m benchmarks.registration --devices 10000
+"""
+import argparse
+import os
+import shutil
+import time
+from unittest import mock
+
+from benchmarks.common import setupDjango, summarise, formatSummary
+
+# Base64 of a 33 byte public key and a 64 byte signature
+KEY = 'BQ' + 'A' * 42
+SIGNATURE = 'A' * 86 + '=='
+
+
+# DeviceSerializer.create as it was before registration became atomic:
+# every prekey is inserted, and committed, on its own
+def perRowCreate(self, validated_data):
+    from api.models import Device, PreKey, SignedPreKey
+    user = self.context['user']
+    signedPreKey = validated_data.pop('signedPreKey')
+    preKeys = validated_data.pop('preKeys')
+    deviceReference = Device.objects.create(user=user, preKeyCount=len(preKeys), **validated_data)
+    SignedPreKey.objects.create(device=deviceReference, **signedPreKey)
+    for x in preKeys:
+        PreKey.objects.create(device=deviceReference, **x)
+    return deviceReference
+
+
+def registration(username, preKeys):
+    return {
+        'identityKey': KEY,
+        'address': username + '.1',
+        'registrationId': 1,
+        'preKeys': [{'keyId': x, 'publicKey': KEY} for x in range(1, preKeys + 1)],
+        'signedPreKey': {'keyId': 1, 'publicKey': KEY, 'signature': SIGNATURE},
+    }
+
+
+def register(prefix, devices, preKeys):
+    from django.contrib.auth.models import User
+    from rest_framework.test import APIClient
+
+    User.objects.bulk_create(User(username='%s%d' % (prefix, i)) for i in range(devices))
+    users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+    client = APIClient()
+    samples = []
+    started = time.perf_counter()
+    for user in users:
+        client.force_authenticate(user=user)
+        body = registration(user.username, preKeys)
+        requestStarted = time.perf_counter()
+        response = client.post('/device/', body, format='json')
+        samples.append(time.perf_counter() - requestStarted)
+        assert response.status_code == 201, response.data
+    elapsed = time.perf_counter() - started
+    return elapsed, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--prekeys', type=int, default=100)
+    options = parser.parse_args()
+
+    databaseName = setupDjango()
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from api.serializers import DeviceSerializer
+
+    # The load test is not what the throttles are protecting against
+    settings.REST_FRAMEWORK['DEFAULT_THROTTLE_CLASSES'] = ()
+    call_command('migrate', verbosity=0)
+
+    print('Registering %d devices with %d prekeys each in %s' % (options.devices, options.prekeys, databaseName))
+    with mock.patch.object(DeviceSerializer, 'create', perRowCreate):
+        elapsed, samples = register('perrow', options.devices, options.prekeys)
+    print(formatSummary('per-row inserts', summarise(samples)) + '  %.1f devices/s' % (options.devices / elapsed))
+    elapsed, samples = register('bulk', options.devices, options.prekeys)
+    print(formatSummary('atomic bulk insert', summarise(samples)) + '  %.1f devices/s' % (options.devices / elapsed))
+
+    connection.close()
+    if connection.vendor == 'sqlite':
+        shutil.rmtree(os.path.dirname(databaseName))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Times building and rendering a mailbox response, comparing MessageSerializer
+and DRF's JSONRenderer with encodeMessages and the orjson renderer, and
+times parsing a batch POST body with each parser. Runs in memory, with no
+database queries.
+
+    python -m benchmarks.rendering --messages 1000
+"""
+import argparse
+import json
+import os
+from io import BytesIO
+
+from benchmarks.common import setupDjango, timeCalls, summarise, formatSummary
+
+
+def mailbox(count):
+    from django.utils import timezone
+    from api.models import Device, Message
+
+    sender = Device(id=1, registrationId=1111, address='sender.1')
+    recipient = Device(id=2, registrationId=2222, address='recipient.1')
+    now = timezone.now()
+    # A typical Signal message, a few hundred bytes of ciphertext
+    return [
+        Message(id=i, created=now, sender=sender, recipient=recipient, recipientRegistrationId=2222,
+                messageType=1, body=os.urandom(300))
+        for i in range(1, count + 1)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    options = parser.parse_args()
+
+    setupDjango()
+    from rest_framework.parsers import JSONParser
+    from rest_framework.renderers import JSONRenderer
+    from api.renderers import FastJSONRenderer, FastJSONParser
+    from api.encoders import encodeMessages
+    from api.serializers import MessageSerializer
+
+    messages = mailbox(options.messages)
+    runs = [()] * options.repeat
+    print('Rendering %d messages, %d times' % (options.messages, options.repeat))
+    cases = [
+        ('serializer + JSONRenderer', lambda: JSONRenderer().render(MessageSerializer(messages, many=True).data)),
+        ('encoder + JSONRenderer', lambda: JSONRenderer().render(encodeMessages(messages))),
+        ('encoder + FastJSONRenderer', lambda: FastJSONRenderer().render(encodeMessages(messages))),
+    ]
+    for name, render in cases:
+        print(formatSummary(name, summarise(timeCalls(render, runs))))
+
+    # A batch POST of 100 envelopes
+    body = json.dumps([
+        {'recipient': 'user%d' % i, 'message': json.dumps({'type': 1, 'body': 'x' * 300, 'registrationId': i})}
+        for i in range(100)
+    ]).encode()
+    print('Parsing a %d byte batch, %d times' % (len(body), options.repeat))
+    for name, parse in [('JSONParser', JSONParser()), ('FastJSONParser', FastJSONParser())]:
+        print(formatSummary(name, summarise(timeCalls(lambda: parse.parse(BytesIO(body)), runs))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Runs a mixed read/write load against the mailbox and compares reading from
+the primary database with reading from a replica. Writer processes post
+messages to the readers, while reader processes page through their own
+mailboxes with GET /messages/, each process calling Django's WSGI handler
+as a WSGI worker would.
+
+  primary  every query goes to the primary database
+  replica  MessageList.get reads from the replica alias, as it does with
+           REPLICA_DATABASE set, and writes still go to the primary
+
+On SQLite the replica is a copy of the database taken after seeding, so
+readers see the seeded mailboxes and never the messages posted during the
+run, as they would with a replica lagging behind. Readers never write, so
+read-your-writes stickiness is not exercised here. api.tests covers it
+across workers.
+
+    python -m benchmarks.replica --readers 4 --writers 4 --duration 10
+
+With POSTGRES_DB set the benchmark runs against that PostgreSQL database
+instead, which must be a scratch database as it is flushed before each
+run, and replica mode reads from POSTGRES_REPLICA_DB, which must replicate
+it.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import time
+
+from benchmarks.common import setupDjango, summarise, formatSummary
+
+MODES = ('primary', 'replica')
+
+
+def configure(replicaName):
+    from django.conf import settings
+    # The load test is not what the throttles are protecting against
+    settings.REST_FRAMEWORK['DEFAULT_THROTTLE_CLASSES'] = ()
+    settings.REPLICA_DATABASE = 'replica' if replicaName else None
+    if replicaName and settings.DATABASES['replica']['ENGINE'] == 'django.db.backends.sqlite3':
+        settings.DATABASES['replica']['NAME'] = replicaName
+
+
+# Creates a device per reader and writer, and fills each reader's mailbox,
+# returning the readers' and the writers' (token, registrationId)
+def seed(readers, writers, mailboxSize):
+    from django.contrib.auth.models import User
+    from rest_framework_jwt.settings import api_settings
+    from api.models import Device, Message
+
+    encode, payload = api_settings.JWT_ENCODE_HANDLER, api_settings.JWT_PAYLOAD_HANDLER
+    devices = []
+    for i in range(readers + writers):
+        user = User.objects.create_user(username='user%d' % i)
+        devices.append(Device.objects.create(user=user, identityKey=b'\x05' * 33, registrationId=i + 1,
+                                             address=user.username + '.1'))
+    for i, recipient in enumerate(devices[:readers]):
+        sender = devices[readers + i % writers]
+        Message.objects.bulk_create((Message(recipient=recipient, sender=sender, recipientRegistrationId=i + 1,
+                                             messageType=1, body=b'x' * 256) for _ in range(mailboxSize)),
+                                    batch_size=500)
+    clients = [(encode(payload(device.user)), device.registrationId) for device in devices]
+    return clients[:readers], clients[readers:]
+
+
+def request(handler, environ):
+    statuses = []
+    response = handler(environ, lambda status, headers: statuses.append(status))
+    try:
+        content = b''.join(response)
+    finally:
+        response.close()
+    return int(statuses[0].split()[0]), content
+
+
+def worker(databaseName, replicaName, role, index, readers, token, registrationId, pageSize, duration, start,
+           results):
+    setupDjango(databaseName)
+    configure(replicaName)
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test import RequestFactory
+
+    # Failed requests are counted, not logged
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    handler = WSGIHandler()
+    factory = RequestFactory()
+    url = '/messages/%d/' % registrationId
+    authorization = 'Bearer ' + token
+    recipient = index % readers
+    since = ''
+    samples, failures = [], 0
+    start.wait()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        if role == 'writer':
+            # Writers take turns sending to each reader
+            body = json.dumps({
+                'recipient': 'user%d' % recipient,
+                'message': json.dumps({'type': 1, 'body': 'x' * 256, 'registrationId': recipient + 1}),
+            })
+            recipient = (recipient + 1) % readers
+            environ = factory.post(url, body, content_type='application/json',
+                                   HTTP_AUTHORIZATION=authorization).environ
+        else:
+            environ = factory.get(url, {'since': since, 'limit': pageSize}, HTTP_AUTHORIZATION=authorization).environ
+        started = time.perf_counter()
+        statusCode, content = request(handler, environ)
+        samples.append(time.perf_counter() - started)
+        if statusCode >= 400:
+            failures += 1
+        elif role == 'reader':
+            page = json.loads(content.decode())
+            # Starts over from the oldest message after the last page
+            since = page['next'] if page['hasMore'] else ''
+    results.put((role, samples, failures))
+
+
+def resetDatabase(databaseName):
+    from django.core.management import call_command
+    from django.db import connection
+
+    connection.close()
+    if connection.vendor == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(databaseName + suffix):
+                os.remove(databaseName + suffix)
+        call_command('migrate', verbosity=0)
+    else:
+        call_command('migrate', verbosity=0)
+        call_command('flush', interactive=False, verbosity=0)
+
+
+# Copies the seeded SQLite database to the replica's file
+def copyDatabase(databaseName, replicaName):
+    source, target = sqlite3.connect(databaseName), sqlite3.connect(replicaName)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def run(databaseName, mode, options):
+    from django.db import connection
+
+    resetDatabase(databaseName)
+    readers, writers = seed(options.readers, options.writers, options.mailbox)
+    # Workers must not inherit this process's connection
+    connection.close()
+    replicaName = None
+    if mode == 'replica':
+        replicaName = databaseName + '.replica' if connection.vendor == 'sqlite' else 'replica'
+        if connection.vendor == 'sqlite':
+            copyDatabase(databaseName, replicaName)
+
+    context = multiprocessing.get_context('spawn')
+    start = context.Event()
+    results = context.Queue()
+    clients = [('reader', x) for x in readers] + [('writer', x) for x in writers]
+    processes = [
+        context.Process(target=worker, args=(databaseName, replicaName, role, i, len(readers), token, registrationId,
+                                             options.page_size, options.duration, start, results))
+        for i, (role, (token, registrationId)) in enumerate(clients)
+    ]
+    for process in processes:
+        process.start()
+    # Give every worker time to import Django before the clock starts
+    time.sleep(2)
+    start.set()
+    samples = {'reader': [], 'writer': []}
+    failures = {'reader': 0, 'writer': 0}
+    for _ in processes:
+        role, workerSamples, workerFailures = results.get()
+        samples[role] += workerSamples
+        failures[role] += workerFailures
+    for process in processes:
+        process.join()
+
+    print(mode)
+    for role, endpoint in (('writer', 'send message'), ('reader', 'fetch mailbox')):
+        print('  ' + formatSummary(endpoint, summarise(samples[role])) +
+              '  %.1f requests/s  %d failed' % (len(samples[role]) / options.duration, failures[role]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10, help='seconds each run lasts')
+    parser.add_argument('--mailbox', type=int, default=1000, help='messages seeded into each reader\'s mailbox')
+    parser.add_argument('--page-size', type=int, default=50)
+    options = parser.parse_args()
+
+    databaseName = setupDjango()
+    from django.conf import settings
+    from django.db import connection
+
+    print('%d readers, %d writers, %gs per run' % (options.readers, options.writers, options.duration))
+    for mode in MODES:
+        if mode == 'replica' and 'replica' not in settings.DATABASES:
+            print('replica: skipped, POSTGRES_REPLICA_DB is not set')
+            continue
+        run(databaseName, mode, options)
+
+    connection.close()
+    if connection.vendor == 'sqlite':
+        shutil.rmtree(os.path.dirname(databaseName))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Times throttle checks for one busy user, comparing DRF's UserRateThrottle,
+which rewrites a list of timestamps on every check, with the fixed window
+counter in api.throttling, on each throttle store. Checks are timed after
+the user has already made --history requests in the period.
+
+    python -m benchmarks.throttling --history 100 1000 10000
+"""
+import argparse
+from types import SimpleNamespace
+
+from benchmarks.common import setupDjango, timeCalls, summarise, formatSummary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--checks', type=int, default=1000)
+    options = parser.parse_args()
+
+    setupDjango()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.core.cache import cache
+    from rest_framework import throttling as drf
+    from api import throttling
+
+    request = SimpleNamespace(user=User(id=1, username='user1'), META={'REMOTE_ADDR': '127.0.0.1'})
+    # A limit high enough that no check is refused
+    rate = '%d/day' % (max(options.history) + options.checks + 1)
+    cases = [
+        ('DRF UserRateThrottle', drf.UserRateThrottle, 'api.throttling.CacheThrottleStore'),
+        ('window counter, cache store', throttling.UserRateThrottle, 'api.throttling.CacheThrottleStore'),
+        ('window counter, local store', throttling.UserRateThrottle, 'api.throttling.LocalThrottleStore'),
+    ]
+    for history in options.history:
+        print('After %d requests' % history)
+        for name, throttleClass, store in cases:
+            cache.clear()
+            settings.THROTTLE_STORE = store
+            throttling.getThrottleStore.cache_clear()
+            throttle = type('BenchmarkThrottle', (throttleClass,), {'rate': rate})()
+            for _ in range(history):
+                throttle.allow_request(request, None)
+            samples = timeCalls(lambda: throttle.allow_request(request, None), [()] * options.checks)
+            print('  ' + formatSummary(name, summarise(samples)))
+
+
+if __name__ == '__main__':
+    main()
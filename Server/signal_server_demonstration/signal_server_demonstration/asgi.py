@@ -0,0 +1,22 @@
+"""
+ASGI config for signal_server_demonstration project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with any ASGI server, for example::
+
+    uvicorn signal_server_demonstration.asgi:application
+
+See api/asgi.py for how views are run.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'signal_server_demonstration.settings')
+
+django.setup(set_prefix=False)
+
+from api.asgi import ASGIHandler
+
+application = ASGIHandler()
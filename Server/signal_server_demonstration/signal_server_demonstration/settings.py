@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -44,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the rest of the chain
+    'api.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -74,16 +77,97 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'signal_server_demonstration.wsgi.application'
 
+# Worker threads the ASGI handler in signal_server_demonstration/asgi.py runs
+# views and queries on. Each holds its own database connection.
+ASGI_THREADS = 8
+
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# Set POSTGRES_DB to use PostgreSQL, with POSTGRES_HOST, POSTGRES_PORT,
+# POSTGRES_USER and POSTGRES_PASSWORD as needed. Otherwise SQLite is used.
+#
+# Each worker keeps its connection open for DATABASE_CONN_MAX_AGE seconds
+# instead of connecting on every request. Set it to 0 to close connections
+# at the end of each request, as Django does by default.
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
+if os.environ.get('POSTGRES_DB'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ['POSTGRES_DB'],
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'USER': os.environ.get('POSTGRES_USER', ''),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            # Server side cursors do not survive PgBouncer's transaction
+            # pooling, so set POSTGRES_POOLED when connecting through it
+            'DISABLE_SERVER_SIDE_CURSORS': bool(os.environ.get('POSTGRES_POOLED')),
+        }
+    }
+    if os.environ.get('POSTGRES_REPLICA_DB'):
+        DATABASES['replica'] = dict(
+            DATABASES['default'],
+            NAME=os.environ['POSTGRES_REPLICA_DB'],
+            HOST=os.environ.get('POSTGRES_REPLICA_HOST', DATABASES['default']['HOST']),
+            PORT=os.environ.get('POSTGRES_REPLICA_PORT', DATABASES['default']['PORT']),
+        )
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            # Use an on-disk test database so concurrent connections wait on
+            # SQLite's lock rather than failing as they do with shared memory
+            'TEST': {
+                'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+            },
+        },
     }
+    # Defined only with SQLITE_REPLICA_NAME set, and for tests, which give
+    # it a database of its own, so nothing creates a stray replica file
+    if os.environ.get('SQLITE_REPLICA_NAME') or sys.argv[1:2] == ['test']:
+        DATABASES['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_REPLICA_NAME', ''),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'TEST': {
+                'NAME': os.path.join(BASE_DIR, 'test_replica.sqlite3'),
+            },
+        }
+
+# Views opt in to reading from the REPLICA_DATABASE alias, a read replica
+# of the primary, with api.routers.readsFromReplica. A device that wrote
+# through the API reads from the primary for the next REPLICA_STICKY_SECONDS,
+# which should exceed the replication lag. That is recorded in the default
+# cache, so a replica also needs MEMCACHED_LOCATION set. Point
+# SQLITE_REPLICA_NAME at a replicated copy of the SQLite file, or set
+# POSTGRES_REPLICA_DB, with POSTGRES_REPLICA_HOST and POSTGRES_REPLICA_PORT
+# if they differ from the primary's, to enable it.
+DATABASE_ROUTERS = ['api.routers.ReplicaRouter']
+REPLICA_DATABASE = 'replica' if os.environ.get('SQLITE_REPLICA_NAME') or os.environ.get('POSTGRES_REPLICA_DB') else None
+REPLICA_STICKY_SECONDS = 5
+
+# Pragmas set on every new SQLite connection by api.database. busy_timeout
+# is how many milliseconds a writer waits for the lock before failing with
+# "database is locked". Set SQLITE_WAL to also switch to WAL, which lets
+# mailbox reads carry on while a message is being written, and with it
+# synchronous=normal only syncs at checkpoints, which can lose the last
+# commits on power loss but never corrupts the database. WAL is recorded in
+# the database file and adds -wal and -shm files beside it, so it is left
+# off for the development database committed with the project.
+SQLITE_PRAGMAS = {
+    'busy_timeout': 5000,
 }
+if os.environ.get('SQLITE_WAL'):
+    SQLITE_PRAGMAS.update({
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+    })
 
 
 # Password validation
@@ -131,12 +215,23 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
+        'api.authentication.DeviceJSONWebTokenAuthentication',
+    ),
+    # JSON goes through orjson where it is installed
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
     ),
+    'DEFAULT_PARSER_CLASSES': (
+        'api.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
+    # Fixed window counters in THROTTLE_STORE, see api/throttling.py
     'DEFAULT_THROTTLE_CLASSES': (
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle',
-        'rest_framework.throttling.ScopedRateThrottle',
+        'api.throttling.AnonRateThrottle',
+        'api.throttling.UserRateThrottle',
+        'api.throttling.ScopedRateThrottle',
     ),
     'DEFAULT_THROTTLE_RATES': {
         'anon': '3/hour',
@@ -155,8 +250,77 @@ SIMPLE_JWT = {
    'AUTH_HEADER_TYPES': ('JWT',),
 }
 
+# Caches
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+#
+# Recipient devices and verified tokens are cached in the default cache,
+# and every worker process must see an entry removed by another, so with
+# more than one worker, or a read replica, the cache must be shared. Set
+# MEMCACHED_LOCATION to memcached's host:port, comma separated for several
+# servers (requires python-memcached). Otherwise each process has a local
+# memory cache of its own, and the api checks warn with WORKER_PROCESSES
+# above 1 or with REPLICA_DATABASE set.
+if os.environ.get('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['MEMCACHED_LOCATION'].split(','),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Worker processes serving the API, taken from WEB_CONCURRENCY, which
+# gunicorn also reads as its number of workers
+WORKER_PROCESSES = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Where throttles count requests. api.throttling.CacheThrottleStore counts
+# in the THROTTLE_CACHE cache, which must be shared, such as memcached, for
+# limits to hold across worker processes. api.throttling.LocalThrottleStore
+# counts in process memory.
+THROTTLE_STORE = 'api.throttling.CacheThrottleStore'
+THROTTLE_CACHE = 'default'
+
+# Seconds a recipient's device and signed prekey stay cached. Entries are
+# also removed whenever the device or signed prekey changes.
+RECIPIENT_CACHE_TIMEOUT = 300
+
+# Notification bus used to wake long-polling mailbox requests
+MESSAGE_NOTIFICATION_BUS = 'api.notifications.LocalNotificationBus'
+
+# Largest message ciphertext accepted, in bytes, and the size above which
+# ciphertext is stored zlib compressed when that makes it smaller. Signal
+# ciphertext rarely compresses, so compression is off unless a threshold is set.
+MESSAGE_MAX_BODY_BYTES = 64 * 1024
+MESSAGE_COMPRESSION_THRESHOLD = None
+
+# Where messages are stored. api.mailboxes.DatabaseMailbox keeps them in
+# the Message table; api.segmentlog.SegmentLogMailbox keeps an append-only
+# log per device under MAILBOX_DIR, which all workers must share.
+MAILBOX_BACKEND = 'api.mailboxes.DatabaseMailbox'
+MAILBOX_DIR = os.path.join(BASE_DIR, 'mailboxes')
+
+# Seconds an undelivered message is kept before compact_mailboxes purges it
+MESSAGE_TTL = 30 * 24 * 60 * 60
+
+# Successful responses to a device's owner report its remaining one-time
+# prekeys, and ask for more once fewer than this many are left
+PREKEY_LOW_WATER_MARK = 10
+
+# Adds a Server-Timing header with query count, database, render and total
+# time to every response, and aggregates them per view for the
+# request_metrics command. Each worker process writes its metrics under
+# REQUEST_METRICS_DIR at most every REQUEST_METRICS_FLUSH_INTERVAL seconds.
+REQUEST_METRICS = False
+REQUEST_METRICS_DIR = os.path.join(BASE_DIR, 'metrics')
+REQUEST_METRICS_FLUSH_INTERVAL = 10
 
 CORS_ORIGIN_ALLOW_ALL = True
+CORS_EXPOSE_HEADERS = ('X-PreKeys-Remaining', 'X-PreKeys-Replenish')
 # CORS_ORIGIN_WHITELIST = (
 #     'http://127.0.0.1:3000/'
 # )